@@ -20,6 +20,7 @@
 #include <string.h>  // strcmp()
 #include <cmath>  // std::abs operates on doubles
 #include <cstdlib>  // strtol
+#include <string>
 #include <vector>
 
 using std::vector;
@@ -99,6 +100,35 @@ static bool ReadListOfMatrices(
   return true;
 }
 
+// Read the pij to start EM from, written by WriteStartingPij() in
+// analysis/tensorflow/fast_em.py: a 'pij' tag and entry_size doubles.
+static bool ReadStartingPij(FILE* f, uint32_t entry_size,
+                            vector<double>* pij_out) {
+  if (!ExpectTag(f, "pij")) {
+    return false;
+  }
+  vector<double>& pij = *pij_out;
+  pij.resize(entry_size);
+  if (fread(&pij[0], sizeof pij[0], entry_size, f) != entry_size) {
+    return false;
+  }
+
+  double sum = 0.0;
+  for (size_t i = 0; i < pij.size(); ++i) {
+    if (pij[i] < 0.0) {
+      return false;
+    }
+    sum += pij[i];
+  }
+  if (!(sum > 0.0)) {
+    return false;
+  }
+  for (size_t i = 0; i < pij.size(); ++i) {
+    pij[i] /= sum;
+  }
+  return true;
+}
+
 void PrintEntryVector(const vector<double>& cond_prob, size_t m,
                       size_t entry_size) {
   size_t c_base = m * entry_size;
@@ -123,16 +153,24 @@ void PrintPij(const vector<double>& pij) {
 
 // EM algorithm to iteratively estimate parameters.
 
+// If starting_pij is not empty, start from it instead of the uniform
+// distribution.
 static int ExpectationMaximization(
     uint32_t num_entries, uint32_t entry_size, const vector<double>& cond_prob,
-    int max_em_iters, double epsilon, vector<double>* pij_out) {
-  // Start out with uniform distribution.
+    const vector<double>& starting_pij, int max_em_iters, double epsilon,
+    vector<double>* pij_out) {
   vector<double> pij(entry_size, 0.0);
-  double init = 1.0 / entry_size;
-  for (size_t i = 0; i < pij.size(); ++i) {
-    pij[i] = init;
+  if (starting_pij.empty()) {
+    // Start out with uniform distribution.
+    double init = 1.0 / entry_size;
+    for (size_t i = 0; i < pij.size(); ++i) {
+      pij[i] = init;
+    }
+    log("Initialized %d entries with %f", pij.size(), init);
+  } else {
+    pij = starting_pij;
+    log("Initialized %d entries with the starting pij", pij.size());
   }
-  log("Initialized %d entries with %f", pij.size(), init);
 
   vector<double> prev_pij(entry_size, 0.0);  // pij on previous iteration
 
@@ -291,12 +329,26 @@ int main(int argc, char **argv) {
   }
   log("Debug sum: %f", debug_sum);
 
+  // Optional: INPUT.start.bin has the pij to start from.
+  vector<double> starting_pij;
+  std::string start_filename = std::string(in_filename) + ".start.bin";
+  FILE* f_start = fopen(start_filename.c_str(), "rb");
+  if (f_start != NULL) {
+    if (!ReadStartingPij(f_start, entry_size, &starting_pij)) {
+      log("Error reading %s", start_filename.c_str());
+      return 1;
+    }
+    fclose(f_start);
+    log("Read starting pij from %s", start_filename.c_str());
+  }
+
   double epsilon = 1e-6;
   log("epsilon: %f", epsilon);
 
   vector<double> pij(entry_size);
   int num_em_iters = ExpectationMaximization(
-      num_entries, entry_size, cond_prob, max_em_iters, epsilon, &pij);
+      num_entries, entry_size, cond_prob, starting_pij, max_em_iters, epsilon,
+      &pij);
 
   if (!WriteResult(pij, num_em_iters, f_out)) {
     log("Error writing result matrix");
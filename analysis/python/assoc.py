@@ -0,0 +1,421 @@
+#!/usr/bin/python
+"""
+assoc.py: Conditional probabilities for RAPPOR association analysis.
+
+This follows ComputeDistributionEM() in analysis/R/association.R, but instead
+of one matrix per report built with mclapply, the conditional probabilities of
+all reports are computed with array operations on a bit matrix:
+
+  - The reports of a variable are an N x k bit matrix.
+  - For each cohort, the bits of the decoded candidates are a k x J table,
+    built once.
+  - The log likelihood of the reports of a cohort given each candidate is then
+    one matrix product.
+
+The result is an N x E matrix, one row per report, which fast_em.py in
+analysis/tensorflow can run EM on directly, without the serialization round
+trip of fast_em.R.
+"""
+
+import csv
+
+import numpy as np
+
+import decode
+
+
+def ReadReportsColumns(f, var_names):
+  """Read the columns of some variables from an assoc reports CSV file.
+
+  The file has a 'cohort' column, and a column of ASCII bit strings per
+  variable.  Missing values are blank.
+
+  Returns:
+    (int array of cohorts as written, list of value lists, one per variable)
+  """
+  reader = csv.reader(f)
+  try:
+    header = reader.next()
+  except StopIteration:
+    raise decode.Error('Reports file is empty')
+
+  try:
+    cohort_index = header.index('cohort')
+    var_indices = [header.index(name) for name in var_names]
+  except ValueError as e:
+    raise decode.Error('Reports file: %s' % e)
+
+  cohorts = []
+  values = [[] for _ in var_names]
+  for row in reader:
+    cohorts.append(int(row[cohort_index]))
+    for vals, i in zip(values, var_indices):
+      vals.append(row[i])
+  return np.array(cohorts, dtype=np.int64), values
+
+
+def ReadReportsFile(f, var_names, remove_bad_rows=False):
+  """Read the reports of some variables, without the bad rows.
+
+  Rows with a blank value are bad; like decode_assoc.R, they're an error
+  unless remove_bad_rows is set.
+
+  Returns:
+    (int array of cohorts as written, list of value lists, one per variable,
+     number of bad rows)
+  """
+  cohorts, values = ReadReportsColumns(f, var_names)
+  good = np.ones(len(cohorts), dtype=bool)
+  for vals in values:
+    good &= NonBlank(vals)
+
+  num_bad = len(cohorts) - np.count_nonzero(good)
+  if num_bad and not remove_bad_rows:
+    raise decode.Error(
+        "Found %d bad rows and remove_bad_rows wasn't set" % num_bad)
+  rows = np.flatnonzero(good)
+  return cohorts[rows], [[vals[i] for i in rows] for vals in values], num_bad
+
+
+def NonBlank(values):
+  """Boolean array: which values aren't blank."""
+  return np.fromiter((v != '' for v in values), dtype=bool, count=len(values))
+
+
+def BitMatrix(values, k):
+  """Convert ASCII bit strings to an N x k boolean matrix.
+
+  Like sum_bits.py, char 0 of a string is bit k - 1, so column b is bit b.
+  """
+  lengths = np.fromiter((len(v) for v in values), dtype=np.int64,
+                        count=len(values))
+  if np.any(lengths != k):
+    bad = values[np.flatnonzero(lengths != k)[0]]
+    raise decode.Error('Expected %d bits, got %r' % (k, bad))
+  chars = np.frombuffer(''.join(values), dtype=np.uint8)
+  return chars.reshape(len(values), k)[:, ::-1] == ord('1')
+
+
+def CohortCounts(params, cohorts, bits):
+  """Sum the bits of each cohort into an m x (k + 1) counts matrix.
+
+  Like ComputeCounts() in decode.R, or sum_bits.py.  cohorts are 0-based.
+  """
+  m, k = params.num_cohorts, params.num_bloombits
+  counts = np.zeros((m, k + 1), dtype=np.int64)
+  counts[:, 0] = np.bincount(cohorts, minlength=m)
+
+  # The (cohort, bit) cell of each set bit.
+  cells = (cohorts[:, np.newaxis] * k + np.arange(k))[bits]
+  counts[:, 1:] = np.bincount(cells, minlength=m * k).reshape(m, k)
+  return counts
+
+
+def _CondProbs(params):
+  """Return q* and p*: P(report 1 | bit 1) and P(report 1 | bit 0)."""
+  qstar, pstar = decode._ReportProbs(params)
+  if not (0 < pstar < 1 and 0 < qstar < 1):
+    raise decode.Error('p* and q* should be strictly between 0 and 1')
+  return qstar, pstar
+
+
+def _CohortRows(cohorts, m):
+  """The indices of the reports in each cohort."""
+  order = np.argsort(cohorts, kind='mergesort')
+  bounds = np.cumsum(np.bincount(cohorts, minlength=m))[:-1]
+  return np.split(order, bounds)
+
+
+def OtherProbs(params, counts, X_found, proportions):
+  """Probability that each bit was set by a string that wasn't decoded.
+
+  Like GetOtherProbs() in association.R.
+
+  Args:
+    params: rappor.Params
+    counts: m x (k + 1) counts matrix
+    X_found: ColumnSparseMatrix (m * k) x J of the decoded strings
+    proportions: estimated proportions of the decoded strings
+
+  Returns:
+    m x k matrix
+  """
+  m, k = params.num_cohorts, params.num_bloombits
+  qstar, pstar = _CondProbs(params)
+  counts = np.asarray(counts, dtype=np.float64)
+
+  N = counts[:, 0].sum()
+  known_counts = np.ceil(np.asarray(proportions) * N / m)
+  sum_known = known_counts.sum()
+
+  # Counts set by known strings, adjusted by p for zero bits and q for true
+  # bits.
+  known_by_cohort = X_found.Dot(known_counts).reshape(m, k)
+  known_by_cohort = ((sum_known - known_by_cohort) * pstar +
+                     known_by_cohort * qstar)
+
+  reduced = counts - np.hstack((np.full((m, 1), sum_known), known_by_cohort))
+  reduced[reduced < 0] = 0
+  with np.errstate(divide='ignore', invalid='ignore'):
+    probs = reduced[:, 1:] / reduced[:, :1]
+  # As in R, x / 0 is clamped to 1, and 0 / 0 is 0.
+  probs[np.isnan(probs)] = 0
+  probs[probs > 1] = 1
+  return probs
+
+
+def _Normalize(log_lik):
+  """exp() of log likelihoods, scaled so the maximum of each row is 1.
+
+  EM normalizes each row, so the scale doesn't change the result, and it
+  avoids underflow with many bits.  Rows that are all 0 stay 0.
+  """
+  row_max = log_lik.max(axis=1)
+  row_max[~np.isfinite(row_max)] = 0
+  return np.exp(log_lik - row_max[:, np.newaxis])
+
+
+def StringCondProbs(params, cohorts, bits, X_found, prob_other=None):
+  """P(report | value) for each report and decoded string.
+
+  Like GetCondProbStringReports() in association.R.
+
+  Args:
+    params: rappor.Params
+    cohorts: N 0-based cohorts
+    bits: N x k boolean matrix from BitMatrix()
+    X_found: ColumnSparseMatrix (m * k) x J of the decoded strings
+    prob_other: If set, m x k matrix from OtherProbs(), and an 'Other' column
+      is added.
+
+  Returns:
+    N x J (or J + 1) matrix, with each row scaled by a constant.
+  """
+  m, k = params.num_cohorts, params.num_bloombits
+  qstar, pstar = _CondProbs(params)
+  J = X_found.num_cols
+
+  # The bits of each candidate in each cohort: m x k x J
+  bit_table = X_found.ToDense().reshape(m, k, J)
+  num_bits = bit_table.sum(axis=1)  # m x J
+
+  # A report's log likelihood is the sum over bits of log(p*) or log(1 - p*),
+  # except that the candidate's bits use q* instead of p*.
+  log_p1, log_p0 = np.log(pstar), np.log(1 - pstar)
+  log_q1, log_q0 = np.log(qstar), np.log(1 - qstar)
+
+  num_cols = J if prob_other is None else J + 1
+  log_lik = np.zeros((len(cohorts), num_cols))
+  for c, rows in enumerate(_CohortRows(cohorts, m)):
+    if not len(rows):
+      continue
+    B = bits[rows].astype(np.float64)
+    ones = B.sum(axis=1)
+    base = ones * log_p1 + (k - ones) * log_p0
+
+    ones_in_candidate = B.dot(bit_table[c])  # n_c x J
+    zeros_in_candidate = num_bits[c] - ones_in_candidate
+    log_lik[rows, :J] = (base[:, np.newaxis] +
+                         ones_in_candidate * (log_q1 - log_p1) +
+                         zeros_in_candidate * (log_q0 - log_p0))
+
+    if prob_other is not None:
+      with np.errstate(divide='ignore'):
+        log_other = np.where(B > 0, np.log(prob_other[c]),
+                             np.log(1 - prob_other[c]))
+      log_lik[rows, J] = log_other.sum(axis=1)
+
+  return _Normalize(log_lik)
+
+
+def BooleanCondProbs(params, bits):
+  """P(report | value) for each boolean report, for values (TRUE, FALSE).
+
+  Like GetCondProbBooleanReports() in association.R.
+
+  Args:
+    bits: N x 1 boolean matrix from BitMatrix()
+  """
+  qstar, pstar = _CondProbs(params)
+  set_bit = bits[:, 0]
+  return np.where(set_bit[:, np.newaxis], [qstar, pstar],
+                  [1 - qstar, 1 - pstar])
+
+
+def JointCondProbs(cond_probs):
+  """The joint conditional probabilities of several variables.
+
+  Like UpdateJointConditional() in association.R, the variables are
+  conditionally independent, so each row is an outer product.  The entries are
+  in R's column-major order: the first variable varies fastest, as in the
+  files that fast_em.R writes.
+
+  Args:
+    cond_probs: list of N x d_i matrices
+
+  Returns:
+    N x prod(d_i) matrix
+  """
+  joint = cond_probs[0]
+  N = joint.shape[0]
+  for cp in cond_probs[1:]:
+    joint = (cp[:, :, np.newaxis] * joint[:, np.newaxis, :]).reshape(N, -1)
+  return joint
+
+
+def SparseJointCondProbs(cond_probs, threshold=0.0):
+  """Like JointCondProbs(), but only the nonzero entries.
+
+  Each variable's matrix is thresholded with
+  fast_em.SparseCondProb.FromDense(), and the rows of the joint matrix are
+  built from the nonzeros only, so the memory is proportional to the number
+  of nonzeros of the result.
+
+  Returns:
+    (entry_size, indptr, indices, data), which are the arguments of
+    fast_em.SparseCondProb().
+  """
+  import fast_em  # in analysis/tensorflow
+
+  def SparseRows(dense):
+    sparse = fast_em.SparseCondProb.FromDense(dense, threshold)
+    # int64, so the joint indices don't overflow.
+    return sparse.indptr, sparse.indices.astype(np.int64), sparse.data
+
+  indptr, indices, data = SparseRows(cond_probs[0])
+  entry_size = cond_probs[0].shape[1]
+  for cp in cond_probs[1:]:
+    f_indptr, f_indices, f_data = SparseRows(cp)
+    row_nnz = np.diff(indptr)
+    f_row_nnz = np.diff(f_indptr)
+
+    # Each entry of a row is paired with each entry of the factor's row.
+    rows = np.repeat(np.arange(len(row_nnz)), row_nnz)
+    reps = f_row_nnz[rows]
+    left = np.repeat(np.arange(len(data)), reps)
+    starts = np.cumsum(reps) - reps
+    right = (np.repeat(f_indptr[rows], reps) +
+             np.arange(reps.sum()) - np.repeat(starts, reps))
+
+    # The previous variables vary fastest, as in JointCondProbs().
+    indices = f_indices[right] * entry_size + indices[left]
+    data = data[left] * f_data[right]
+    indptr = np.zeros(len(row_nnz) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(row_nnz * f_row_nnz)
+    entry_size *= cp.shape[1]
+  return entry_size, indptr, indices, data
+
+
+def DecodeStringVar(params, strings, X, cohorts, string_bits, num_draws=5,
+                    rand=np.random):
+  """Decode the marginal of a string variable, and compute its conditional
+  probabilities, with an 'Other' column.
+
+  Args:
+    params: rappor.Params
+    strings, X: the map of the string variable, from decode.ReadMapFile()
+    cohorts: N 0-based cohorts
+    string_bits: N x k boolean matrix
+    num_draws, rand: passed to decode.Decode()
+
+  Returns:
+    (N x S matrix, list of S strings)
+  """
+  counts = CohortCounts(params, cohorts, string_bits)
+  marginal = decode.Decode(params, strings, X, counts, num_draws=num_draws,
+                           rand=rand)
+  if not marginal.fit:
+    raise decode.Error('Nothing decoded for the string variable')
+
+  index = dict((s, j) for j, s in enumerate(strings))
+  X_found = X.SelectColumns([index[row[0]] for row in marginal.fit])
+  proportions = [row[3] for row in marginal.fit]
+
+  prob_other = OtherProbs(params, counts, X_found, proportions)
+  string_cp = StringCondProbs(params, cohorts, string_bits, X_found,
+                              prob_other=prob_other)
+  return string_cp, [row[0] for row in marginal.fit] + ['Other']
+
+
+def StringBooleanCondProbs(params, strings, X, cohorts, string_bits,
+                           bool_bits, num_draws=5, rand=np.random):
+  """Decode the string variable, and compute the conditional probabilities of
+  both variables.
+
+  Like ComputeDistributionEM() in association.R with ignore_other = FALSE,
+  as called by decode_assoc.R.
+
+  Args:
+    bool_bits: N x 1 boolean matrix
+    Others: as in DecodeStringVar()
+
+  Returns:
+    ([N x 2 boolean matrix, N x S string matrix], list of S strings).  Pass
+    the matrices to JointCondProbs() or SparseJointCondProbs().
+  """
+  string_cp, found = DecodeStringVar(params, strings, X, cohorts, string_bits,
+                                     num_draws=num_draws, rand=rand)
+  return [BooleanCondProbs(params, bool_bits), string_cp], found
+
+
+def ReadAssocResults(f):
+  """Read assoc-results.csv, as written by decode_assoc.R.
+
+  Returns:
+    (list of S strings, 2 x S matrix of proportions for (TRUE, FALSE))
+  """
+  reader = csv.reader(f)
+  try:
+    reader.next()  # header: bool var, string var, proportion
+  except StopIteration:
+    raise decode.Error('Results file is empty')
+
+  strings = []
+  proportions = {}
+  for row in reader:
+    try:
+      b, s, proportion = row[:3]  # there may be a prop_std_error column
+      i = ('TRUE', 'FALSE').index(b)
+      proportions[(i, s)] = float(proportion)
+    except ValueError:
+      raise decode.Error('Invalid results row %r' % row)
+    if s not in strings:
+      strings.append(s)
+
+  fit = np.zeros((2, len(strings)))
+  for j, s in enumerate(strings):
+    fit[:, j] = [proportions.get((i, s), 0.0) for i in (0, 1)]
+  return strings, fit
+
+
+# Weight of the uniform distribution in a warm start.  EM can't move an entry
+# away from zero, so strings that weren't found on the previous date need some
+# mass to start from.
+WARM_START_UNIFORM = 0.05
+
+
+def WarmStartPij(prior_strings, prior_fit, strings, uniform=WARM_START_UNIFORM):
+  """Starting point for EM from the estimate of the previous date.
+
+  Args:
+    prior_strings, prior_fit: from ReadAssocResults()
+    strings: the S strings decoded today, in the order of the conditional
+      probabilities
+    uniform: weight of the uniform distribution in the mix
+
+  Returns:
+    pij vector of length 2 * S, in the order of JointCondProbs(), or None if
+    none of the strings were found on the previous date.
+  """
+  index = dict((s, j) for j, s in enumerate(prior_strings))
+  start = np.zeros((2, len(strings)))
+  for j, s in enumerate(strings):
+    if s in index:
+      start[:, j] = prior_fit[:, index[s]]
+  total = start.sum()
+  if not total > 0:
+    return None
+
+  # The boolean varies fastest.
+  start = start.T.ravel() / total
+  return (1 - uniform) * start + uniform / len(start)
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""
+assoc_test.py: Tests for assoc.py
+"""
+
+import cStringIO
+import unittest
+
+import numpy as np
+
+import assoc  # module under test
+import decode
+import decode_test
+
+
+def _GetCondProb(report, pstar, qstar, bit_indices, prob_other=None):
+  """GetCondProb() from association.R, one report at a time."""
+  probs = np.where(report == 1, pstar, 1 - pstar)
+  result = []
+  for x in bit_indices:
+    rest = np.delete(probs, x)
+    candidate = np.where(report[x] == 1, qstar, 1 - qstar)
+    result.append(np.prod(rest) * np.prod(candidate))
+  if prob_other is not None:
+    result.append(np.prod(np.where(report == 1, prob_other, 1 - prob_other)))
+  return np.array(result)
+
+
+class AssocTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = np.random.RandomState(2)
+
+  def testReadReportsFile(self):
+    f = cStringIO.StringIO(
+        'cohort,domain,flag\n'
+        '3,0110,1\n'
+        '1,,0\n'
+        '0,1000,0\n')
+    self.assertRaises(decode.Error, assoc.ReadReportsFile, f,
+                      ['domain', 'flag'])
+
+    f.seek(0)
+    cohorts, (domain, flag), num_bad = assoc.ReadReportsFile(
+        f, ['domain', 'flag'], remove_bad_rows=True)
+    np.testing.assert_array_equal([3, 0], cohorts)
+    self.assertEqual(['0110', '1000'], domain)
+    self.assertEqual(['1', '0'], flag)
+    self.assertEqual(1, num_bad)
+
+  def testBitMatrixAndCounts(self):
+    params = decode_test._Params(k=4, m=2)
+    bits = assoc.BitMatrix(['0110', '1000', '0011'], 4)
+    # Char 0 is bit k - 1.
+    np.testing.assert_array_equal(
+        [[0, 1, 1, 0], [0, 0, 0, 1], [1, 1, 0, 0]], bits)
+    self.assertRaises(decode.Error, assoc.BitMatrix, ['011'], 4)
+
+    counts = assoc.CohortCounts(params, np.array([1, 0, 1]), bits)
+    np.testing.assert_array_equal([[1, 0, 0, 0, 1], [2, 1, 2, 1, 0]], counts)
+
+  def testStringCondProbs(self):
+    params = decode_test._Params(k=8, h=2, m=3, p=0.3, q=0.8, f=0.2)
+    m, k = params.num_cohorts, params.num_bloombits
+    qstar, pstar = decode._ReportProbs(params)
+
+    # Two hashes may set the same bit.
+    columns = [(np.arange(m)[:, None] * k +
+                self.rand.randint(0, k, size=(m, 2))).ravel()
+               for _ in xrange(5)]
+    X = decode.lasso.ColumnSparseMatrix.FromColumns(m * k, columns)
+
+    N = 40
+    cohorts = self.rand.randint(0, m, size=N)
+    bits = self.rand.uniform(size=(N, k)) < 0.4
+    prob_other = self.rand.uniform(size=(m, k))
+    prob_other[0, 0] = 0  # can give zero probability
+
+    cond_probs = assoc.StringCondProbs(params, cohorts, bits, X,
+                                       prob_other=prob_other)
+    self.assertEqual((N, 6), cond_probs.shape)
+    for i in xrange(N):
+      c = cohorts[i]
+      bit_indices = [X.Column(j)[X.Column(j) // k == c] % k
+                     for j in xrange(5)]
+      expected = _GetCondProb(bits[i].astype(int), pstar, qstar, bit_indices,
+                              prob_other[c])
+      # Equal up to the scale of the row.
+      np.testing.assert_allclose(expected / expected.sum(),
+                                 cond_probs[i] / cond_probs[i].sum())
+
+  def testOtherProbs(self):
+    params = decode_test._Params(k=4, h=1, m=2, p=0.25, q=0.75)
+    X = decode.lasso.ColumnSparseMatrix.FromColumns(8, [[0, 4]])
+    counts = np.array([[100, 80, 30, 20, 10],
+                       [0, 0, 0, 0, 0]])
+    probs = assoc.OtherProbs(params, counts, X, [0.5])
+    self.assertEqual((2, 4), probs.shape)
+    self.assertTrue(np.all((probs >= 0) & (probs <= 1)))
+    # The empty cohort has no "other" reports.
+    np.testing.assert_array_equal([0, 0, 0, 0], probs[1])
+
+  def testJointCondProbs(self):
+    a = self.rand.uniform(size=(3, 2))
+    b = self.rand.uniform(size=(3, 4))
+    joint = assoc.JointCondProbs([a, b])
+    self.assertEqual((3, 8), joint.shape)
+    # R's as.vector(outer(a, b)): the first variable varies fastest.
+    for i in xrange(3):
+      np.testing.assert_allclose(np.outer(a[i], b[i]).ravel(order='F'),
+                                 joint[i])
+
+  def testSparseJointCondProbs(self):
+    a = self.rand.uniform(size=(5, 2))
+    b = self.rand.uniform(size=(5, 4))
+    b[b < 0.5] = 0
+    b[2] = 0  # a row with no entries
+    entry_size, indptr, indices, data = assoc.SparseJointCondProbs([a, b])
+    self.assertEqual(8, entry_size)
+
+    joint = np.zeros((5, 8))
+    for i in xrange(5):
+      row = slice(indptr[i], indptr[i + 1])
+      joint[i, indices[row]] = data[row]
+    np.testing.assert_allclose(assoc.JointCondProbs([a, b]), joint)
+    self.assertEqual(np.count_nonzero(joint), len(data))
+
+    # Entries below the threshold of their variable's row are dropped.
+    _, _, _, thresholded = assoc.SparseJointCondProbs([a, b], threshold=0.99)
+    self.assertTrue(len(thresholded) < len(data))
+
+  def testWarmStartPij(self):
+    f = cStringIO.StringIO(
+        '"flag","domain","proportion"\n'
+        '"TRUE","a.com",0.4\n'
+        '"FALSE","a.com",0.2\n'
+        '"TRUE","Other",0.3\n'
+        '"FALSE","Other",0.1\n')
+    prior_strings, prior_fit = assoc.ReadAssocResults(f)
+    self.assertEqual(['a.com', 'Other'], prior_strings)
+    np.testing.assert_array_equal([[0.4, 0.3], [0.2, 0.1]], prior_fit)
+
+    pij = assoc.WarmStartPij(prior_strings, prior_fit,
+                             ['b.com', 'a.com', 'Other'], uniform=0.4)
+    self.assertAlmostEqual(1.0, pij.sum())
+    # New strings only get the uniform part.
+    np.testing.assert_allclose([0.4 / 6] * 2, pij[:2])
+    np.testing.assert_allclose(0.6 * 0.4 + 0.4 / 6, pij[2])
+    self.assertTrue(np.all(pij > 0))
+
+    self.assertEqual(
+        None, assoc.WarmStartPij(prior_strings, prior_fit, ['b.com']))
+
+
+if __name__ == '__main__':
+  unittest.main()
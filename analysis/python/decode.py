@@ -0,0 +1,792 @@
+#!/usr/bin/python
+"""
+decode.py: Decode RAPPOR distributions with NumPy.
+
+This follows Decode() in analysis/R/decode.R:
+
+  1. Estimate the true Bloom filter counts from the observed counts.
+  2. If the system is close to underdetermined, select candidates with the
+     non-negative Lasso (lasso.py).
+  3. Refit the selected candidates with constrained least squares, like
+     ConstrainedLinModel() in alternative.R: weighted by the inverse
+     standard errors, with non-negative coefficients that sum to at most 1,
+     and a fitted Bloom filter within 3 standard errors of the estimates.
+  4. Repeat 2 and 3 on resampled estimates to get standard errors.
+
+DecodeMany() decodes many dates of a metric with one design matrix.  The
+draws of a date share their weights, so they're solved together with one
+Gram matrix and cached factorizations.  Only draws that violate a constraint
+need the iterative solver.
+
+Boolean and basic RAPPOR metrics have closed-form estimates.
+DecodeBooleanMany() and DecodeBasicMany() compute them for a whole stack of
+counts matrices at once.
+"""
+
+import csv
+import json
+import math
+import os
+
+import numpy as np
+
+import lasso
+
+
+class Error(Exception):
+  pass
+
+
+def ReadCountsFile(f, params, adjust_counts=False):
+  """Read a counts file: an m x (k + 1) CSV matrix.
+
+  Like ReadCountsFile() in read_input.R.  If adjust_counts is set, a file with
+  a multiple of m rows is folded into m rows, like AdjustCounts().
+  """
+  rows = [[int(cell) for cell in row] for row in csv.reader(f) if row]
+  counts = np.array(rows, dtype=np.int64)
+  if counts.ndim != 2:
+    raise Error('Counts file is empty or ragged')
+
+  m = params.num_cohorts
+  if adjust_counts:
+    if counts.shape[0] % m != 0:
+      raise Error('Got %d rows in the counts file, not a multiple of m = %d' %
+                  (counts.shape[0], m))
+    counts = counts.reshape(-1, m, counts.shape[1]).sum(axis=0)
+
+  if counts.shape[0] != m:
+    raise Error('Got %d rows in the counts file, expected m = %d' %
+                (counts.shape[0], m))
+  if counts.shape[1] - 1 != params.num_bloombits:
+    raise Error('Counts file: number of columns should equal to k + 1: %d' %
+                counts.shape[1])
+  if np.any(counts < 0):
+    raise Error('Counts file: all counts must be positive.')
+  return counts
+
+
+def ReadMapFile(f, params):
+  """Read a map file, as written by hash_candidates.py.
+
+  Each row is a candidate string followed by m * h 1-based bit positions.
+  Like ReadMapFile() in read_input.R, duplicate strings are removed and the
+  empty string is renamed 'Empty'.
+
+  Returns:
+    (list of strings, ColumnSparseMatrix of size (m * k) x S)
+  """
+  num_rows = params.num_cohorts * params.num_bloombits
+  expected = params.num_cohorts * params.num_hashes
+
+  strings = []
+  columns = []
+  seen = set()
+  for row in csv.reader(f):
+    if not row:
+      continue
+    s = row[0] or 'Empty'
+    if s in seen:
+      continue
+    seen.add(s)
+    if len(row) - 1 != expected:
+      raise Error('Map file: number of columns should equal hm + 1: %d_%d' %
+                  (len(row) - 1, expected))
+    positions = [int(cell) - 1 for cell in row[1:] if cell != 'NA']
+    strings.append(s)
+    columns.append(positions)
+
+  return strings, lasso.ColumnSparseMatrix.FromColumns(num_rows, columns)
+
+
+def UnionMaps(maps):
+  """Combine several maps into one, like UnionMaps() in decode.R.
+
+  Args:
+    maps: list of (strings, ColumnSparseMatrix) from ReadMapFile()
+
+  Returns:
+    (strings, ColumnSparseMatrix, columns), where columns has the indices of
+    the columns of each map in the union.
+  """
+  strings = []
+  union_cols = []
+  index = {}
+  columns = []
+  for map_strings, X in maps:
+    cols = []
+    for j, s in enumerate(map_strings):
+      if s not in index:
+        index[s] = len(strings)
+        strings.append(s)
+        union_cols.append(X.Column(j))
+      cols.append(index[s])
+    columns.append(np.array(cols, dtype=np.int64))
+
+  num_rows = maps[0][1].num_rows
+  return (strings, lasso.ColumnSparseMatrix.FromColumns(num_rows, union_cols),
+          columns)
+
+
+def _ReportProbs(params):
+  """Return P(report 1 | true 1) and P(report 1 | true 0)."""
+  p, q, f = params.prob_p, params.prob_q, params.prob_f
+  p11 = q * (1 - f / 2) + p * f / 2
+  p01 = p * (1 - f / 2) + q * f / 2
+  return p11, p01
+
+
+def _EstimateBloomCounts(p11, p01, counts):
+  p2 = p11 - p01
+
+  counts = np.asarray(counts, dtype=np.float64)
+  N = counts[..., :1]
+  v = counts[..., 1:]
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    ests = (v - p01 * N) / p2 / N
+
+    p_hats = np.clip((v - p01 * N) / (N * p2), 0, 1)
+    r = p_hats * p11 + (1 - p_hats) * p01
+    stds = np.sqrt(N * r * (1 - r) / p2 ** 2) / N
+
+  # Some estimates may be infinite, e.g. if f = 1.  Set them to 0.
+  ests[np.isinf(ests)] = 0
+  return ests, stds
+
+
+def EstimateBloomCounts(params, counts):
+  """Estimate the proportion of each cohort that set each Bloom filter bit.
+
+  Like EstimateBloomCounts() in decode.R.  Works on a stack of counts
+  matrices too: counts may have shape (..., m, k + 1).
+
+  Returns:
+    (estimates, stds), each of shape (..., m, k)
+  """
+  p11, p01 = _ReportProbs(params)
+  return _EstimateBloomCounts(p11, p01, counts)
+
+
+def EstimateBloomCountsStack(params_list, counts):
+  """Like EstimateBloomCounts(), for a T x m x (k + 1) stack of counts
+  matrices with different p, q, and f.
+
+  Args:
+    params_list: list of T rappor.Params
+    counts: array of shape (T, m, k + 1)
+  """
+  probs = np.array([_ReportProbs(params) for params in params_list])
+  p11 = probs[:, 0].reshape(-1, 1, 1)
+  p01 = probs[:, 1].reshape(-1, 1, 1)
+  return _EstimateBloomCounts(p11, p01, counts)
+
+
+def _RefitWeights(stds):
+  """Row weights of the refit, like MakeLseiModel() in alternative.R.
+
+  Args:
+    stds: standard deviations of the Bloom filter estimates, in row-first
+        order.
+  """
+  with np.errstate(divide='ignore'):
+    w = 1.0 / stds
+  finite = w[~np.isinf(w)]
+  w_median = np.median(finite) if len(finite) else 1.0
+  w = np.minimum(w, w_median * 2)
+  return w / w.mean()
+
+
+def _UpperBounds(ests, stds):
+  """Bounds on the fitted Bloom filter, like MakeH() in alternative.R: don't
+  overshoot any bit by more than 3 standard deviations."""
+  return np.clip(ests + 3 * stds, 0.01, 1)
+
+
+def _ActiveSetQp(G, b, C, c, tol=1e-10, max_iter=None):
+  """Minimize 1/2 x^T G x - b^T x subject to x >= 0 and C x <= c.
+
+  A primal active set method (Nocedal and Wright, Algorithm 16.3).  Requires
+  c >= 0, so that x = 0 is feasible.  Like Lawson-Hanson, it starts there
+  with every bound active and frees coordinates one at a time.
+  """
+  n = len(b)
+  if max_iter is None:
+    max_iter = 3 * (n + len(c)) + 10
+  scale = max(1.0, np.abs(G).max())
+  x = np.zeros(n)
+  at_bound = np.ones(n, dtype=bool)
+  working = []  # rows of C that hold with equality
+
+  for _ in xrange(max_iter):
+    free = np.flatnonzero(~at_bound)
+    rows = np.array(working, dtype=np.int64)
+    g = G.dot(x) - b
+
+    # Minimize over the free coordinates, keeping the working rows tight.
+    A = C[np.ix_(rows, free)]
+    nf, nw = len(free), len(rows)
+    K = np.zeros((nf + nw, nf + nw))
+    K[:nf, :nf] = G[np.ix_(free, free)]
+    K[:nf, nf:] = A.T
+    K[nf:, :nf] = A
+    rhs = np.concatenate((-g[free], np.zeros(nw)))
+    sol = np.linalg.lstsq(K, rhs, rcond=None)[0]
+    p = np.zeros(n)
+    p[free] = sol[:nf]
+    lam = sol[nf:]
+
+    if np.abs(p).max() <= tol:
+      # x is optimal on the working set.  Stop if every multiplier is
+      # non-negative, or else release the most negative one.
+      mu = g + C[rows].T.dot(lam)
+      mu[~at_bound] = np.inf
+      j = np.argmin(mu)
+      i = np.argmin(lam) if nw else None
+      lam_min = lam[i] if nw else np.inf
+      if min(mu[j], lam_min) >= -tol * scale:
+        break
+      if mu[j] <= lam_min:
+        at_bound[j] = False
+      else:
+        del working[i]
+      continue
+
+    # Step toward x + p, stopping at the first constraint that blocks.
+    alpha, blocking_bound, blocking_row = 1.0, None, None
+    dec = free[p[free] < 0]
+    if len(dec):
+      ratios = x[dec] / -p[dec]
+      r = np.argmin(ratios)
+      if ratios[r] < alpha:
+        alpha, blocking_bound = ratios[r], dec[r]
+    Cp = C.dot(p)
+    Cp[rows] = 0
+    inc = np.flatnonzero(Cp > tol)
+    if len(inc):
+      ratios = np.maximum(c[inc] - C[inc].dot(x), 0) / Cp[inc]
+      r = np.argmin(ratios)
+      if ratios[r] < alpha:
+        alpha, blocking_bound, blocking_row = ratios[r], None, inc[r]
+
+    x += alpha * p
+    if blocking_bound is not None:
+      at_bound[blocking_bound] = True
+      x[blocking_bound] = 0
+    elif blocking_row is not None:
+      working.append(blocking_row)
+  return x
+
+
+class _GramCache(object):
+  """The weighted Gram matrix of a set of map columns, and factorizations of
+  its principal submatrices.  Shared by every right-hand side with the same
+  design matrix and weights, i.e. all draws of one date."""
+
+  def __init__(self, dense, weights):
+    self.dense = dense
+    self.w2 = weights ** 2
+    self.G = dense.T.dot(dense * self.w2[:, None])
+    self.pinvs = {}  # passive set -> pseudo-inverse of G[P, P]
+
+  def Rhs(self, Y):
+    """X^T W^2 y for each column y of Y."""
+    return self.dense.T.dot(Y * self.w2[:, None])
+
+  def Solve(self, P, b):
+    """Solve G[P, P] z = b, where b may have several columns."""
+    key = P.tobytes()
+    pinv = self.pinvs.get(key)
+    if pinv is None:
+      pinv = np.linalg.pinv(self.G[np.ix_(P, P)])
+      self.pinvs[key] = pinv
+    return pinv.dot(b)
+
+  def Feasible(self, z, support, upper, tol=1e-10):
+    """Whether z, the coefficients of the support, satisfy the constraints of
+    ConstrainedLinModel()."""
+    return (np.all(z >= 0) and z.sum() <= 1 + tol and
+            np.all(self.dense[:, support].dot(z) <= upper + tol))
+
+  def ConstrainedLs(self, b, support, upper, tol=1e-10, max_iter=None):
+    """Weighted least squares with the constraints of ConstrainedLinModel().
+
+    Minimizes |W (y - X x)|^2 given b = X^T W^2 y, using only the
+    coordinates in 'support', subject to x >= 0, sum(x) <= 1, and X x <=
+    upper.
+    """
+    dense = self.dense[:, support]
+    C = np.vstack((np.ones((1, len(support))), dense))
+    c = np.concatenate(([1.0], upper))
+    x = np.zeros(len(b))
+    x[support] = _ActiveSetQp(self.G[np.ix_(support, support)], b[support],
+                              C, c, tol=tol, max_iter=max_iter)
+    return x
+
+
+def _FitColumns(gram, B, supports, uppers):
+  """Refit every right-hand side on its support, like ConstrainedLinModel().
+
+  Right-hand sides with the same support are solved together with one
+  factorization.  Only those whose unconstrained solution violates a
+  constraint need the iterative solver.
+
+  Args:
+    gram: _GramCache
+    B: matrix with X^T W^2 y for each right-hand side in a column
+    supports: list of index arrays into the columns of gram.dense, one per
+        column of B
+    uppers: list of upper bounds on the fitted Bloom filter, one per column
+        of B
+
+  Returns:
+    Matrix of coefficients, one column per right-hand side.
+  """
+  coefs = np.zeros(B.shape)
+  by_support = {}
+  for c, support in enumerate(supports):
+    by_support.setdefault(support.tobytes(), (support, []))[1].append(c)
+
+  for support, cols in by_support.itervalues():
+    if len(support) == 0:
+      continue
+    Z = gram.Solve(support, B[np.ix_(support, cols)])
+    for i, c in enumerate(cols):
+      if gram.Feasible(Z[:, i], support, uppers[c]):
+        coefs[support, c] = Z[:, i]
+      else:
+        coefs[:, c] = gram.ConstrainedLs(B[:, c], support, uppers[c])
+  return coefs
+
+
+def _ComputeInference(params, Y, N, dense_reported):
+  """The variance decomposition computed by PerformInference() in decode.R.
+
+  Returns:
+    (explained_var, missing_var, noise_var) as proportions of the total sum of
+    squares.
+  """
+  p11, p01 = _ReportProbs(params)
+  resid_var = p01 * (1 - p01) * (N / float(params.num_cohorts)) / (
+      p11 - p01) ** 2
+
+  n = len(Y)
+  TSS = np.sum((Y - Y.mean()) ** 2)
+  ESS = resid_var * n
+
+  num_reported = dense_reported.shape[1]
+  if num_reported == 0:
+    RSS = 0.0
+  elif num_reported < n:
+    A = np.hstack((np.ones((n, 1)), dense_reported))
+    beta = np.linalg.lstsq(A, Y, rcond=None)[0]
+    RSS = np.sum((A.dot(beta) - Y.mean()) ** 2)
+  else:
+    RSS = float('nan')
+
+  return RSS / TSS, (TSS - ESS - RSS) / TSS, ESS / TSS
+
+
+class DecodeResult(object):
+  """The decoded distribution for one counts matrix."""
+
+  def __init__(self, fit, metrics):
+    # List of (string, estimate, std_error, proportion, prop_std_error,
+    # prop_low_95, prop_high_95) tuples, sorted by decreasing estimate.
+    self.fit = fit
+    self.metrics = metrics  # dict, written to metrics.json
+    self.by_map = {}  # map name -> DecodeResult, from DecodeMany(maps=...)
+
+
+RESULTS_HEADER = ('string', 'estimate', 'std_error', 'proportion',
+                  'prop_std_error', 'prop_low_95', 'prop_high_95')
+
+
+def _IntervalRow(string, estimate, std_error, N):
+  proportion = estimate / N
+  prop_std_error = std_error / N
+  return (string, estimate, std_error, proportion, prop_std_error,
+          max(proportion - 1.96 * prop_std_error, 0.0),
+          min(proportion + 1.96 * prop_std_error, 1.0))
+
+
+def _MakeResult(params, strings, coefs_all, N, Y, dense_cols):
+  """Summarize the fits of one counts matrix, like the end of Decode()."""
+  coefs_ave = N * coefs_all.mean(axis=0)
+  coefs_ssd = N * coefs_all.std(axis=0, ddof=1)
+
+  # Only select coefficients more than two standard deviations from 0.
+  reported = np.flatnonzero(coefs_ave > 1e-6 + 2 * coefs_ssd)
+
+  fit = []
+  for j in reported:
+    fit.append(_IntervalRow(strings[j], math.floor(coefs_ave[j]),
+                            math.floor(coefs_ssd[j]), N))
+  fit.sort(key=lambda row: row[1], reverse=True)
+
+  explained_var, missing_var, _ = _ComputeInference(
+      params, Y, N, dense_cols(reported))
+  metrics = {
+      'sample_size': N,
+      'allocated_mass': sum(row[3] for row in fit),
+      'num_detected': len(fit),
+      'explained_var': round(explained_var, 3),
+      'missing_var': round(missing_var, 3),
+  }
+  return DecodeResult(fit, metrics)
+
+
+class Prior(object):
+  """A previous decode of the same metric, to warm start from."""
+
+  def __init__(self, coefs, lam):
+    self.coefs = coefs  # proportion of each candidate, a vector of size S
+    self.lam = lam  # Lasso lambda of the previous fit, or None
+
+
+def ReadPrior(results_f, metrics_f, strings):
+  """Read a Prior from the results.csv and metrics.json of a previous decode.
+
+  Strings that are no longer candidates are ignored.
+
+  Args:
+    results_f, metrics_f: file objects.  metrics_f may be None.
+    strings: candidate strings of the new decode
+  """
+  index = dict((s, j) for j, s in enumerate(strings))
+  coefs = np.zeros(len(strings))
+  for i, row in enumerate(csv.reader(results_f)):
+    if i == 0:
+      if tuple(row) != RESULTS_HEADER:
+        raise Error('Expected results.csv header %s, got %s' %
+                    (RESULTS_HEADER, row))
+      continue
+    j = index.get(row[0])
+    if j is not None:
+      coefs[j] = float(row[3])
+
+  lam = None
+  if metrics_f is not None:
+    lam = json.load(metrics_f).get('lasso_lambda')
+  return Prior(coefs, lam)
+
+
+def _SelectFirst(X_filtered, y, prior):
+  """Select candidates for the unperturbed estimates with the Lasso.
+
+  With a prior, the Lasso is fit only at the prior's lambda, starting from its
+  coefficients and with its support as the initial active set.  If that
+  selects too many candidates, the data has changed too much, and the whole
+  path is computed as usual.
+
+  Returns:
+    (LassoFit, whether it was warm started)
+  """
+  if prior is not None and prior.lam is not None:
+    start = lasso.LassoFit(prior.coefs, 0.0, prior.lam,
+                           np.flatnonzero(prior.coefs > 0), 0)
+    fit = lasso.FitLassoAt(X_filtered, y, prior.lam, start=start)
+    if fit.NumNonZero() <= min(500, X_filtered.num_rows * .8):
+      return fit, True
+  return lasso.FitLasso(X_filtered, y), False
+
+
+def _SelectCandidates(X_filtered, draws, prior):
+  """Select the candidates to refit for each draw.
+
+  If the system is close to being underdetermined, they're selected with the
+  Lasso, warm starting the resamples.  Otherwise all candidates are refit.
+
+  Returns:
+    (list of column index arrays, one per draw, dict of Lasso metrics,
+    LassoFit of the first draw or None)
+  """
+  if X_filtered.num_cols <= X_filtered.num_rows * .8:
+    return [np.arange(X_filtered.num_cols)] * len(draws), {}, None
+
+  first, warm = _SelectFirst(X_filtered, draws[0], prior)
+  supports = [np.flatnonzero(first.coefs > 0)]
+  fit = first
+  for e in draws[1:]:
+    fit = lasso.FitLassoAt(X_filtered, e, fit.lam, start=fit)
+    supports.append(np.flatnonzero(fit.coefs > 0))
+  return supports, {'lasso_lambda': first.lam, 'warm_started': warm}, first
+
+
+def DecodeMany(params, strings, X, counts_list, num_draws=5, rand=np.random,
+               priors=None, maps=None):
+  """Decode several counts matrices that share params and a map.
+
+  Dates with the same set of non-empty cohorts share a design matrix, which
+  is extracted once for every candidate that any fit selects.  The refits of
+  all resamples of a date are solved together.
+
+  With several maps, X is their union, from UnionMaps().  Like DecodeMaps()
+  in decode.R, each map is also decoded on its own columns.  The maps share
+  the estimates, the resampled draws, and the weighted Gram matrix of each
+  date with the union.
+
+  Args:
+    params: rappor.Params
+    strings: candidate strings, one per column of X
+    X: ColumnSparseMatrix of size (m * k) x S, from ReadMapFile()
+    counts_list: list of m x (k + 1) counts matrices
+    num_draws: number of fits per matrix; all but the first are resampled
+    rand: numpy.random.RandomState or the numpy.random module
+    priors: optional list with a Prior or None for each counts matrix
+    maps: optional list of (name, columns of X) for each map of the union
+
+  Returns:
+    List of DecodeResult, one per counts matrix.  With maps, the by_map of
+    each result has a DecodeResult for each map name.
+  """
+  m = params.num_cohorts
+  k = params.num_bloombits
+  S = X.num_cols
+  if priors is None:
+    priors = [None] * len(counts_list)
+  if maps is None:
+    maps = []
+
+  # Estimate the Bloom filter bits of every counts matrix at once.
+  ests_all, stds_all = EstimateBloomCounts(params, np.array(counts_list))
+
+  designs = {}  # non-empty cohorts -> (cohorts, filtered design matrix)
+  # (design key, draws, their stds, supports, lasso metrics, map fits) for
+  # each matrix
+  dates = []
+  for i, counts in enumerate(counts_list):
+    cohorts = np.flatnonzero(counts[:, 0] != 0)
+    key = cohorts.tobytes()
+    if key not in designs:
+      rows = (cohorts[:, None] * k + np.arange(k)).ravel()
+      designs[key] = (cohorts, X if len(rows) == m * k else X.SelectRows(rows))
+    X_filtered = designs[key][1]
+    n = X_filtered.num_rows
+
+    ests, stds = ests_all[i][cohorts], stds_all[i][cohorts]
+    draws = [ests.ravel()]  # row-first order, like R
+    draw_stds = [stds.ravel()]
+    for _ in xrange(num_draws - 1):
+      e, s = lasso.Resample(ests, stds, rand)
+      draws.append(e.ravel())
+      draw_stds.append(s.ravel())
+
+    supports, lasso_metrics, first = _SelectCandidates(X_filtered, draws,
+                                                       priors[i])
+
+    # Like DecodeMaps() in decode.R, each map is decoded on its own columns,
+    # with the same estimates and draws.  Its Lasso starts from the union's
+    # lambda and support.
+    map_fits = []  # (supports, lasso metrics) for each map
+    for _, cols in maps:
+      prior = None if first is None else Prior(first.coefs[cols], first.lam)
+      map_supports, map_metrics, _ = _SelectCandidates(
+          X_filtered.SelectColumns(cols), draws, prior)
+      if map_metrics:
+        map_metrics['warm_started'] = lasso_metrics['warm_started']
+      map_fits.append(([cols[s] for s in map_supports], map_metrics))
+    dates.append((key, draws, draw_stds, supports, lasso_metrics, map_fits))
+
+  results = [None] * len(counts_list)
+  for key, (cohorts, X_filtered) in designs.iteritems():
+    indices = [i for i, date in enumerate(dates) if date[0] == key]
+
+    # Extract the candidates selected on any date, or for any map, once.
+    selected = []
+    for i in indices:
+      selected.extend(dates[i][3])
+      for map_supports, _ in dates[i][5]:
+        selected.extend(map_supports)
+    union = np.unique(np.concatenate(selected))
+    position = np.zeros(S, dtype=np.int64)
+    position[union] = np.arange(len(union))
+    dense = X_filtered.SelectColumns(union).ToDense()
+
+    def DenseColumns(cols):
+      return dense[:, position[cols]]
+
+    for i in indices:
+      _, draws, draw_stds, supports, lasso_metrics, map_fits = dates[i]
+
+      # The weights are the same for every draw, since the resampled stds
+      # are scaled uniformly.  Only the upper bounds differ.
+      gram = _GramCache(dense, _RefitWeights(draw_stds[0]))
+      Y = np.column_stack(draws)
+      uppers = [_UpperBounds(e, s) for e, s in zip(draws, draw_stds)]
+      B = gram.Rhs(Y)
+      coefs = np.zeros((S, num_draws))
+      coefs[union] = _FitColumns(gram, B, [position[s] for s in supports],
+                                 uppers)
+
+      N = float(counts_list[i][:, 0].sum())
+      coefs_all = coefs.T
+      y = draws[0]
+      results[i] = _MakeResult(params, strings, coefs_all, N, y,
+                               DenseColumns)
+      results[i].metrics.update(lasso_metrics)
+
+      for (name, cols), (map_supports, map_metrics) in zip(maps, map_fits):
+        coefs = np.zeros((S, num_draws))
+        coefs[union] = _FitColumns(gram, B,
+                                   [position[s] for s in map_supports], uppers)
+        result = _MakeResult(params, [strings[j] for j in cols],
+                             coefs[cols].T, N, y,
+                             lambda r, cols=cols: DenseColumns(cols[r]))
+        result.metrics.update(map_metrics)
+        results[i].by_map[name] = result
+
+  return results
+
+
+def DecodeBooleanMany(params_list, counts_list):
+  """Decode boolean (k = 1) counts, like .DecodeBoolean() in decode.R.
+
+  Boolean variables are reported without cohorts, so each counts matrix is
+  summed over cohorts, and all of them are estimated with one array
+  computation.
+
+  Args:
+    params_list: list of rappor.Params with num_bloombits = 1
+    counts_list: list of m x 2 counts matrices, where m may vary
+
+  Returns:
+    List of DecodeResult, one per counts matrix.
+  """
+  summed = np.array([np.sum(counts, axis=0) for counts in counts_list],
+                    dtype=np.float64).reshape(-1, 1, 2)
+  ests, stds = EstimateBloomCountsStack(params_list, summed)
+  ests = ests.ravel()
+  stds = stds.ravel()
+  N = summed[:, 0, 0]
+
+  results = []
+  for i in xrange(len(counts_list)):
+    std_error = stds[i] * N[i]
+    fit = [
+        _IntervalRow('TRUE', ests[i] * N[i], std_error, N[i]),
+        _IntervalRow('FALSE', N[i] - ests[i] * N[i], std_error, N[i]),
+    ]
+    metrics = {
+        'sample_size': N[i],
+        'allocated_mass': 1.0,
+        'num_detected': len(fit),
+    }
+    results.append(DecodeResult(fit, metrics))
+  return results
+
+
+def BasicRapporBits(params, X):
+  """If the map is a "basic RAPPOR" map, return the bit of each candidate.
+
+  A basic RAPPOR map has one cohort and one bit per candidate, e.g. the
+  diagonal maps that Decode() checks for.
+
+  Returns:
+    An array with the bit index of each column of X, or None.
+  """
+  if params.num_cohorts != 1:
+    return None
+  if not np.all(X.ColumnCounts() == 1):
+    return None
+  if len(np.unique(X.indices)) != X.num_cols:
+    return None
+  return X.indices.copy()
+
+
+def DecodeBasicMany(params_list, strings_list, bits_list, counts_list):
+  """Decode basic RAPPOR counts in closed form.
+
+  Each candidate has its own bit, so the least squares fit of Decode() is
+  just the estimated Bloom filter count of that bit.  As in Decode(),
+  candidates are reported if their estimate is more than two standard
+  deviations from 0.
+
+  Args:
+    params_list: list of rappor.Params, all with the same num_bloombits and
+      num_cohorts = 1
+    strings_list: list of candidate strings for each counts matrix
+    bits_list: list of BasicRapporBits() for each counts matrix
+    counts_list: list of 1 x (k + 1) counts matrices
+
+  Returns:
+    List of DecodeResult, one per counts matrix.
+  """
+  counts = np.array(counts_list, dtype=np.float64)
+  ests, stds = EstimateBloomCountsStack(params_list, counts)
+  N = counts[:, 0, :1]
+  ests = ests[:, 0, :] * N
+  stds = stds[:, 0, :] * N
+  reported = ests > 1e-6 + 2 * stds
+
+  results = []
+  for i, (strings, bits) in enumerate(zip(strings_list, bits_list)):
+    fit = [
+        _IntervalRow(s, math.floor(ests[i, b]), math.floor(stds[i, b]), N[i, 0])
+        for s, b in zip(strings, bits) if reported[i, b]]
+    fit.sort(key=lambda row: row[1], reverse=True)
+    metrics = {
+        'sample_size': N[i, 0],
+        'allocated_mass': sum(row[3] for row in fit),
+        'num_detected': len(fit),
+    }
+    results.append(DecodeResult(fit, metrics))
+  return results
+
+
+def Decode(params, strings, X, counts, num_draws=5, rand=np.random):
+  """Decode one counts matrix, with the closed form for boolean and basic
+  RAPPOR params, like Decode() in decode.R.
+
+  Returns:
+    DecodeResult
+  """
+  if params.num_bloombits == 1:
+    return DecodeBooleanMany([params], [counts])[0]
+  bits = BasicRapporBits(params, X)
+  if bits is not None:
+    return DecodeBasicMany([params], [strings], [bits], [counts])[0]
+  return DecodeMany(params, strings, X, [counts], num_draws=num_draws,
+                    rand=rand)[0]
+
+
+def ScaleSampledResult(result, num_reports, sample_rate):
+  """Scale the decode of a Bernoulli sample of reports up to all reports.
+
+  Proportions are estimated from the sample, so their standard errors and
+  intervals already reflect its size: they are wider than those of a decode
+  of all reports, by about 1 / sqrt(sample_rate).  The estimated counts are
+  scaled to num_reports, with standard errors scaled the same way.
+
+  Args:
+    result: DecodeResult of the sampled counts
+    num_reports: number of reports the sample was drawn from
+    sample_rate: probability that each report was sampled
+
+  Returns:
+    A new DecodeResult.
+  """
+  fit = []
+  for (string, _, _, proportion, prop_std_error, low_95, high_95) in (
+      result.fit):
+    fit.append((string, math.floor(proportion * num_reports),
+                math.floor(prop_std_error * num_reports), proportion,
+                prop_std_error, low_95, high_95))
+
+  metrics = dict(result.metrics)
+  metrics['num_sampled'] = metrics['sample_size']
+  metrics['sample_size'] = num_reports
+  metrics['sample_rate'] = sample_rate
+  return DecodeResult(fit, metrics)
+
+
+def WriteResult(result, output_dir):
+  """Write results.csv and metrics.json, like decode_dist.R."""
+  with open(os.path.join(output_dir, 'results.csv'), 'w') as f:
+    c = csv.writer(f)
+    c.writerow(RESULTS_HEADER)
+    for row in result.fit:
+      c.writerow(row)
+
+  with open(os.path.join(output_dir, 'metrics.json'), 'w') as f:
+    json.dump(result.metrics, f)
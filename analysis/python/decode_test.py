@@ -0,0 +1,282 @@
+#!/usr/bin/python
+"""
+decode_test.py: Tests for decode.py
+"""
+
+import cStringIO
+import unittest
+
+import numpy as np
+
+import decode  # module under test
+import rappor
+
+
+def _Params(k=16, h=2, m=8, p=0.25, q=0.75, f=0.0):
+  params = rappor.Params()
+  params.num_bloombits = k
+  params.num_hashes = h
+  params.num_cohorts = m
+  params.prob_p = p
+  params.prob_q = q
+  params.prob_f = f
+  return params
+
+
+def _SimulateCounts(params, X, proportions, num_reports, rand):
+  """Expected counts (rounded) for the given true distribution."""
+  p11, p01 = decode._ReportProbs(params)
+  m, k = params.num_cohorts, params.num_bloombits
+  bits = X.Dot(proportions).reshape(m, k)
+  N = np.full((m, 1), num_reports // m)
+  v = N * (bits * p11 + (1 - bits) * p01)
+  v += rand.normal(0, 1, size=v.shape) * np.sqrt(N / 1000.0)
+  return np.hstack((N, np.round(v))).astype(np.int64)
+
+
+class ReadTest(unittest.TestCase):
+
+  def testReadMapFile(self):
+    params = _Params(k=4, h=1, m=2)
+    f = cStringIO.StringIO('a,1,6\nb,2,8\na,3,5\n,4,5\n')
+    strings, X = decode.ReadMapFile(f, params)
+    self.assertEqual(['a', 'b', 'Empty'], strings)
+    np.testing.assert_array_equal([0, 5, 1, 7, 3, 4], X.indices)
+
+  def testUnionMaps(self):
+    params = _Params(k=4, h=1, m=2)
+    map1 = decode.ReadMapFile(cStringIO.StringIO('a,1,5\nb,2,6\n'), params)
+    map2 = decode.ReadMapFile(cStringIO.StringIO('b,2,6\nc,3,7\n'), params)
+    strings, X, columns = decode.UnionMaps([map1, map2])
+    self.assertEqual(['a', 'b', 'c'], strings)
+    np.testing.assert_array_equal([0, 1], columns[0])
+    np.testing.assert_array_equal([1, 2], columns[1])
+    np.testing.assert_array_equal(map2[1].ToDense(),
+                                  X.SelectColumns(columns[1]).ToDense())
+
+  def testReadCountsFile(self):
+    params = _Params(k=2, h=1, m=2)
+    f = cStringIO.StringIO('10,1,2\n20,3,4\n1,0,1\n2,1,0\n')
+    self.assertRaises(decode.Error, decode.ReadCountsFile, f, params)
+
+    f.seek(0)
+    counts = decode.ReadCountsFile(f, params, adjust_counts=True)
+    np.testing.assert_array_equal([[11, 1, 3], [22, 4, 4]], counts)
+
+
+class EstimateBloomCountsTest(unittest.TestCase):
+
+  def testEstimates(self):
+    params = _Params(k=2, h=1, m=2)
+    p11, p01 = decode._ReportProbs(params)
+    counts = np.array([[100, 100 * p11, 100 * p01],
+                       [0, 0, 0]])
+    ests, stds = decode.EstimateBloomCounts(params, counts)
+    np.testing.assert_allclose([1.0, 0.0], ests[0])
+    self.assertTrue(np.all(stds[0] > 0))
+    self.assertTrue(np.all(np.isnan(ests[1])))
+
+
+class ClosedFormTest(unittest.TestCase):
+
+  def testDecodeBooleanMany(self):
+    params_list = [_Params(k=1, m=2), _Params(k=1, m=1, p=0.1, q=0.9)]
+    counts_list = [np.array([[600, 350], [400, 250]]), np.array([[1000, 420]])]
+    results = decode.DecodeBooleanMany(params_list, counts_list)
+
+    for params, counts, result in zip(params_list, counts_list, results):
+      # Same as estimating the summed counts one at a time.
+      ests, stds = decode.EstimateBloomCounts(
+          params, np.sum(counts, axis=0).reshape(1, 2))
+      (string, estimate, std_error, proportion, _, _, _) = result.fit[0]
+      self.assertEqual('TRUE', string)
+      self.assertAlmostEqual(ests[0, 0], proportion)
+      self.assertAlmostEqual(ests[0, 0] * 1000, estimate)
+      self.assertAlmostEqual(stds[0, 0] * 1000, std_error)
+      self.assertEqual('FALSE', result.fit[1][0])
+      self.assertAlmostEqual(1 - ests[0, 0], result.fit[1][3])
+
+  def testDecodeBasicMany(self):
+    params = _Params(k=4, h=1, m=1)
+    _, X = decode.ReadMapFile(
+        cStringIO.StringIO('a,3\nb,1\nc,2\nd,4\n'), params)
+    bits = decode.BasicRapporBits(params, X)
+    np.testing.assert_array_equal([2, 0, 1, 3], bits)
+
+    p11, p01 = decode._ReportProbs(params)
+    N = 10000
+    truth = np.array([0.6, 0.0, 0.0, 0.4])  # by bit
+    counts = np.hstack(([N], N * (truth * p11 + (1 - truth) * p01)))
+    results = decode.DecodeBasicMany(
+        [params], [['a', 'b', 'c', 'd']], [bits], [counts.reshape(1, 5)])
+
+    fit = results[0].fit
+    self.assertEqual(['b', 'd'], [row[0] for row in fit])
+    self.assertAlmostEqual(0.6, fit[0][3], delta=1e-3)
+    self.assertAlmostEqual(0.4, fit[1][3], delta=1e-3)
+
+    # Not basic RAPPOR: two candidates share a bit.
+    _, X = decode.ReadMapFile(cStringIO.StringIO('a,1\nb,1\n'), params)
+    self.assertEqual(None, decode.BasicRapporBits(params, X))
+
+
+class SampledTest(unittest.TestCase):
+
+  def testScaleSampledResult(self):
+    fit = [('a', 300.0, 20.0, 0.3, 0.02, 0.2608, 0.3392)]
+    result = decode.DecodeResult(fit, {'sample_size': 1000.0})
+    scaled = decode.ScaleSampledResult(result, 10000, 0.1)
+
+    self.assertEqual([('a', 3000.0, 200.0, 0.3, 0.02, 0.2608, 0.3392)],
+                     scaled.fit)
+    self.assertEqual(10000, scaled.metrics['sample_size'])
+    self.assertEqual(1000.0, scaled.metrics['num_sampled'])
+    self.assertEqual(0.1, scaled.metrics['sample_rate'])
+
+  def testDecodeBoolean(self):
+    params = _Params(k=1, m=2)
+    result = decode.Decode(params, None, None, np.array([[10, 5], [10, 5]]))
+    self.assertEqual(['TRUE', 'FALSE'], [row[0] for row in result.fit])
+
+
+class DecodeManyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = np.random.RandomState(3)
+
+  def _Check(self, params, num_candidates, priors=None):
+    m, k, h = params.num_cohorts, params.num_bloombits, params.num_hashes
+    columns = []
+    for _ in xrange(num_candidates):
+      cohort_bits = self.rand.randint(0, k, size=(m, h))
+      columns.append((np.arange(m)[:, None] * k + cohort_bits).ravel())
+    X = decode.lasso.ColumnSparseMatrix.FromColumns(m * k, columns)
+    strings = ['s%d' % j for j in xrange(num_candidates)]
+
+    truth = np.zeros(num_candidates)
+    truth[:3] = [0.5, 0.3, 0.2]
+    counts_list = [_SimulateCounts(params, X, truth, 100000, self.rand)
+                   for _ in xrange(3)]
+    # One date has an empty cohort, so it has its own design matrix.
+    counts_list[2][1] = 0
+
+    results = decode.DecodeMany(params, strings, X, counts_list,
+                                rand=self.rand, priors=priors)
+    self.assertEqual(3, len(results))
+    for result in results:
+      found = dict((row[0], row[3]) for row in result.fit)
+      for j in xrange(3):
+        self.assertAlmostEqual(truth[j], found['s%d' % j], delta=0.05)
+      self.assertEqual(len(result.fit), result.metrics['num_detected'])
+      estimates = [row[1] for row in result.fit]
+      self.assertEqual(sorted(estimates, reverse=True), estimates)
+    return results
+
+  def testOverdetermined(self):
+    self._Check(_Params(k=32, h=2, m=16), 50)
+
+  def testUnderdetermined(self):
+    # More candidates than 0.8 * m * k, so the Lasso selects them.
+    self._Check(_Params(k=16, h=2, m=8), 200)
+
+  def testMaps(self):
+    params = _Params(k=32, h=2, m=16)
+    m, k, h = params.num_cohorts, params.num_bloombits, params.num_hashes
+    columns = [(np.arange(m)[:, None] * k +
+                self.rand.randint(0, k, size=(m, h))).ravel()
+               for _ in xrange(50)]
+    X = decode.lasso.ColumnSparseMatrix.FromColumns(m * k, columns)
+    strings = ['s%d' % j for j in xrange(50)]
+    truth = np.zeros(50)
+    truth[[0, 1, 40]] = [0.5, 0.3, 0.2]
+    counts_list = [_SimulateCounts(params, X, truth, 100000, self.rand)]
+    maps = [('first', np.arange(30)), ('second', np.arange(20, 50))]
+
+    result = decode.DecodeMany(params, strings, X, counts_list,
+                               rand=self.rand, maps=maps)[0]
+    self.assertEqual(['first', 'second'], sorted(result.by_map))
+    union = dict((row[0], row[3]) for row in result.fit)
+    self.assertEqual(['s0', 's1', 's40'], sorted(union))
+
+    # Each map is decoded on its own, like decoding it alone.  Without s40,
+    # the first map explains its bits with other strings, and s0 gets more
+    # mass than in the union.
+    for name, cols in maps:
+      alone = decode.DecodeMany(params, [strings[j] for j in cols],
+                                X.SelectColumns(cols), counts_list,
+                                rand=self.rand)[0]
+      expected = dict((row[0], row[3]) for row in alone.fit)
+      actual = dict((row[0], row[3]) for row in result.by_map[name].fit)
+      for s in ('s0', 's1', 's40'):
+        if s in expected:
+          self.assertAlmostEqual(expected[s], actual[s], delta=0.005)
+    first = dict((row[0], row[3]) for row in result.by_map['first'].fit)
+    self.assertGreater(first['s0'] - union['s0'], 0.005)
+
+  def testPriors(self):
+    params = _Params(k=16, h=2, m=8)
+    results = self._Check(params, 200)
+    coefs = np.zeros(200)
+    for row in results[0].fit:
+      coefs[int(row[0][1:])] = row[3]  # 's12' -> 12
+    prior = decode.Prior(coefs, results[0].metrics['lasso_lambda'])
+
+    # Only the dates with a prior are warm started.  They don't start from
+    # each other.
+    results = self._Check(params, 200, priors=[None, prior, None])
+    self.assertEqual([False, True, False],
+                     [r.metrics['warm_started'] for r in results])
+
+  def testReadPrior(self):
+    results_f = cStringIO.StringIO(
+        'string,estimate,std_error,proportion,prop_std_error,prop_low_95,'
+        'prop_high_95\n'
+        'b,500,10,0.5,0.01,0.48,0.52\n'
+        'gone,200,10,0.2,0.01,0.18,0.22\n')
+    metrics_f = cStringIO.StringIO('{"lasso_lambda": 0.001}')
+    prior = decode.ReadPrior(results_f, metrics_f, ['a', 'b', 'c'])
+    np.testing.assert_array_equal([0, 0.5, 0], prior.coefs)
+    self.assertEqual(0.001, prior.lam)
+
+    results_f.seek(0)
+    prior = decode.ReadPrior(results_f, None, ['a', 'b', 'c'])
+    self.assertEqual(None, prior.lam)
+
+  def testConstrainedLs(self):
+    dense = np.array([[1.0, 0, 0], [1, 1, 0], [0, 1, 1], [0, 0, 1]])
+    gram = decode._GramCache(dense, np.ones(4))
+    y = np.array([1.0, 1.0, 0.0, -1.0])
+    x = gram.ConstrainedLs(gram.Rhs(y[:, None])[:, 0], np.arange(3),
+                           np.ones(4))
+    # The unconstrained solution has a negative coefficient.
+    np.testing.assert_allclose([1.0, 0.0, 0.0], x, atol=1e-8)
+
+  def testRefitLikeConstrainedLinModel(self):
+    # One cohort with k = 6, and candidates a, b, c.  In R:
+    #
+    #   X <- Matrix(c(1, 1, 0, 0, 1, 0,
+    #                 0, 1, 1, 0, 0, 1,
+    #                 0, 0, 1, 1, 1, 0) == 1, ncol = 3, sparse = TRUE)
+    #   ConstrainedLinModel(X, list(
+    #       estimates = rbind(c(0.89, 0.93, 0.65, 0.38, 0.27, 0.93)),
+    #       stds = rbind(c(0, 0.059, 0.072, 0.074, 0.009, 0.027))))
+    #
+    # gives a = 0.297, b = 0.703, c = 0.  All kinds of constraints bind:
+    # c >= 0, a + b + c <= 1, and bit 5 (a + c) <= 0.27 + 3 * 0.009.  The
+    # zero std has its weight clipped.
+    dense = np.array([[1.0, 0, 0], [1, 1, 0], [0, 1, 1], [0, 0, 1],
+                      [1, 0, 1], [0, 1, 0]])
+    y = np.array([0.89, 0.93, 0.65, 0.38, 0.27, 0.93])
+    stds = np.array([0, 0.059, 0.072, 0.074, 0.009, 0.027])
+
+    gram = decode._GramCache(dense, decode._RefitWeights(stds))
+    x = decode._FitColumns(gram, gram.Rhs(y[:, None]), [np.arange(3)],
+                           [decode._UpperBounds(y, stds)])[:, 0]
+    np.testing.assert_allclose([0.297, 0.703, 0.0], x, atol=1e-8)
+
+    # Without the constraints, the fit overshoots.
+    z = gram.Solve(np.arange(3), gram.Rhs(y[:, None]))[:, 0]
+    self.assertGreater(z.sum(), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+"""
+lasso.py: Non-negative Lasso for RAPPOR decoding, in NumPy.
+
+This solves the same problem as FitLasso() in analysis/R/decode.R, which calls
+glmnet with lower.limits = 0:
+
+  minimize  1/(2n) |y - b0 - X b|^2 + lambda * sum(b)   subject to b >= 0
+
+X is the boolean map matrix: one row per (cohort, bit) pair and one column per
+candidate string.  Each column only has h set bits per cohort, so it's stored
+sparsely.
+
+The solver is coordinate descent over an active set.  Coordinates outside the
+active set are only touched by a vectorized KKT check, and a fit can be warm
+started from a previous one.  Decode() fits the same problem on slightly
+perturbed estimates several times, so the resamples start very close to their
+solutions.
+"""
+
+import numpy as np
+
+
+class ColumnSparseMatrix(object):
+  """A boolean matrix, stored as the row indices of the set cells of each
+  column (i.e. CSC format without values)."""
+
+  def __init__(self, num_rows, indptr, indices):
+    """
+    Args:
+      num_rows: number of rows
+      indptr: the rows of column j are indices[indptr[j]:indptr[j+1]]
+      indices: 0-based row indices
+    """
+    self.num_rows = num_rows
+    self.indptr = np.asarray(indptr, dtype=np.int64)
+    self.indices = np.asarray(indices, dtype=np.int64)
+    self.num_cols = len(self.indptr) - 1
+
+    # The column of each stored cell, for vectorized products.
+    self.entry_cols = np.repeat(np.arange(self.num_cols), np.diff(self.indptr))
+
+  @staticmethod
+  def FromColumns(num_rows, columns):
+    """Create a matrix from a list of row index sequences, one per column.
+
+    Duplicate row indices (e.g. two hash functions setting the same bit) are
+    merged.
+    """
+    cols = [np.unique(np.asarray(c, dtype=np.int64)) for c in columns]
+    indptr = np.zeros(len(cols) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(c) for c in cols])
+    if cols:
+      indices = np.concatenate(cols)
+    else:
+      indices = np.zeros(0, dtype=np.int64)
+    return ColumnSparseMatrix(num_rows, indptr, indices)
+
+  def ColumnCounts(self):
+    """Number of set cells in each column."""
+    return np.diff(self.indptr)
+
+  def Column(self, j):
+    return self.indices[self.indptr[j]:self.indptr[j + 1]]
+
+  def Dot(self, v):
+    """Return X v."""
+    return np.bincount(self.indices, weights=v[self.entry_cols],
+                       minlength=self.num_rows)
+
+  def TDot(self, r):
+    """Return X^T r."""
+    return np.bincount(self.entry_cols, weights=r[self.indices],
+                       minlength=self.num_cols)
+
+  def SelectColumns(self, cols):
+    return ColumnSparseMatrix.FromColumns(
+        self.num_rows, [self.Column(j) for j in cols])
+
+  def SelectRows(self, rows):
+    """Return the submatrix with the given rows, in the given order."""
+    new_index = -np.ones(self.num_rows, dtype=np.int64)
+    new_index[np.asarray(rows, dtype=np.int64)] = np.arange(len(rows))
+
+    mapped = new_index[self.indices]
+    keep = mapped >= 0
+    indptr = np.zeros(self.num_cols + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(
+        np.bincount(self.entry_cols[keep], minlength=self.num_cols))
+    # Cells stay grouped by column, but may need sorting within a column.
+    order = np.lexsort((mapped[keep], self.entry_cols[keep]))
+    return ColumnSparseMatrix(len(rows), indptr, mapped[keep][order])
+
+  def ToDense(self):
+    dense = np.zeros((self.num_rows, self.num_cols))
+    dense[self.indices, self.entry_cols] = 1.0
+    return dense
+
+
+class LassoFit(object):
+  """The solution at one value of lambda."""
+
+  def __init__(self, coefs, intercept, lam, active, num_passes):
+    self.coefs = coefs
+    self.intercept = intercept
+    self.lam = lam
+    self.active = active  # coordinates that were iterated over
+    self.num_passes = num_passes  # number of coordinate descent sweeps
+
+  def NumNonZero(self):
+    return int(np.count_nonzero(self.coefs))
+
+
+class _Problem(object):
+  """Quantities that depend only on X and y, shared by all lambdas."""
+
+  def __init__(self, X, y, intercept):
+    n = X.num_rows
+    self.X = X
+    self.n = n
+    self.counts = X.ColumnCounts().astype(np.float64)
+
+    if intercept:
+      self.y_mean = np.mean(y)
+      self.col_means = self.counts / n
+    else:
+      self.y_mean = 0.0
+      self.col_means = np.zeros(X.num_cols)
+    self.y_centered = y - self.y_mean
+
+    # Squared norms of the centered columns.  Columns with no variance (e.g.
+    # no bits set) can't be fit, and stay at 0.
+    self.sq_norms = self.counts - n * self.col_means ** 2
+    self.fittable = self.sq_norms > 1e-12
+
+    self.null_dev = np.dot(self.y_centered, self.y_centered)
+
+
+class _State(object):
+  """Coefficients and residual during coordinate descent.
+
+  Centering X would make it dense, so the residual of the centered problem is
+  kept as a sparse part r plus a scalar offset:
+
+    y_centered - (X - 1 col_means^T) b  ==  r + offset
+  """
+
+  def __init__(self, problem, coefs):
+    self.coefs = coefs.copy()
+    self.r = problem.y_centered - problem.X.Dot(self.coefs)
+    self.offset = np.dot(problem.col_means, self.coefs)
+
+  def Gradients(self, problem):
+    """Inner products of every centered column with the residual.
+
+    The centered residual always sums to 0, so the centering term of the
+    column drops out.
+    """
+    return problem.X.TDot(self.r) + problem.counts * self.offset
+
+
+def _Sweep(problem, state, coords, n_lambda):
+  """Do one pass of coordinate descent.
+
+  Returns:
+    The largest decrease in the objective (scaled by 2n) of any coordinate.
+  """
+  X = problem.X
+  coefs = state.coefs
+  max_change = 0.0
+  for j in coords:
+    if not problem.fittable[j]:
+      continue
+    rows = X.indices[X.indptr[j]:X.indptr[j + 1]]
+    sq_norm = problem.sq_norms[j]
+    g = state.r[rows].sum() + problem.counts[j] * state.offset
+
+    old = coefs[j]
+    new = max(0.0, g + sq_norm * old - n_lambda) / sq_norm
+    delta = new - old
+    if delta != 0.0:
+      coefs[j] = new
+      state.r[rows] -= delta
+      state.offset += delta * problem.col_means[j]
+      max_change = max(max_change, sq_norm * delta * delta)
+  return max_change
+
+
+def _Solve(problem, state, lam, active, tol, max_passes):
+  """Solve at one lambda, starting from the given state and active set.
+
+  Returns:
+    (sorted active set, number of sweeps)
+  """
+  n_lambda = problem.n * lam
+  threshold = tol * problem.null_dev
+  active = np.asarray(active, dtype=np.int64)
+  num_passes = 0
+
+  while True:
+    while num_passes < max_passes:
+      change = _Sweep(problem, state, active, n_lambda)
+      num_passes += 1
+      if change <= threshold:
+        break
+
+    # KKT check on the coordinates outside the active set: a coordinate at 0
+    # must not have a gradient larger than n * lambda.
+    g = state.Gradients(problem)
+    violators = np.flatnonzero(
+        (state.coefs == 0) & (g > n_lambda * (1 + 1e-9)) & problem.fittable)
+    violators = np.setdiff1d(violators, active)
+    if len(violators) == 0 or num_passes >= max_passes:
+      break
+    active = np.union1d(active, violators)
+
+  return active, num_passes
+
+
+def _MakeFit(problem, state, lam, active, num_passes):
+  intercept = problem.y_mean - np.dot(problem.col_means, state.coefs)
+  return LassoFit(state.coefs.copy(), intercept, lam, active, num_passes)
+
+
+def LambdaMax(X, y, intercept=True):
+  """The smallest lambda for which all coefficients are 0."""
+  problem = _Problem(X, y, intercept)
+  state = _State(problem, np.zeros(X.num_cols))
+  g = state.Gradients(problem)
+  g[~problem.fittable] = 0.0
+  return max(0.0, g.max() if len(g) else 0.0) / problem.n
+
+
+def FitLassoAt(X, y, lam, start=None, intercept=True, tol=1e-7,
+               max_passes=100000):
+  """Fit the non-negative Lasso at a single lambda.
+
+  Args:
+    X: ColumnSparseMatrix of size n x S
+    y: vector of size n
+    lam: regularization parameter
+    start: optional LassoFit to warm start from.  Its coefficients are the
+      starting point, and its active set is the initial active set.
+
+  Returns:
+    LassoFit
+  """
+  problem = _Problem(X, y, intercept)
+  if start is None:
+    coefs = np.zeros(X.num_cols)
+    active = np.zeros(0, dtype=np.int64)
+  else:
+    coefs = start.coefs
+    active = start.active
+  state = _State(problem, coefs)
+  active, num_passes = _Solve(problem, state, lam, active, tol, max_passes)
+  return _MakeFit(problem, state, lam, active, num_passes)
+
+
+def FitLasso(X, y, intercept=True, num_lambdas=100, lambda_min_ratio=None,
+             max_nonzero=None, tol=1e-7, max_passes=100000):
+  """Fit the non-negative Lasso along a decreasing path of lambdas, like
+  glmnet.
+
+  Each lambda is warm started from the previous one.  As with glmnet's pmax,
+  the path stops before the number of non-zero coefficients exceeds
+  max_nonzero.
+
+  Args:
+    X: ColumnSparseMatrix of size n x S
+    y: vector of size n
+    max_nonzero: defaults to min(500, 0.8 * n), as in FitLasso() in decode.R
+
+  Returns:
+    LassoFit for the last lambda on the path.
+  """
+  n = X.num_rows
+  if max_nonzero is None:
+    max_nonzero = min(500, n * .8)
+  if lambda_min_ratio is None:
+    lambda_min_ratio = 0.01 if n < X.num_cols else 1e-4
+
+  problem = _Problem(X, y, intercept)
+  state = _State(problem, np.zeros(X.num_cols))
+
+  lambda_max = LambdaMax(X, y, intercept)
+  if lambda_max == 0.0:
+    return _MakeFit(problem, state, 0.0, np.zeros(0, dtype=np.int64), 0)
+
+  exponents = np.arange(num_lambdas) / float(max(1, num_lambdas - 1))
+  lambdas = lambda_max * lambda_min_ratio ** exponents
+
+  fit = None
+  active = np.zeros(0, dtype=np.int64)
+  total_passes = 0
+  for lam in lambdas:
+    active, num_passes = _Solve(problem, state, lam, active, tol,
+                                max_passes - total_passes)
+    total_passes += num_passes
+    if np.count_nonzero(state.coefs) > max_nonzero and fit is not None:
+      break
+    fit = _MakeFit(problem, state, lam, active, total_passes)
+    if total_passes >= max_passes:
+      break
+  return fit
+
+
+def Resample(estimates, stds, rand):
+  """Like Resample() in decode.R: add Gaussian noise to the estimates.
+
+  Returns:
+    (estimates, stds) of the resampled Bloom filter estimates.
+  """
+  noise = rand.normal(0.0, 1.0, size=estimates.shape) * stds
+  return estimates + noise, stds * 2 ** .5
+
+
+def FitResampledLasso(X, estimates, stds, num_resamples, rand=np.random,
+                      max_nonzero=None):
+  """Fit the estimates, and then num_resamples resampled versions of them.
+
+  This is the Lasso part of the loop in Decode().  The first fit computes the
+  whole path; each resample is fit at the same lambda, warm started from the
+  previous fit.
+
+  Args:
+    X: ColumnSparseMatrix with m * k rows, in the row order of the map
+    estimates, stds: m x k arrays, as returned by EstimateBloomCounts
+    num_resamples: number of resampled fits after the first one
+    rand: numpy.random.RandomState or the numpy.random module
+
+  Returns:
+    A list of 1 + num_resamples LassoFit instances.
+  """
+  # Row-first order, like as.vector(t(estimates)) in R.
+  fit = FitLasso(X, estimates.ravel(), max_nonzero=max_nonzero)
+  fits = [fit]
+  for _ in xrange(num_resamples):
+    resampled, _ = Resample(estimates, stds, rand)
+    fit = FitLassoAt(X, resampled.ravel(), fit.lam, start=fit)
+    fits.append(fit)
+  return fits
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+"""
+lasso_test.py: Tests for lasso.py
+"""
+
+import unittest
+
+import numpy as np
+
+import lasso  # module under test
+
+
+def _RandomMap(rand, num_rows, num_cols, bits_per_col):
+  columns = [rand.choice(num_rows, bits_per_col, replace=False)
+             for _ in xrange(num_cols)]
+  return lasso.ColumnSparseMatrix.FromColumns(num_rows, columns)
+
+
+def _CheckKkt(test, X, y, fit, tol=1e-5):
+  """Check the optimality conditions of the non-negative Lasso."""
+  dense = X.ToDense()
+  centered = dense - dense.mean(axis=0)
+  r = y - fit.intercept - dense.dot(fit.coefs)
+  g = centered.T.dot(r) / X.num_rows
+
+  test.assertTrue(np.all(fit.coefs >= 0))
+  nonzero = fit.coefs > 0
+  # Active coordinates have gradient lambda; the others at most lambda.
+  np.testing.assert_allclose(g[nonzero], fit.lam, atol=tol)
+  test.assertTrue(np.all(g[~nonzero] <= fit.lam + tol))
+
+
+class ColumnSparseMatrixTest(unittest.TestCase):
+
+  def testProducts(self):
+    X = lasso.ColumnSparseMatrix.FromColumns(4, [[0, 2], [], [1, 1, 3]])
+    dense = np.array([[1, 0, 0],
+                      [0, 0, 1],
+                      [1, 0, 0],
+                      [0, 0, 1]], dtype=np.float64)
+    np.testing.assert_array_equal(dense, X.ToDense())
+    np.testing.assert_array_equal([2, 0, 2], X.ColumnCounts())
+
+    v = np.array([1.0, 2.0, 3.0])
+    np.testing.assert_allclose(dense.dot(v), X.Dot(v))
+    r = np.array([1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_allclose(dense.T.dot(r), X.TDot(r))
+
+  def testSelect(self):
+    X = lasso.ColumnSparseMatrix.FromColumns(4, [[0, 2], [], [1, 3]])
+    dense = X.ToDense()
+    np.testing.assert_array_equal(dense[:, [2, 0]],
+                                  X.SelectColumns([2, 0]).ToDense())
+    np.testing.assert_array_equal(dense[[3, 0, 1], :],
+                                  X.SelectRows([3, 0, 1]).ToDense())
+
+
+class LassoTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = np.random.RandomState(1)
+
+  def testRecoversExactSolution(self):
+    # No noise, more rows than columns: a tiny lambda gives back the truth.
+    X = _RandomMap(self.rand, 64, 10, 4)
+    truth = np.zeros(10)
+    truth[[1, 4, 7]] = [0.5, 0.3, 0.1]
+    y = X.Dot(truth)
+
+    fit = lasso.FitLassoAt(X, y, 1e-8, intercept=False, tol=1e-14)
+    np.testing.assert_allclose(truth, fit.coefs, atol=1e-5)
+
+  def testKkt(self):
+    X = _RandomMap(self.rand, 100, 200, 5)
+    truth = np.zeros(200)
+    truth[:8] = self.rand.uniform(0.01, 0.2, size=8)
+    y = X.Dot(truth) + self.rand.normal(0, 0.01, size=100)
+
+    lam = 0.1 * lasso.LambdaMax(X, y)
+    fit = lasso.FitLassoAt(X, y, lam, tol=1e-12)
+    _CheckKkt(self, X, y, fit)
+
+    # Above lambda max, everything is 0.
+    fit = lasso.FitLassoAt(X, y, 1.01 * lasso.LambdaMax(X, y))
+    self.assertEqual(0, fit.NumNonZero())
+
+  def testPath(self):
+    X = _RandomMap(self.rand, 100, 200, 5)
+    y = X.Dot(self.rand.uniform(0, 0.02, size=200))
+
+    fit = lasso.FitLasso(X, y, tol=1e-12)
+    _CheckKkt(self, X, y, fit)
+    self.assertTrue(fit.NumNonZero() <= 80)
+
+    fit = lasso.FitLasso(X, y, max_nonzero=5)
+    self.assertTrue(0 < fit.NumNonZero() <= 5)
+
+  def testWarmStart(self):
+    X = _RandomMap(self.rand, 128, 300, 4)
+    truth = np.zeros(300)
+    truth[:10] = self.rand.uniform(0.02, 0.1, size=10)
+    y = X.Dot(truth)
+    y2 = y + self.rand.normal(0, 0.001, size=128)
+
+    first = lasso.FitLasso(X, y, tol=1e-10)
+    cold = lasso.FitLassoAt(X, y2, first.lam, tol=1e-10)
+    warm = lasso.FitLassoAt(X, y2, first.lam, start=first, tol=1e-10)
+
+    np.testing.assert_allclose(cold.coefs, warm.coefs, atol=1e-4)
+    self.assertTrue(warm.num_passes <= cold.num_passes)
+
+  def testFitResampledLasso(self):
+    X = _RandomMap(self.rand, 64, 50, 4)
+    truth = np.zeros(50)
+    truth[:5] = 0.1
+    estimates = X.Dot(truth).reshape(8, 8)
+    stds = np.ones((8, 8)) * 0.01
+
+    fits = lasso.FitResampledLasso(X, estimates, stds, 4, rand=self.rand)
+    self.assertEqual(5, len(fits))
+    for fit in fits:
+      self.assertEqual(fits[0].lam, fit.lam)
+      self.assertTrue(np.all(fit.coefs >= 0))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,404 @@
+#!/usr/bin/python
+"""
+ngrams.py: Discover the dictionary of a string variable from n-gram reports.
+
+This follows EstimateDictionary() in analysis/R/decode_ngrams.R, and
+analysis/cpp/find_cliques.cc:
+
+  1. Each client reports the n-grams of its string at 2 of the k positions.
+     For each pair of positions, the joint distribution of the two n-grams is
+     decoded, and the pairs with a proportion above a threshold are the edges
+     of a k-partite graph, with one partition per position.
+  2. A string of k n-grams is a candidate if its n-grams form a k-clique.
+
+Unlike the R code and find_cliques.cc:
+
+  - EM on a pair of n-grams (PairEm) never builds the joint matrix of a
+    report.  Each iteration is a few matrix products with the S1 x S2
+    estimate, so the candidates of both positions can be large.
+  - The graph is stored as arrays: for each pair of partitions, the
+    neighbors of each node as a CSR matrix of node indices (KPartiteGraph).
+  - The clique search is a depth-first search that picks one node per
+    partition, and keeps, for every other partition, the nodes adjacent to all
+    the picked ones.  A branch stops as soon as one of them is empty, so
+    incomplete paths are never enumerated, and memory is bounded by k times
+    the number of nodes.  The branches of the first partition are searched in
+    parallel processes.
+
+Usage:
+  ngrams.py find-cliques [--num-processes N] < graph.txt
+
+reads a graph in the format of WriteKPartiteGraph() in decode_ngrams.R, like
+find_cliques.cc, and prints the strings of its k-cliques.
+"""
+
+import multiprocessing
+import optparse
+import sys
+
+import numpy as np
+
+import assoc
+import decode
+
+
+# Threshold on the pairwise proportions, as in FindPairwiseCandidates().
+PAIR_THRESHOLD = 0.04
+
+
+def log(msg, *args):
+  if args:
+    msg = msg % args
+  print >>sys.stderr, msg
+
+
+def PairEm(cp1, cp2, max_em_iters=1000, epsilon=1e-6):
+  """EM for the joint distribution of two variables.
+
+  Like fast_em.FactorCondProb with 2 factors: the likelihood of report m is
+  cp1[m] . P . cp2[m], so an iteration is
+
+    P <- P * (cp1^T . (cp2 / likelihoods)) / N
+
+  Args:
+    cp1, cp2: N x S1 and N x S2 conditional probabilities
+
+  Returns:
+    (number of EM iterations, S1 x S2 matrix of proportions)
+  """
+  N, S1 = cp1.shape
+  S2 = cp2.shape[1]
+  P = np.ones((S1, S2)) / (S1 * S2)
+  num_em_iters = 0
+  while num_em_iters < max_em_iters:
+    likelihoods = np.einsum('ij,ij->i', cp1.dot(P), cp2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      weighted = cp2 / likelihoods[:, np.newaxis]
+    weighted[likelihoods == 0] = 0  # reports impossible under P
+    new_P = P * cp1.T.dot(weighted) / N
+    num_em_iters += 1
+    dif = np.max(np.abs(new_P - P))
+    P = new_P
+    if dif < epsilon:
+      break
+  return num_em_iters, P
+
+
+def FindPairwiseCandidates(params, ngrams, X, pair_reports,
+                           threshold=PAIR_THRESHOLD, max_em_iters=1000,
+                           num_draws=5, rand=np.random):
+  """Decode the joint distribution of each pair of positions.
+
+  Like FindPairwiseCandidates() in decode_ngrams.R.  The n-grams of each
+  position are decoded as in decode_assoc.R, with an 'Other' column, and the
+  pairs of found n-grams whose proportion is above threshold are returned.
+
+  Args:
+    params: rappor.Params
+    ngrams, X: the map of all candidate n-grams, from decode.ReadMapFile()
+    pair_reports: dict of 0-based positions (i, j) -> (N 0-based cohorts,
+      N x k bits of the n-gram at i, N x k bits of the n-gram at j)
+    threshold: minimum proportion of an edge
+
+  Returns:
+    dict of (i, j) -> list of (n-gram at i, n-gram at j)
+  """
+  edges = {}
+  for (i, j), (cohorts, bits1, bits2) in sorted(pair_reports.iteritems()):
+    try:
+      cp1, found1 = assoc.DecodeStringVar(params, ngrams, X, cohorts, bits1,
+                                          num_draws=num_draws, rand=rand)
+      cp2, found2 = assoc.DecodeStringVar(params, ngrams, X, cohorts, bits2,
+                                          num_draws=num_draws, rand=rand)
+    except decode.Error as e:
+      log('Positions (%d, %d): %s', i, j, e)
+      edges[(i, j)] = []
+      continue
+
+    num_em_iters, fit = PairEm(cp1, cp2, max_em_iters=max_em_iters)
+    # The last row and column are 'Other'.
+    rows, cols = np.nonzero(fit[:-1, :-1] > threshold)
+    edges[(i, j)] = [(found1[a], found2[b]) for a, b in zip(rows, cols)]
+    log('Positions (%d, %d): %d x %d n-grams, %d EM iterations, %d edges',
+        i, j, len(found1) - 1, len(found2) - 1, num_em_iters,
+        len(edges[(i, j)]))
+  return edges
+
+
+class KPartiteGraph(object):
+  """A k-partite graph of n-grams, one partition per position.
+
+  The nodes of partition i are the sorted n-grams self.nodes[i].  For each
+  ordered pair of partitions (i, j), the neighbors in j of each node of i are
+  a CSR matrix: self.adjacency[(i, j)] is (indptr, indices), with the indices
+  of each row sorted.
+  """
+
+  def __init__(self, num_partitions, ngram_size, nodes, adjacency):
+    self.num_partitions = num_partitions
+    self.ngram_size = ngram_size
+    self.nodes = nodes
+    self.adjacency = adjacency
+
+  @staticmethod
+  def FromEdges(num_partitions, ngram_size, edges):
+    """
+    Args:
+      edges: dict of (i, j) -> list of (n-gram at i, n-gram at j), with i < j,
+        e.g. from FindPairwiseCandidates()
+    """
+    labels = [set() for _ in xrange(num_partitions)]
+    for (i, j), pairs in edges.iteritems():
+      if not 0 <= i < j < num_partitions:
+        raise RuntimeError('Invalid partitions (%d, %d)' % (i, j))
+      for a, b in pairs:
+        labels[i].add(a)
+        labels[j].add(b)
+    nodes = [sorted(s) for s in labels]
+    index = [dict((s, n) for n, s in enumerate(p)) for p in nodes]
+
+    adjacency = {}
+    for i in xrange(num_partitions):
+      for j in xrange(i + 1, num_partitions):
+        pairs = edges.get((i, j), [])
+        left = np.array([index[i][a] for a, _ in pairs], dtype=np.int32)
+        right = np.array([index[j][b] for _, b in pairs], dtype=np.int32)
+        adjacency[(i, j)] = _Csr(left, right, len(nodes[i]), len(nodes[j]))
+        adjacency[(j, i)] = _Csr(right, left, len(nodes[j]), len(nodes[i]))
+    return KPartiteGraph(num_partitions, ngram_size, nodes, adjacency)
+
+  def Neighbors(self, i, node, j):
+    """Sorted indices of the nodes in partition j adjacent to a node of i."""
+    indptr, indices = self.adjacency[(i, j)]
+    return indices[indptr[node]:indptr[node + 1]]
+
+  def NumEdges(self):
+    return sum(len(indices) for (i, j), (_, indices)
+               in self.adjacency.iteritems() if i < j)
+
+  def Edges(self):
+    """Yield (i, j, n-gram at i, n-gram at j) for each edge, with i < j."""
+    for i in xrange(self.num_partitions):
+      for j in xrange(i + 1, self.num_partitions):
+        for a in xrange(len(self.nodes[i])):
+          for b in self.Neighbors(i, a, j):
+            yield i, j, self.nodes[i][a], self.nodes[j][b]
+
+
+def _Csr(rows, cols, num_rows, num_cols):
+  """CSR (indptr, indices) of a 0/1 matrix, without duplicate entries."""
+  keys = np.unique(rows.astype(np.int64) * num_cols + cols)
+  rows, cols = keys // num_cols, keys % num_cols
+  indptr = np.zeros(num_rows + 1, dtype=np.int64)
+  np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+  return indptr, cols.astype(np.int32)
+
+
+def ReadKPartiteGraph(f):
+  """Read the format of WriteKPartiteGraph() in decode_ngrams.R:
+
+    num_partitions 3
+    ngram_size 2
+    edge 0.ab 1.cd
+    edge 0.ab 2.ef
+  """
+  try:
+    num_partitions = int(_ExpectField(f.readline(), 'num_partitions'))
+    ngram_size = int(_ExpectField(f.readline(), 'ngram_size'))
+  except ValueError as e:
+    raise RuntimeError('Invalid graph header: %s' % e)
+
+  edges = {}
+  for line in f:
+    parts = line.split()
+    if not parts:
+      continue
+    if len(parts) != 3 or parts[0] != 'edge':
+      raise RuntimeError('Expected an edge, got %r' % line)
+    (i, a), (j, b) = [_ParseNode(p, ngram_size) for p in parts[1:]]
+    if i >= j:
+      raise RuntimeError('Edge in wrong order (%d >= %d)' % (i, j))
+    edges.setdefault((i, j), []).append((a, b))
+  return KPartiteGraph.FromEdges(num_partitions, ngram_size, edges)
+
+
+def _ExpectField(line, name):
+  parts = line.split()
+  if len(parts) != 2 or parts[0] != name:
+    raise RuntimeError('Expected %r, got %r' % (name, line))
+  return parts[1]
+
+
+def _ParseNode(s, ngram_size):
+  """'1.cd' -> (1, 'cd')"""
+  partition, _, ngram = s.partition('.')
+  if len(ngram) != ngram_size:
+    raise RuntimeError('Invalid node %r' % s)
+  return int(partition), ngram
+
+
+def WriteKPartiteGraph(f, graph):
+  f.write('num_partitions %d\n' % graph.num_partitions)
+  f.write('ngram_size %d\n' % graph.ngram_size)
+  for i, j, a, b in graph.Edges():
+    f.write('edge %d.%s %d.%s\n' % (i, a, j, b))
+
+
+def _Extend(graph, picked, candidates, max_cliques, out):
+  """Extend a partial clique by one partition, depth first.
+
+  Args:
+    picked: dict of partition -> node index
+    candidates: dict of each other partition -> sorted array of the nodes
+      adjacent to all picked nodes.  None are empty.
+    out: list of cliques, as tuples of node indices in partition order
+
+  Returns:
+    False if the search should stop, because out has max_cliques cliques.
+  """
+  if not candidates:
+    out.append(tuple(picked[p] for p in xrange(graph.num_partitions)))
+    return max_cliques is None or len(out) < max_cliques
+
+  # Branch on the partition with the fewest candidates.
+  p = min(candidates, key=lambda q: len(candidates[q]))
+  rest = [q for q in candidates if q != p]
+  for node in candidates[p]:
+    narrowed = {}
+    for q in rest:
+      c = np.intersect1d(candidates[q], graph.Neighbors(p, node, q),
+                         assume_unique=True)
+      if len(c) == 0:
+        break  # prune: no node of q completes this branch
+      narrowed[q] = c
+    else:
+      picked[p] = node
+      more = _Extend(graph, picked, narrowed, max_cliques, out)
+      del picked[p]
+      if not more:
+        return False
+  return True
+
+
+def _SearchFrom(graph, root, node, max_cliques):
+  """All the cliques containing a node of the root partition."""
+  candidates = {}
+  for q in xrange(graph.num_partitions):
+    if q != root:
+      candidates[q] = graph.Neighbors(root, node, q)
+      if len(candidates[q]) == 0:
+        return []
+  out = []
+  _Extend(graph, {root: node}, candidates, max_cliques, out)
+  return out
+
+
+# The graph of a worker process, so it's pickled once per process, not once
+# per branch.
+_worker_graph = None
+
+
+def _InitWorker(graph):
+  global _worker_graph
+  _worker_graph = graph
+
+
+def _SearchBranch(args):
+  root, node, max_cliques = args
+  return _SearchFrom(_worker_graph, root, node, max_cliques)
+
+
+def FindCliques(graph, num_processes=1, max_cliques=None):
+  """Find the k-cliques of a k-partite graph, i.e. the feasible strings.
+
+  Like FindFeasibleStrings() in decode_ngrams.R, or find_cliques.cc.
+
+  Args:
+    num_processes: number of processes to search the branches of the root
+      partition in
+    max_cliques: If set, stop after this many cliques, to bound the output.
+
+  Returns:
+    Sorted list of tuples of n-grams, one per partition.
+  """
+  k = graph.num_partitions
+  if k == 0 or any(len(p) == 0 for p in graph.nodes):
+    return []
+  # The partition with the fewest nodes has the fewest branches.
+  root = min(xrange(k), key=lambda p: len(graph.nodes[p]))
+  tasks = [(root, node, max_cliques) for node in xrange(len(graph.nodes[root]))]
+
+  cliques = []
+  if num_processes > 1:
+    pool = multiprocessing.Pool(num_processes, initializer=_InitWorker,
+                                initargs=(graph,))
+    try:
+      for found in pool.imap_unordered(_SearchBranch, tasks):
+        cliques.extend(found)
+        if max_cliques is not None and len(cliques) >= max_cliques:
+          break
+    finally:
+      pool.terminate()
+  else:
+    for root, node, _ in tasks:
+      cliques.extend(_SearchFrom(graph, root, node, max_cliques))
+      if max_cliques is not None and len(cliques) >= max_cliques:
+        break
+
+  if max_cliques is not None and len(cliques) >= max_cliques:
+    log('Stopped after %d cliques', max_cliques)
+    cliques = sorted(cliques)[:max_cliques]
+  return sorted(tuple(graph.nodes[p][n] for p, n in enumerate(c))
+                for c in cliques)
+
+
+def EstimateDictionary(params, ngrams, X, pair_reports, num_partitions,
+                       ngram_size, threshold=PAIR_THRESHOLD, num_processes=1,
+                       max_cliques=None, rand=np.random):
+  """Estimate the dictionary of full strings from pairwise n-gram reports.
+
+  Like EstimateDictionary() in decode_ngrams.R.  See FindPairwiseCandidates()
+  for the arguments.
+
+  Returns:
+    (sorted list of candidate strings, KPartiteGraph)
+  """
+  edges = FindPairwiseCandidates(params, ngrams, X, pair_reports,
+                                 threshold=threshold, rand=rand)
+  graph = KPartiteGraph.FromEdges(num_partitions, ngram_size, edges)
+  log('Graph has %d nodes and %d edges',
+      sum(len(p) for p in graph.nodes), graph.NumEdges())
+  cliques = FindCliques(graph, num_processes=num_processes,
+                        max_cliques=max_cliques)
+  return sorted(''.join(c) for c in cliques), graph
+
+
+def CreateOptionsParser():
+  p = optparse.OptionParser()
+  p.add_option(
+      '--num-processes', dest='num_processes', type='int', default=1,
+      help='Number of processes for the clique search')
+  p.add_option(
+      '--max-cliques', dest='max_cliques', type='int', default=None,
+      help='Stop after this many cliques')
+  return p
+
+
+def main(argv):
+  (opts, argv) = CreateOptionsParser().parse_args(argv)
+  if len(argv) < 2 or argv[1] != 'find-cliques':
+    raise RuntimeError('Usage: ngrams.py find-cliques [options] < graph.txt')
+
+  graph = ReadKPartiteGraph(sys.stdin)
+  log('Read %d partitions, %d edges', graph.num_partitions, graph.NumEdges())
+  for clique in FindCliques(graph, num_processes=opts.num_processes,
+                            max_cliques=opts.max_cliques):
+    print ''.join(clique)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError, e:
+    print >>sys.stderr, 'FATAL: %s' % e
+    sys.exit(1)
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+"""
+ngrams_test.py: Tests for ngrams.py
+"""
+
+import cStringIO
+import itertools
+import unittest
+
+import numpy as np
+
+import decode
+import decode_test
+import ngrams  # module under test
+
+
+GRAPH = """\
+num_partitions 4
+ngram_size 2
+edge 0.ab 1.cd
+edge 0.xx 1.cd
+edge 0.ij 1.kl
+edge 0.ab 1.le
+edge 0.ab 2.ef
+edge 0.ij 2.mn
+edge 0.ij 3.op
+edge 0.ab 3.gh
+edge 1.cd 2.ef
+edge 1.kl 2.mn
+edge 1.kl 3.op
+edge 1.cd 3.gh
+edge 2.ef 3.gh
+edge 2.mn 3.xy
+"""
+
+
+def _Encode(params, X, values, cohorts, rand):
+  """IRR bits of the candidates 'values' (column indices of X)."""
+  k = params.num_bloombits
+  bloom = np.zeros((len(values), k), dtype=bool)
+  for n, (v, c) in enumerate(zip(values, cohorts)):
+    column = X.Column(v)
+    bloom[n, column[column // k == c] % k] = True
+  qstar, pstar = decode._ReportProbs(params)
+  return rand.uniform(size=bloom.shape) < np.where(bloom, qstar, pstar)
+
+
+class NgramsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = np.random.RandomState(3)
+
+  def testReadKPartiteGraph(self):
+    graph = ngrams.ReadKPartiteGraph(cStringIO.StringIO(GRAPH))
+    self.assertEqual(4, graph.num_partitions)
+    self.assertEqual(['ab', 'ij', 'xx'], graph.nodes[0])
+    self.assertEqual(14, graph.NumEdges())
+    # Both directions.
+    self.assertEqual(['ab', 'xx'], [graph.nodes[0][n]
+                                    for n in graph.Neighbors(1, 0, 0)])
+
+    f = cStringIO.StringIO()
+    ngrams.WriteKPartiteGraph(f, graph)
+    self.assertEqual(sorted(GRAPH.splitlines()[2:]),
+                     sorted(f.getvalue().splitlines()[2:]))
+
+    self.assertRaises(RuntimeError, ngrams.ReadKPartiteGraph,
+                      cStringIO.StringIO('num_partitions 2\nngram_size 2\n'
+                                         'edge 1.ab 0.cd\n'))
+
+  def testFindCliques(self):
+    graph = ngrams.ReadKPartiteGraph(cStringIO.StringIO(GRAPH))
+    # ij kl mn op is missing the edge mn - op.
+    expected = [('ab', 'cd', 'ef', 'gh')]
+    self.assertEqual(expected, ngrams.FindCliques(graph))
+    self.assertEqual(expected, ngrams.FindCliques(graph, num_processes=2))
+
+    # Every combination of a complete k-partite graph is a clique.
+    edges = dict(((i, j), list(itertools.product('ab', 'ab')))
+                 for i, j in itertools.combinations(range(3), 2))
+    graph = ngrams.KPartiteGraph.FromEdges(3, 1, edges)
+    self.assertEqual(8, len(ngrams.FindCliques(graph)))
+    self.assertEqual(3, len(ngrams.FindCliques(graph, max_cliques=3)))
+
+    # A partition without nodes.
+    graph = ngrams.KPartiteGraph.FromEdges(3, 2, {(0, 1): [('ab', 'cd')]})
+    self.assertEqual([], ngrams.FindCliques(graph))
+
+  def testPairEm(self):
+    truth = np.array([[0.5, 0.1], [0.0, 0.4]])
+    N = 5000
+    flat = self.rand.choice(4, size=N, p=truth.ravel())
+    cp1 = self.rand.uniform(size=(N, 2))
+    cp2 = self.rand.uniform(size=(N, 2))
+    cp1[np.arange(N), flat // 2] += 5
+    cp2[np.arange(N), flat % 2] += 5
+
+    _, fit = ngrams.PairEm(cp1, cp2)
+    joint = (cp1[:, :, np.newaxis] * cp2[:, np.newaxis, :]).reshape(N, 4)
+    pij = np.ones(4) / 4
+    for _ in xrange(2000):
+      new_pij = pij * (joint / joint.dot(pij)[:, np.newaxis]).mean(axis=0)
+      if np.max(np.abs(new_pij - pij)) < 1e-6:
+        break
+      pij = new_pij
+    np.testing.assert_allclose(pij.reshape(2, 2), fit, atol=1e-4)
+
+  def testEstimateDictionary(self):
+    params = decode_test._Params(k=32, h=2, m=8, p=0.05, q=0.95, f=0.0)
+    m, k = params.num_cohorts, params.num_bloombits
+    alphabet = 'abcd'
+    candidates = [''.join(c) for c in itertools.product(alphabet, repeat=2)]
+    columns = [(np.arange(m)[:, None] * k +
+                self.rand.randint(0, k, size=(m, 2))).ravel()
+               for _ in candidates]
+    X = decode.lasso.ColumnSparseMatrix.FromColumns(m * k, columns)
+
+    # Strings of 3 bigrams.  Each client reports 2 of them.
+    strings = ['abcdda', 'cabbad', 'ddacbc']
+    index = dict((s, j) for j, s in enumerate(candidates))
+    pair_reports = {}
+    for i, j in itertools.combinations(range(3), 2):
+      N = 6000
+      values = self.rand.randint(0, len(strings), size=N)
+      cohorts = self.rand.randint(0, m, size=N)
+      bits = []
+      for pos in (i, j):
+        ngram = [index[strings[v][2 * pos:2 * pos + 2]] for v in values]
+        bits.append(_Encode(params, X, ngram, cohorts, self.rand))
+      pair_reports[(i, j)] = (cohorts, bits[0], bits[1])
+
+    found, graph = ngrams.EstimateDictionary(
+        params, candidates, X, pair_reports, 3, 2, rand=self.rand)
+    self.assertEqual(sorted(strings), found)
+    self.assertEqual(9, graph.NumEdges())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,9 +1,58 @@
 #!/usr/bin/python
 """
-fast_em.py: Tensorflow implementation of expectation maximization for RAPPOR
-association analysis.
+fast_em.py: Expectation maximization for RAPPOR association analysis.
 
-TODO:
+There are three engines:
+
+  numpy: Each EM iteration is two matrix-vector products over the
+    (num_entries, entry_size) matrix of conditional probabilities.  This is
+    the default, and doesn't require TensorFlow.
+
+  mmap: The same iteration, over a memory-mapped input file, one chunk of rows
+    at a time.  Only pij and a partial sum are kept in memory, so the input
+    can be larger than RAM.
+
+  online: Stochastic (online) EM over mini-batches of rows of a memory-mapped
+    input file.  $FAST_EM_ONLINE_PASSES is the number of passes over the
+    reports (default 1), and $FAST_EM_BATCH_ROWS is the number of rows in a
+    mini-batch (default 10000).  MAX_EM_ITERS doesn't apply, since callers
+    like fast_em.R set it for batch EM.  Each mini-batch updates pij, so one
+    pass is often enough for a close estimate.  See RunOnlineEm().
+
+  tensorflow: The original TensorFlow implementation, with one op per report.
+
+The numpy and mmap engines use SQUAREM to accelerate EM if $FAST_EM_METHOD is
+'squarem' (default 'em').  They write the objective (mean log likelihood) and
+step length of each iteration to OUTPUT.trace.csv.
+
+They split the rows into chunks and sum them on $FAST_EM_NUM_THREADS threads
+(default 1).  NumPy releases the GIL in the
+matrix-vector products, so the threads run in parallel.
+
+Usage:
+  fast_em.py INPUT OUTPUT MAX_EM_ITERS [ENGINE]
+
+The input and output formats are the same as analysis/cpp/fast_em.cc.  The
+numpy and mmap engines also read the sparse format written by
+WriteSparseListOfMatrices().  All engines also read format v2, which has a
+fixed-size header with the dtype, dimensions, and checksums (see WriteV2()).
+Set $FAST_EM_OUTPUT_VERSION to 2 to write the result in format v2 too.
+fast_em.R and fast_em.cc only read and write v1.
+
+If $FAST_EM_PRECISION is float32 (default float64), the numpy and mmap engines
+compute the products of a dense matrix in float32, and sum them in float64.
+The numpy engine stores the matrix as float32, so it takes half the memory.
+The result is checked in float64, which EM falls back to if they differ (see
+RunMixedPrecisionEm()).
+
+If $FAST_EM_ESTIMATE_VAR is 1, the variance-covariance matrix of the estimate
+is also written to OUTPUT, after pij (see ComputeVar()).
+
+If INPUT.start.bin exists, EM starts from the pij in it instead of the uniform
+distribution (see WriteStartingPij()).  The assoc pipeline uses this to warm
+start from the previous date.
+
+TODO for the TensorFlow engine:
   - Use TensorFlow ops for reading input (so that reading input can be
     distributed)
   - Reduce the number of ops (currently proportional to the number of reports).
@@ -14,10 +63,14 @@ TODO:
     bin$ ./test.sh decode-assoc-tensorflow - 226 seconds on GPU
 """
 
+import multiprocessing.pool
+import os
 import sys
+import zlib
 
 import numpy as np
-import tensorflow as tf
+# tensorflow is imported by the functions that need it, so that the NumPy
+# engine works without it.
 
 
 def log(msg, *args):
@@ -61,13 +114,247 @@ def ReadListOfMatrices(f):
   return num_entries, entry_size, v
 
 
+def MapListOfMatrices(path):
+  """
+  Memory map the list of conditional probability matrices in a binary file.
+
+  Returns:
+    num_entries, entry_size, and a read-only numpy.memmap of shape
+    (num_entries, entry_size).
+  """
+  with open(path, 'rb') as f:
+    ExpectTag(f, 'ne \0')
+    num_entries = np.fromfile(f, np.uint32, count=1)[0]
+    ExpectTag(f, 'es \0')
+    entry_size = np.fromfile(f, np.uint32, count=1)[0]
+    ExpectTag(f, 'dat\0')
+    offset = f.tell()
+
+  log('Number of entries: %d', num_entries)
+  log('Entry size: %d', entry_size)
+
+  try:
+    v = np.memmap(path, dtype=np.float64, mode='r', offset=offset,
+                  shape=(int(num_entries), int(entry_size)))
+  except ValueError as e:  # file too short
+    raise RuntimeError('Error mapping %s: %s' % (path, e))
+  return num_entries, entry_size, v
+
+
+class SparseCondProb(object):
+  """A (num_entries, entry_size) matrix of conditional probabilities, with
+  only the nonzero entries of each row (CSR format).
+
+  For string x boolean association, most entries of a report's row are
+  near zero, so EM on this format takes time and memory proportional to the
+  number of nonzeros.
+  """
+
+  def __init__(self, entry_size, indptr, indices, data):
+    """
+    Args:
+      entry_size: number of columns
+      indptr: the entries of row i are indices[indptr[i]:indptr[i+1]]
+      indices: column of each entry
+      data: value of each entry
+    """
+    self.indptr = indptr
+    self.indices = indices
+    self.data = data
+    self.shape = (len(indptr) - 1, entry_size)
+
+  @staticmethod
+  def FromDense(dense, threshold=0.0):
+    """Keep the entries of each row greater than threshold * the row max."""
+    dense = np.asarray(dense)
+    keep = dense > threshold * dense.max(axis=1)[:, np.newaxis]
+    keep &= dense > 0
+    indptr = np.zeros(dense.shape[0] + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(keep.sum(axis=1))
+    rows, cols = np.nonzero(keep)
+    return SparseCondProb(dense.shape[1], indptr, cols.astype(np.uint32),
+                          dense[rows, cols])
+
+  def __getitem__(self, rows):
+    """Select a slice of rows, for chunking."""
+    start, stop, _ = rows.indices(self.shape[0])
+    stop = max(start, stop)
+    begin, end = self.indptr[start], self.indptr[stop]
+    return SparseCondProb(self.shape[1],
+                          np.asarray(self.indptr[start:stop + 1]) - begin,
+                          self.indices[begin:end], self.data[begin:end])
+
+  def ToDense(self):
+    dense = np.zeros(self.shape)
+    counts = np.diff(self.indptr)
+    rows = np.repeat(np.arange(self.shape[0]), counts)
+    dense[rows, self.indices] = self.data
+    return dense
+
+  def PartialSum(self, pij):
+    """Like _PartialSum() for a dense matrix."""
+    num_rows, entry_size = self.shape
+    counts = np.diff(self.indptr)
+    indices = np.asarray(self.indices)
+    data = np.asarray(self.data)
+    rows = np.repeat(np.arange(num_rows), counts)
+
+    row_sums = np.bincount(rows, weights=data * pij[indices],
+                           minlength=num_rows)
+    with np.errstate(divide='ignore'):
+      total = np.bincount(indices, weights=data / row_sums[rows],
+                          minlength=entry_size)
+      return total, np.sum(np.log(row_sums))
+
+
+class FactorCondProb(object):
+  """A (num_entries, entry_size) matrix of joint conditional probabilities,
+  stored as one (num_entries, d_v) factor per variable.
+
+  The row of report m is the outer product of the rows m of the factors, as in
+  UpdateJointConditional() in analysis/R/association.R, flattened with the
+  first variable varying fastest.  entry_size is the product of the d_v, but
+  only the sum of the d_v is stored per report, so 3 or more variables fit in
+  memory.  The E-step contracts pij with the factors, a chunk of rows at a
+  time.
+  """
+
+  def __init__(self, factors):
+    """
+    Args:
+      factors: list of (num_entries, d_v) arrays, one per variable
+    """
+    self.factors = factors
+    self.dims = tuple(f.shape[1] for f in factors)
+    self.shape = (factors[0].shape[0], int(np.prod(self.dims)))
+
+  def __getitem__(self, rows):
+    """Select a slice of rows, for chunking."""
+    return FactorCondProb([f[rows] for f in self.factors])
+
+  def ToDense(self):
+    joint = self.factors[0]
+    num_rows = joint.shape[0]
+    for f in self.factors[1:]:
+      # The variables so far vary fastest.
+      joint = (f[:, :, np.newaxis] * joint[:, np.newaxis, :]).reshape(
+          num_rows, -1)
+    return joint
+
+  def _Operands(self, factors):
+    """einsum operands for the factors: report axis R, and one axis per
+    variable."""
+    R = len(factors)
+    operands = []
+    for v, f in enumerate(factors):
+      operands.extend([f, [R, v]])
+    return operands, R
+
+  def PartialSum(self, pij):
+    """Like _PartialSum() for a dense matrix."""
+    num_rows, entry_size = self.shape
+    P = pij.reshape(self.dims, order='F')
+    axes = range(len(self.dims))
+    # Each contraction has temporaries of about chunk_rows * entry_size.
+    chunk_rows = max(1, MMAP_CHUNK_BYTES // (8 * entry_size))
+
+    total = np.zeros(self.dims)
+    log_lik = 0.0
+    for start in xrange(0, num_rows, chunk_rows):
+      factors = [f[start:start + chunk_rows] for f in self.factors]
+      operands, R = self._Operands(factors)
+      # The likelihood of each report: pij contracted with its factors.
+      row_sums = np.einsum(P, axes, *(operands + [[R]]), optimize=True)
+      with np.errstate(divide='ignore'):
+        w = 1.0 / row_sums
+        total += np.einsum(w, [R], *(operands + [axes]), optimize=True)
+        log_lik += np.sum(np.log(row_sums))
+    return total.ravel(order='F'), log_lik
+
+
+def _IsSparse(path):
+  with open(path, 'rb') as f:
+    return f.read(4) == 'csr\0'
+
+
+def _ReadSparseHeader(f):
+  ExpectTag(f, 'csr\0')
+  ExpectTag(f, 'ne \0')
+  num_entries = int(np.fromfile(f, np.uint32, count=1)[0])
+  ExpectTag(f, 'es \0')
+  entry_size = int(np.fromfile(f, np.uint32, count=1)[0])
+  log('Number of entries: %d', num_entries)
+  log('Entry size: %d', entry_size)
+
+  ExpectTag(f, 'ptr\0')
+  indptr = np.fromfile(f, np.uint64, count=num_entries + 1).astype(np.int64)
+  if len(indptr) != num_entries + 1:
+    raise RuntimeError('Expected %d row pointers, got %d' %
+                       (num_entries + 1, len(indptr)))
+  log('Nonzeros: %d', indptr[-1])
+  return entry_size, indptr
+
+
+def ReadSparseListOfMatrices(f):
+  """Read the sparse format written by WriteSparseListOfMatrices()."""
+  entry_size, indptr = _ReadSparseHeader(f)
+  nnz = indptr[-1]
+  ExpectTag(f, 'idx\0')
+  indices = np.fromfile(f, np.uint32, count=nnz)
+  ExpectTag(f, 'dat\0')
+  data = np.fromfile(f, np.float64, count=nnz)
+  if len(indices) != nnz or len(data) != nnz:
+    raise RuntimeError('Expected %d nonzeros' % nnz)
+  return SparseCondProb(entry_size, indptr, indices, data)
+
+
+def MapSparseListOfMatrices(path):
+  """Like ReadSparseListOfMatrices(), but memory map the entries."""
+  with open(path, 'rb') as f:
+    entry_size, indptr = _ReadSparseHeader(f)
+    idx_offset = f.tell() + 4
+  nnz = int(indptr[-1])
+  dat_offset = idx_offset + 4 * nnz + 4
+  try:
+    indices = np.memmap(path, dtype=np.uint32, mode='r', offset=idx_offset,
+                        shape=(nnz,))
+    data = np.memmap(path, dtype=np.float64, mode='r', offset=dat_offset,
+                     shape=(nnz,))
+  except ValueError as e:  # file too short
+    raise RuntimeError('Error mapping %s: %s' % (path, e))
+  return SparseCondProb(entry_size, indptr, indices, data)
+
+
 def WriteTag(f, tag):
   if len(tag) != 3:
     raise AssertionError("Tags should be 3 bytes.  Got %r" % tag)
   f.write(tag + '\0')  # NUL terminated
 
 
-def WriteResult(f, num_em_iters, pij):
+def WriteSparseListOfMatrices(f, cond_prob):
+  """Write a SparseCondProb.
+
+  The format is 'csr', then the number of entries and entry size as in the
+  dense format, then 'ptr' and num_entries + 1 uint64 row pointers, 'idx' and
+  the uint32 column of each nonzero, and 'dat' and their float64 values.
+  """
+  num_entries, entry_size = cond_prob.shape
+  WriteTag(f, 'csr')
+  WriteTag(f, 'ne ')
+  np.array([num_entries], np.uint32).tofile(f)
+  WriteTag(f, 'es ')
+  np.array([entry_size], np.uint32).tofile(f)
+  WriteTag(f, 'ptr')
+  np.asarray(cond_prob.indptr, np.uint64).tofile(f)
+  WriteTag(f, 'idx')
+  np.asarray(cond_prob.indices, np.uint32).tofile(f)
+  WriteTag(f, 'dat')
+  np.asarray(cond_prob.data, np.float64).tofile(f)
+
+
+def WriteResult(f, num_em_iters, pij, var_cov=None):
+  """Write the result.  If var_cov is set, the entry_size x entry_size
+  matrix follows pij, after a 'var' tag."""
   WriteTag(f, 'emi')
   emi = np.array([num_em_iters], np.uint32)
   emi.tofile(f)
@@ -75,9 +362,327 @@ def WriteResult(f, num_em_iters, pij):
   WriteTag(f, 'pij')
   pij.tofile(f)
 
+  if var_cov is not None:
+    WriteTag(f, 'var')
+    np.asarray(var_cov, np.float64).tofile(f)
+
+
+def StartingPijPath(input_path):
+  return input_path + '.start.bin'
+
+
+def WriteStartingPij(f, pij):
+  """Write the pij to start EM from: 'pij' and entry_size float64 values."""
+  WriteTag(f, 'pij')
+  np.asarray(pij, np.float64).tofile(f)
+
+
+def ReadStartingPij(f, entry_size):
+  """Read the file written by WriteStartingPij()."""
+  ExpectTag(f, 'pij\0')
+  pij = np.fromfile(f, np.float64, count=entry_size)
+  if len(pij) != entry_size:
+    raise RuntimeError('Expected %d starting values, got %d' %
+                       (entry_size, len(pij)))
+  if np.any(pij < 0) or not pij.sum() > 0:
+    raise RuntimeError('Starting pij should be nonnegative with a positive sum')
+  return pij / pij.sum()
+
+
+#
+# Format v2
+#
+# The v1 formats above are a series of tags and values, so a reader has to
+# parse them in order, and they don't record the type of the values.  A v2
+# file is a fixed-size header, then one 2-D array at an aligned offset, so it
+# can be memory mapped without parsing anything else:
+#
+#   magic        8 bytes 'RAPPOREM'
+#   version      uint32, 2
+#   kind         uint32, V2_COND_PROB or V2_RESULT
+#   dtype        uint32, a key of V2_DTYPES
+#   num_dims     uint32, the number of variables
+#   num_rows     uint64
+#   num_cols     uint64
+#   dims         8 x uint32, the size of each variable, with the first one
+#                varying fastest in a row.  Their product is num_cols.
+#   data_offset  uint64, a multiple of V2_ALIGNMENT
+#   data_bytes   uint64
+#   aux          uint64, the number of EM iterations of a V2_RESULT
+#   data_crc     uint32, CRC-32 of the data
+#   (reserved)
+#   header_crc   uint32, CRC-32 of the header before it
+#
+# All values are little-endian.  A V2_COND_PROB array is the
+# (num_entries, entry_size) matrix of conditional probabilities.  Row 0 of a
+# V2_RESULT array is pij, and the entry_size x entry_size variance-covariance
+# matrix may follow it.
+
+V2_MAGIC = 'RAPPOREM'
+V2_VERSION = 2
+V2_ALIGNMENT = 64
+V2_MAX_DIMS = 8
+
+V2_COND_PROB = 1
+V2_RESULT = 2
+
+V2_DTYPES = {1: np.dtype('<f8'), 2: np.dtype('<f4')}
+
+V2_HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('kind', '<u4'),
+    ('dtype', '<u4'),
+    ('num_dims', '<u4'),
+    ('num_rows', '<u8'),
+    ('num_cols', '<u8'),
+    ('dims', '<u4', (V2_MAX_DIMS,)),
+    ('data_offset', '<u8'),
+    ('data_bytes', '<u8'),
+    ('aux', '<u8'),
+    ('data_crc', '<u4'),
+    ('reserved', 'V24'),
+    ('header_crc', '<u4'),
+])
+assert V2_HEADER.itemsize == 128
+
+
+def _Crc32(array, crc=0):
+  """CRC-32 of the bytes of a C-contiguous array, a chunk at a time."""
+  b = array.reshape(-1).view(np.uint8)
+  for start in xrange(0, len(b), MMAP_CHUNK_BYTES):
+    crc = zlib.crc32(b[start:start + MMAP_CHUNK_BYTES], crc)
+  return crc & 0xffffffff
+
+
+def _V2DtypeCode(dtype):
+  for code, d in V2_DTYPES.iteritems():
+    if d == np.dtype(dtype):
+      return code
+  raise RuntimeError('Format v2 stores float64 or float32, not %s' % dtype)
+
+
+def _V2Chunks(array, dtype):
+  """Yield the rows of array converted to dtype, a chunk at a time, so a large
+  memmap isn't copied all at once."""
+  num_rows, num_cols = array.shape
+  chunk_rows = max(1, MMAP_CHUNK_BYTES // (8 * max(1, num_cols)))
+  for start in xrange(0, num_rows, chunk_rows):
+    yield np.ascontiguousarray(array[start:start + chunk_rows], dtype=dtype)
+
+
+def WriteV2(f, kind, array, dims=None, aux=0, dtype=None):
+  """Write a 2-D array in format v2.
+
+  Args:
+    kind: V2_COND_PROB or V2_RESULT
+    array: numpy.ndarray or numpy.memmap
+    dims: sizes of the variables of a column, e.g. (2, S).  By default, a
+      single variable.
+    aux: the number of EM iterations of a V2_RESULT
+    dtype: float64 or float32.  By default, the dtype of array.
+  """
+  num_rows, num_cols = array.shape
+  dtype = V2_DTYPES[_V2DtypeCode(array.dtype if dtype is None else dtype)]
+  dims = tuple(dims) if dims is not None else (num_cols,)
+  if len(dims) > V2_MAX_DIMS or int(np.prod(dims)) != num_cols:
+    raise RuntimeError('Invalid dims %s for %d columns' % (dims, num_cols))
+
+  data_crc = 0
+  for chunk in _V2Chunks(array, dtype):
+    data_crc = _Crc32(chunk, data_crc)
+
+  header = np.zeros(1, V2_HEADER)
+  h = header[0]
+  h['magic'] = V2_MAGIC
+  h['version'] = V2_VERSION
+  h['kind'] = kind
+  h['dtype'] = _V2DtypeCode(dtype)
+  h['num_dims'] = len(dims)
+  h['num_rows'] = num_rows
+  h['num_cols'] = num_cols
+  h['dims'][:len(dims)] = dims
+  h['data_offset'] = -(-V2_HEADER.itemsize // V2_ALIGNMENT) * V2_ALIGNMENT
+  h['data_bytes'] = num_rows * num_cols * dtype.itemsize
+  h['aux'] = aux
+  h['data_crc'] = data_crc
+  h['header_crc'] = _Crc32(header.view(np.uint8)[:-4])
+
+  f.write(header.tostring())
+  f.write('\0' * (int(h['data_offset']) - V2_HEADER.itemsize))
+  for chunk in _V2Chunks(array, dtype):
+    f.write(chunk.tostring())
+
+
+def _IsV2(path):
+  with open(path, 'rb') as f:
+    return f.read(len(V2_MAGIC)) == V2_MAGIC
+
+
+def ReadV2Header(f):
+  """Read and check the header of a v2 file.
+
+  Returns:
+    A record of V2_HEADER.  The file is positioned after the header.
+  """
+  b = f.read(V2_HEADER.itemsize)
+  if len(b) != V2_HEADER.itemsize or not b.startswith(V2_MAGIC):
+    raise RuntimeError('Expected a format v2 header')
+  header = np.frombuffer(b, V2_HEADER)
+  h = header[0]
+  if _Crc32(header.view(np.uint8)[:-4]) != h['header_crc']:
+    raise RuntimeError('Header checksum mismatch')
+  if h['version'] != V2_VERSION:
+    raise RuntimeError('Unsupported format version %d' % h['version'])
+  if h['dtype'] not in V2_DTYPES:
+    raise RuntimeError('Unknown dtype code %d' % h['dtype'])
+  num_dims = h['num_dims']
+  if (num_dims > V2_MAX_DIMS or
+      int(np.prod(h['dims'][:num_dims])) != h['num_cols']):
+    raise RuntimeError('Invalid dims in header')
+  return h
+
+
+def V2Dims(header):
+  return tuple(int(d) for d in header['dims'][:header['num_dims']])
+
+
+def _CheckV2Data(header, data):
+  if _Crc32(data) != header['data_crc']:
+    raise RuntimeError('Data checksum mismatch')
+
+
+def ReadV2(f, verify=True):
+  """Read a v2 file into memory.
+
+  Returns:
+    (header, array of shape (num_rows, num_cols))
+  """
+  h = ReadV2Header(f)
+  f.read(int(h['data_offset']) - V2_HEADER.itemsize)
+  shape = (int(h['num_rows']), int(h['num_cols']))
+  data = np.fromfile(f, V2_DTYPES[h['dtype']], count=shape[0] * shape[1])
+  if len(data) != shape[0] * shape[1]:
+    raise RuntimeError('Expected %d values, got %d' %
+                       (shape[0] * shape[1], len(data)))
+  if verify:
+    _CheckV2Data(h, data)
+  return h, data.reshape(shape)
+
+
+def MapV2(path, verify=False):
+  """Memory map the array of a v2 file, without copying it.
+
+  Checking the data CRC reads the whole file, so it's off by default.
+
+  Returns:
+    (header, read-only numpy.memmap of shape (num_rows, num_cols))
+  """
+  with open(path, 'rb') as f:
+    h = ReadV2Header(f)
+  shape = (int(h['num_rows']), int(h['num_cols']))
+  try:
+    data = np.memmap(path, dtype=V2_DTYPES[h['dtype']], mode='r',
+                     offset=int(h['data_offset']), shape=shape)
+  except ValueError as e:  # file too short
+    raise RuntimeError('Error mapping %s: %s' % (path, e))
+  if verify:
+    _CheckV2Data(h, data)
+  return h, data
+
+
+def WriteListOfMatricesV2(f, cond_prob, dims=None, dtype=None):
+  """Write a (num_entries, entry_size) matrix of conditional probabilities in
+  format v2, e.g. to convert a v1 file:
+
+    _, _, v = MapListOfMatrices(path)
+    WriteListOfMatricesV2(f, v, dtype=np.float32)
+  """
+  WriteV2(f, V2_COND_PROB, cond_prob, dims=dims, dtype=dtype)
+
+
+def LoadCondProb(path, mmap=False):
+  """Load the conditional probabilities of any input format: v1 dense, v1
+  sparse (WriteSparseListOfMatrices()), or v2.
+
+  Args:
+    mmap: If True, memory map the file instead of reading it.
+
+  Returns:
+    numpy.ndarray, numpy.memmap, or SparseCondProb of shape
+    (num_entries, entry_size)
+  """
+  if _IsV2(path):
+    if mmap:
+      h, cond_prob = MapV2(path)
+    else:
+      with open(path, 'rb') as f:
+        h, cond_prob = ReadV2(f)
+    if h['kind'] != V2_COND_PROB:
+      raise RuntimeError('%s has no conditional probabilities' % path)
+    log('Number of entries: %d', h['num_rows'])
+    log('Entry size: %d (%s)', h['num_cols'], cond_prob.dtype)
+    return cond_prob
+
+  if _IsSparse(path):
+    if mmap:
+      return MapSparseListOfMatrices(path)
+    with open(path, 'rb') as f:
+      return ReadSparseListOfMatrices(f)
+
+  if mmap:
+    _, _, cond_prob = MapListOfMatrices(path)
+    return cond_prob
+  with open(path, 'rb') as f:
+    num_entries, entry_size, v = ReadListOfMatrices(f)
+  return v.reshape((num_entries, entry_size))
+
+
+def WriteResultV2(f, num_em_iters, pij, var_cov=None):
+  """Like WriteResult(), in format v2."""
+  result = np.asarray(pij, np.float64)[np.newaxis, :]
+  if var_cov is not None:
+    result = np.vstack((result, var_cov))
+  WriteV2(f, V2_RESULT, result, aux=num_em_iters)
+
+
+def ReadResult(f):
+  """Read a result written by WriteResult() or WriteResultV2().
+
+  Returns:
+    (num_em_iters, pij, var_cov or None)
+  """
+  b = f.read(len(V2_MAGIC))
+  f.seek(-len(b), os.SEEK_CUR)
+  if b == V2_MAGIC:
+    h, result = ReadV2(f)
+    if h['kind'] != V2_RESULT:
+      raise RuntimeError('Expected an EM result')
+    var_cov = result[1:] if len(result) > 1 else None
+    return int(h['aux']), result[0], var_cov
+
+  # v1 doesn't store entry_size.  The rest of the file is either pij, or pij,
+  # 'var', and entry_size ** 2 values.
+  ExpectTag(f, 'emi\0')
+  num_em_iters = int(np.fromfile(f, np.uint32, count=1)[0])
+  ExpectTag(f, 'pij\0')
+  rest = f.read()
+  if len(rest) % 8 == 0:
+    return num_em_iters, np.frombuffer(rest, np.float64), None
+  # 8 * E + 4 + 8 * E^2 bytes
+  entry_size = int(round((np.sqrt(1 + (len(rest) - 4) / 2.0) - 1) / 2))
+  split = 8 * entry_size
+  if (len(rest) != split + 4 + 8 * entry_size ** 2 or
+      rest[split:split + 4] != 'var\0'):
+    raise RuntimeError('Invalid v1 result of %d bytes' % len(rest))
+  pij = np.frombuffer(rest[:split], np.float64)
+  var_cov = np.frombuffer(rest[split + 4:], np.float64)
+  return num_em_iters, pij, var_cov.reshape((entry_size, entry_size))
+
 
 def DebugSum(num_entries, entry_size, v):
   """Sum the entries as a sanity check."""
+  import tensorflow as tf
   cond_prob = tf.placeholder(tf.float64, shape=(num_entries * entry_size,))
   debug_sum = tf.reduce_sum(cond_prob)
   with tf.Session() as sess:
@@ -86,6 +691,8 @@ def DebugSum(num_entries, entry_size, v):
 
 
 def BuildEmIter(num_entries, entry_size, v):
+  import tensorflow as tf
+
   # Placeholder for the value from the previous iteration.
   pij_in = tf.placeholder(tf.float64, shape=(entry_size,))
 
@@ -110,7 +717,8 @@ def BuildEmIter(num_entries, entry_size, v):
   return pij_in, em_iter_expr
 
 
-def RunEm(pij_in, entry_size, em_iter_expr, max_em_iters, epsilon=1e-6):
+def RunEm(pij_in, entry_size, em_iter_expr, max_em_iters, epsilon=1e-6,
+          starting_pij=None):
   """Run the iterative EM algorithm (using the TensorFlow API).
 
   Args:
@@ -118,12 +726,19 @@ def RunEm(pij_in, entry_size, em_iter_expr, max_em_iters, epsilon=1e-6):
     entry_size: total number of cells in each matrix
     v: numpy.ndarray (e.g. 7000 x 8 matrix)
     max_em_iters: maximum number of EM iterations
+    starting_pij: If set, the initial value instead of the uniform
+      distribution.
 
   Returns:
     pij: numpy.ndarray (e.g. vector of length 8)
   """
-  # Initial value is the uniform distribution
-  pij = np.ones(entry_size) / entry_size
+  import tensorflow as tf
+
+  if starting_pij is None:
+    # Initial value is the uniform distribution
+    pij = np.ones(entry_size) / entry_size
+  else:
+    pij = starting_pij
 
   i = 0  # visible outside loop
 
@@ -137,40 +752,559 @@ def RunEm(pij_in, entry_size, em_iter_expr, max_em_iters, epsilon=1e-6):
       pij = new_pij
 
       if dif < epsilon:
-        log('Early EM termination: %e < %e', max_dif, epsilon)
+        log('Early EM termination: %e < %e', dif, epsilon)
         break
 
   # If i = 9, then we did 10 iteratinos.
   return i + 1, pij
 
 
+# Size of the chunks of rows read by the mmap engine.
+MMAP_CHUNK_BYTES = 64 << 20
+
+# With float32 products, BLAS sums the rows of a chunk in float32, so the
+# chunks are small, and they're summed in float64.
+FLOAT32_CHUNK_ROWS = 16384
+
+# Max difference between a float32 and a float64 EM step from the float32
+# estimate.  If it's larger, RunMixedPrecisionEm() falls back to float64.
+FLOAT32_TOLERANCE = 1e-5
+
+
+def _PartialSum(chunk, pij, float32=False):
+  """Sums over the rows of a chunk.
+
+  Args:
+    float32: If set, compute the matrix-vector products of a dense chunk in
+      float32.  The results are float64.
+
+  Returns:
+    sum_m cond_prob[m] / (cond_prob[m] . pij), and
+    sum_m log(cond_prob[m] . pij)
+  """
+  if isinstance(chunk, (SparseCondProb, FactorCondProb)):
+    return chunk.PartialSum(pij)
+  if float32:
+    chunk = np.asarray(chunk, np.float32)
+    row_sums = chunk.dot(pij.astype(np.float32)).astype(np.float64)
+    with np.errstate(divide='ignore', over='ignore'):
+      w = (1.0 / row_sums).astype(np.float32)
+      return (chunk.T.dot(w).astype(np.float64),
+              np.sum(np.log(row_sums)))
+  row_sums = chunk.dot(pij)
+  with np.errstate(divide='ignore'):
+    return chunk.T.dot(1.0 / row_sums), np.sum(np.log(row_sums))
+
+
+def _DefaultChunkRows(cond_prob, float32):
+  """Chunks for a dense matrix whose products aren't all float64.
+
+  np.dot() converts a float32 matrix to float64, so without chunks, each
+  iteration would make a float64 copy of the whole matrix.
+  """
+  if isinstance(cond_prob, (SparseCondProb, FactorCondProb)):
+    return None
+  if float32:
+    return FLOAT32_CHUNK_ROWS
+  if cond_prob.dtype != np.float64:
+    return max(1, MMAP_CHUNK_BYTES // (8 * cond_prob.shape[1]))
+  return None
+
+
+def AsFloat32(cond_prob):
+  """Copy a dense matrix (e.g. a float64 memmap) to a float32 array, a chunk
+  at a time, so the float64 matrix doesn't have to fit in memory."""
+  if cond_prob.dtype == np.float32:
+    return cond_prob
+  num_entries, entry_size = cond_prob.shape
+  result = np.empty((num_entries, entry_size), np.float32)
+  chunk_rows = max(1, MMAP_CHUNK_BYTES // (8 * entry_size))
+  for start in xrange(0, num_entries, chunk_rows):
+    result[start:start + chunk_rows] = cond_prob[start:start + chunk_rows]
+  return result
+
+
+def EmStep(cond_prob, pij, chunk_rows=None, pool=None, float32=False):
+  """One EM iteration.
+
+  For each report m, z_m = cond_prob[m] * pij, normalized to sum to 1, and the
+  new pij is the average of the z_m.  Since pij is common to all reports, that
+  is
+
+    new_pij[i] = pij[i] * sum_m (cond_prob[m, i] / (cond_prob[m] . pij)) / n
+
+  which only needs two matrix-vector products, and no temporary matrix.
+
+  Args:
+    cond_prob: numpy.ndarray, numpy.memmap, SparseCondProb, or
+      FactorCondProb of shape (num_entries, entry_size)
+    pij: vector of length entry_size
+    chunk_rows: If set, sum over chunks of this many rows, so that only one
+      chunk of a memmap is paged in at a time.
+    pool: If set, a multiprocessing.pool.ThreadPool that sums the chunks in
+      parallel.
+    float32: If set, compute the products of a dense matrix in float32.  The
+      chunks are summed in float64.
+
+  Returns:
+    new_pij, and the objective at pij: the mean log likelihood of the reports,
+    which EM never decreases.
+  """
+  num_entries = cond_prob.shape[0]
+  if chunk_rows is None:
+    total, log_lik = _PartialSum(cond_prob, pij, float32=float32)
+    return pij * total / num_entries, log_lik / num_entries
+
+  chunks = (cond_prob[start:start + chunk_rows]
+            for start in xrange(0, num_entries, chunk_rows))
+  if pool is None:
+    partial_sums = (_PartialSum(chunk, pij, float32=float32)
+                    for chunk in chunks)
+  else:
+    # imap() keeps the order, so the result doesn't depend on scheduling.
+    partial_sums = pool.imap(
+        lambda chunk: _PartialSum(chunk, pij, float32=float32), chunks)
+
+  total = np.zeros(len(pij))
+  log_lik = 0.0
+  for partial_sum, partial_log_lik in partial_sums:
+    total += partial_sum
+    log_lik += partial_log_lik
+  return pij * total / num_entries, log_lik / num_entries
+
+
+def NumpyEmIter(cond_prob, pij, chunk_rows=None, pool=None):
+  """One EM iteration.  See EmStep()."""
+  return EmStep(cond_prob, pij, chunk_rows=chunk_rows, pool=pool)[0]
+
+
+def _SquaremStep(p0, p1, p2):
+  """Extrapolate from two EM steps, with the SqS3 step length.
+
+  See Varadhan and Roland, "Simple and Globally Convergent Methods for
+  Accelerating the Convergence of Any EM Algorithm" (2008).
+
+  Returns:
+    (new pij, step length).  A step length of 1 gives p2, i.e. plain EM.
+  """
+  r = p1 - p0
+  v = p2 - p1 - r
+  vv = v.dot(v)
+  if vv == 0.0:
+    return p2, 1.0
+  step = max(1.0, np.sqrt(r.dot(r) / vv))
+
+  # Halve the distance to p2 until the result is a distribution.
+  while True:
+    p = p0 + 2 * step * r + step * step * v
+    if np.all(p >= 0) or step == 1.0:
+      break
+    step = max(1.0, (step + 1.0) / 2)
+  return p / p.sum(), step
+
+
+def RunNumpyEm(cond_prob, max_em_iters, epsilon=1e-6, chunk_rows=None,
+               num_threads=1, accelerate=False, starting_pij=None,
+               float32=False):
+  """Run the iterative EM algorithm with NumPy.
+
+  Args:
+    cond_prob: numpy.ndarray, numpy.memmap, SparseCondProb, or
+      FactorCondProb of shape (num_entries, entry_size)
+    max_em_iters: maximum number of EM iterations
+    chunk_rows: passed to EmStep
+    num_threads: number of threads to sum the chunks on.  If chunk_rows isn't
+      set, each thread gets a few chunks, to balance the load.
+    accelerate: Use SQUAREM.  Each cycle does 3 EM iterations: two to
+      extrapolate from, and one from the extrapolated point.  If the
+      objective goes down, the cycle falls back to the plain EM steps.
+    starting_pij: If set, the initial value instead of the uniform
+      distribution, e.g. the estimate for the previous date.  EM can't move
+      an entry away from zero, so it should be positive wherever the new
+      estimate might be.
+    float32: passed to EmStep.  See RunMixedPrecisionEm() for a checked
+      version.
+
+  Returns:
+    (number of EM iterations, pij, trace), where trace is a list of
+    (objective, step length), one per iteration or SQUAREM cycle.
+  """
+  num_entries, entry_size = cond_prob.shape
+  if chunk_rows is None:
+    chunk_rows = _DefaultChunkRows(cond_prob, float32)
+  if starting_pij is None:
+    # Initial value is the uniform distribution
+    pij = np.ones(entry_size) / entry_size
+  else:
+    if len(starting_pij) != entry_size:
+      raise RuntimeError('Expected %d starting values, got %d' %
+                         (entry_size, len(starting_pij)))
+    pij = np.asarray(starting_pij, np.float64)
+
+  pool = None
+  if num_threads > 1:
+    pool = multiprocessing.pool.ThreadPool(num_threads)
+    if chunk_rows is None:
+      chunk_rows = max(1, -(-num_entries // (4 * num_threads)))
+
+  def Step(p):
+    return EmStep(cond_prob, p, chunk_rows=chunk_rows, pool=pool,
+                  float32=float32)
+
+  num_em_iters = 0
+  trace = []
+  try:
+    while num_em_iters < max_em_iters:
+      new_pij, objective = Step(pij)
+      num_em_iters += 1
+      step = 1.0
+
+      dif = np.max(np.abs(new_pij - pij))
+      if accelerate and dif >= epsilon and num_em_iters + 2 <= max_em_iters:
+        p2, _ = Step(new_pij)
+        p, step = _SquaremStep(pij, new_pij, p2)
+        new_pij, new_objective = Step(p)
+        num_em_iters += 2
+        if not new_objective >= objective:  # also catches NaN
+          new_pij, step = p2, 1.0
+        dif = np.max(np.abs(new_pij - pij))
+
+      log('EM iteration %d, objective = %.10g, step = %g, dif = %e',
+          num_em_iters, objective, step, dif)
+      trace.append((objective, step))
+      pij = new_pij
+
+      if dif < epsilon:
+        log('Early EM termination: %e < %e', dif, epsilon)
+        break
+      if not np.all(np.isfinite(pij)):
+        log('EM estimate is not finite; stopping')
+        break
+  finally:
+    if pool:
+      pool.close()
+
+  return num_em_iters, pij, trace
+
+
+def RunMixedPrecisionEm(cond_prob, max_em_iters, epsilon=1e-6,
+                        tolerance=FLOAT32_TOLERANCE, starting_pij=None,
+                        **kwargs):
+  """Run EM with float32 products, and check the result in float64.
+
+  Store cond_prob as float32 (e.g. with AsFloat32()) to halve its memory and
+  bandwidth.  When EM stops, one float32 and one float64 EM step are taken
+  from the estimate.  If they differ by more than tolerance, or the estimate
+  isn't finite (e.g. a row sum underflowed), EM continues in float64 from the
+  float32 estimate, or from starting_pij if it isn't finite.  The float64
+  iterations only get what's left of max_em_iters.
+
+  Args:
+    cond_prob: numpy.ndarray or numpy.memmap of shape
+      (num_entries, entry_size)
+    tolerance: max absolute difference between the two steps
+    kwargs: passed to RunNumpyEm()
+
+  Returns:
+    (total number of EM iterations, pij, trace, whether EM fell back to
+    float64)
+  """
+  num_em_iters, pij, trace = RunNumpyEm(
+      cond_prob, max_em_iters, epsilon=epsilon, starting_pij=starting_pij,
+      float32=True, **kwargs)
+
+  dif = np.inf
+  if np.all(np.isfinite(pij)):
+    chunk_rows = kwargs.get('chunk_rows')
+    step32, _ = EmStep(cond_prob, pij, float32=True,
+                       chunk_rows=chunk_rows or FLOAT32_CHUNK_ROWS)
+    step64, _ = EmStep(cond_prob, pij,
+                       chunk_rows=chunk_rows or
+                       _DefaultChunkRows(cond_prob, False))
+    dif = np.max(np.abs(step32 - step64))
+    if dif <= tolerance:
+      log('float32 EM is within %e of float64 (%e)', tolerance, dif)
+      return num_em_iters, pij, trace, False
+  log('float32 EM differs from float64 by %e; continuing in float64', dif)
+
+  if not np.all(np.isfinite(pij)):
+    pij = starting_pij
+  more_iters, pij, more_trace = RunNumpyEm(
+      cond_prob, max(max_em_iters - num_em_iters, 0), epsilon=epsilon,
+      starting_pij=pij, **kwargs)
+  return num_em_iters + more_iters, pij, trace + more_trace, True
+
+
+def _PartialInformation(chunk, pij):
+  """sum_m outer(cond_prob[m], cond_prob[m]) / (cond_prob[m] . pij)^2"""
+  if isinstance(chunk, (SparseCondProb, FactorCondProb)):
+    chunk = chunk.ToDense()
+  with np.errstate(divide='ignore', invalid='ignore'):
+    w = chunk / chunk.dot(pij)[:, np.newaxis]
+  return w.T.dot(w)
+
+
+def ObservedInformation(cond_prob, pij, chunk_rows=None, pool=None):
+  """The observed information matrix of the estimate pij.
+
+  Like the inform matrix of ComputeVar() in analysis/R/association.R, but
+  with one matrix product per chunk of rows instead of an outer product per
+  report.
+
+  Args:
+    cond_prob: numpy.ndarray, numpy.memmap, SparseCondProb, or
+      FactorCondProb of shape (num_entries, entry_size)
+    pij: the estimate, a vector of length entry_size
+    chunk_rows: number of rows to sum at a time.  By default, chunks take
+      about MMAP_CHUNK_BYTES, so memory is bounded for a memmap too.
+    pool: as in EmStep()
+
+  Returns:
+    entry_size x entry_size matrix
+  """
+  num_entries, entry_size = cond_prob.shape
+  if chunk_rows is None:
+    chunk_rows = max(1, MMAP_CHUNK_BYTES // (8 * entry_size))
+
+  chunks = (cond_prob[start:start + chunk_rows]
+            for start in xrange(0, num_entries, chunk_rows))
+  if pool is None:
+    partials = (_PartialInformation(chunk, pij) for chunk in chunks)
+  else:
+    partials = pool.imap(lambda chunk: _PartialInformation(chunk, pij), chunks)
+
+  inform = np.zeros((entry_size, entry_size))
+  for partial in partials:
+    inform += partial
+  return inform
+
+
+def ComputeVar(cond_prob, pij, chunk_rows=None, pool=None):
+  """The variance of the estimate pij, like ComputeVar() in association.R.
+
+  Returns:
+    (var_cov, sd, inform).  var_cov is the inverse of the observed
+    information; if that is singular, e.g. because some entries of pij are
+    zero, it's the pseudo-inverse.
+  """
+  inform = ObservedInformation(cond_prob, pij, chunk_rows=chunk_rows,
+                               pool=pool)
+  try:
+    var_cov = np.linalg.inv(inform)
+  except np.linalg.LinAlgError:
+    log('Information matrix is singular; using the pseudo-inverse')
+    var_cov = np.linalg.pinv(inform)
+  sd = np.sqrt(np.abs(np.diag(var_cov)))
+  return var_cov, sd, inform
+
+
+# Exponent of the step size schedule of online EM.  It should be in (0.5, 1].
+ONLINE_STEP_DECAY = 0.6
+
+
+def RunOnlineEm(cond_prob, num_passes=1, batch_rows=10000,
+                step_decay=ONLINE_STEP_DECAY, starting_pij=None, rand=None):
+  """Run stochastic (online) EM over mini-batches of rows.
+
+  Batch EM sums over all the reports for each update of pij.  Online EM
+  updates pij after each mini-batch, using a running average of the
+  expected entry frequencies:
+
+    s <- (1 - g_t) s + g_t (mean of z_m over the mini-batch)
+    pij <- s
+
+  with step size g_t = (t + 1)^-step_decay for the t-th mini-batch, counting
+  from 0.  See Cappe and Moulines, "Online EM Algorithm for Latent Data
+  Models" (2009).
+
+  Only pij, s, and one mini-batch are in memory at a time, so cond_prob can be
+  a numpy.memmap larger than RAM.
+
+  Args:
+    cond_prob: numpy.ndarray, numpy.memmap, SparseCondProb, or
+      FactorCondProb of shape (num_entries, entry_size)
+    num_passes: number of passes over the rows
+    batch_rows: number of rows in a mini-batch
+    step_decay: exponent of the step size schedule, in (0.5, 1]
+    starting_pij: as in RunNumpyEm()
+    rand: If set, a numpy.random.RandomState to shuffle the order of the
+      mini-batches on each pass.  The rows of a mini-batch are always
+      contiguous, so the reports should not be sorted by value.
+
+  Returns:
+    (number of mini-batches, pij, trace), where trace is a list of
+    (objective of the mini-batch at the pij it started from, step size).
+  """
+  if not 0.5 < step_decay <= 1:
+    raise RuntimeError('step_decay should be in (0.5, 1], got %r' % step_decay)
+  num_entries, entry_size = cond_prob.shape
+  if starting_pij is None:
+    pij = np.ones(entry_size) / entry_size
+  else:
+    if len(starting_pij) != entry_size:
+      raise RuntimeError('Expected %d starting values, got %d' %
+                         (entry_size, len(starting_pij)))
+    pij = np.asarray(starting_pij, np.float64)
+
+  starts = np.arange(0, num_entries, batch_rows)
+  num_batches = 0
+  trace = []
+  for i in xrange(num_passes):
+    if rand is not None:
+      rand.shuffle(starts)
+    for start in starts:
+      chunk = cond_prob[start:start + batch_rows]
+      total, log_lik = _PartialSum(chunk, pij)
+      n = chunk.shape[0]
+
+      step = (num_batches + 1.0) ** -step_decay
+      # The running average s is pij itself, since the M-step is the identity.
+      pij = (1 - step) * pij + step * (pij * total / n)
+      pij /= pij.sum()  # correct rounding drift
+      num_batches += 1
+      trace.append((log_lik / n, step))
+
+    log('Online EM pass %d: %d mini-batches, objective of last = %.10g',
+        i + 1, num_batches, trace[-1][0])
+
+  return num_batches, pij, trace
+
+
+def WriteTrace(f, trace):
+  """Write the trace of RunNumpyEm as CSV."""
+  f.write('iteration,objective,step_size\n')
+  for i, (objective, step) in enumerate(trace):
+    f.write('%d,%r,%r\n' % (i + 1, objective, step))
+
+
+def _MaybeReadStartingPij(input_path, entry_size):
+  start_path = StartingPijPath(input_path)
+  if not os.path.exists(start_path):
+    return None
+  with open(start_path, 'rb') as f:
+    pij = ReadStartingPij(f, int(entry_size))
+  log('Starting from %s', start_path)
+  return pij
+
+
 def sep():
   print '-' * 80
 
 
 def main(argv):
-  input_path = argv[1]
-  output_path = argv[2]
-  max_em_iters = int(argv[3])
+  try:
+    input_path = argv[1]
+    output_path = argv[2]
+    max_em_iters = int(argv[3])
+  except (IndexError, ValueError):
+    raise RuntimeError(
+        'Usage: fast_em.py INPUT OUTPUT MAX_EM_ITERS '
+        '[numpy|mmap|online|tensorflow]')
+  engine = argv[4] if len(argv) > 4 else 'numpy'
+  try:
+    num_threads = int(os.getenv('FAST_EM_NUM_THREADS', '1'))
+  except ValueError:
+    raise RuntimeError('FAST_EM_NUM_THREADS should be an integer')
+  method = os.getenv('FAST_EM_METHOD', 'em')
+  if method not in ('em', 'squarem'):
+    raise RuntimeError('FAST_EM_METHOD should be em or squarem')
+  estimate_var = os.getenv('FAST_EM_ESTIMATE_VAR', '0') == '1'
+  output_version = os.getenv('FAST_EM_OUTPUT_VERSION', '1')
+  if output_version not in ('1', '2'):
+    raise RuntimeError('FAST_EM_OUTPUT_VERSION should be 1 or 2')
+  precision = os.getenv('FAST_EM_PRECISION', 'float64')
+  if precision not in ('float64', 'float32'):
+    raise RuntimeError('FAST_EM_PRECISION should be float64 or float32')
+  trace = None
+  var_cov = None
 
-  sep()
-  with open(input_path) as f:
-    num_entries, entry_size, cond_prob = ReadListOfMatrices(f)
+  def RunBatchEm(cond_prob, chunk_rows, starting_pij):
+    """The numpy and mmap engines."""
+    kwargs = dict(num_threads=num_threads, accelerate=(method == 'squarem'),
+                  starting_pij=starting_pij)
+    if precision == 'float32' and not isinstance(cond_prob, SparseCondProb):
+      # Small float32 chunks instead of the mmap engine's chunks.
+      num_em_iters, pij, trace, _ = RunMixedPrecisionEm(
+          cond_prob, max_em_iters, **kwargs)
+      return num_em_iters, pij, trace
+    return RunNumpyEm(cond_prob, max_em_iters, chunk_rows=chunk_rows,
+                      **kwargs)
 
   sep()
-  DebugSum(num_entries, entry_size, cond_prob)
+  if engine in ('mmap', 'online'):
+    cond_prob = LoadCondProb(input_path, mmap=True)
+    entry_size = cond_prob.shape[1]
+    starting_pij = _MaybeReadStartingPij(input_path, entry_size)
 
-  sep()
-  pij_in, em_iter_expr = BuildEmIter(num_entries, entry_size, cond_prob)
-  num_em_iters, pij = RunEm(pij_in, entry_size, em_iter_expr, max_em_iters)
+  if engine == 'online':
+    try:
+      batch_rows = int(os.getenv('FAST_EM_BATCH_ROWS', '10000'))
+    except ValueError:
+      raise RuntimeError('FAST_EM_BATCH_ROWS should be an integer')
+    try:
+      num_passes = int(os.getenv('FAST_EM_ONLINE_PASSES', '1'))
+    except ValueError:
+      num_passes = 0
+    if num_passes < 1:
+      raise RuntimeError('FAST_EM_ONLINE_PASSES should be a positive integer')
+    num_em_iters, pij, trace = RunOnlineEm(
+        cond_prob, num_passes=num_passes, batch_rows=batch_rows,
+        starting_pij=starting_pij, rand=np.random.RandomState(0))
+
+  elif engine == 'mmap':
+    chunk_rows = max(1, MMAP_CHUNK_BYTES // (8 * int(entry_size)))
+    num_em_iters, pij, trace = RunBatchEm(cond_prob, chunk_rows,
+                                          starting_pij)
+
+  elif engine == 'numpy':
+    if precision == 'float32' and not _IsSparse(input_path):
+      # Never hold the float64 matrix in memory.
+      cond_prob = AsFloat32(LoadCondProb(input_path, mmap=True))
+    else:
+      cond_prob = LoadCondProb(input_path)
+    num_em_iters, pij, trace = RunBatchEm(
+        cond_prob, None,
+        _MaybeReadStartingPij(input_path, cond_prob.shape[1]))
+
+  elif engine == 'tensorflow':
+    cond_prob = LoadCondProb(input_path)
+    if isinstance(cond_prob, SparseCondProb):
+      raise RuntimeError('The tensorflow engine only reads dense input')
+    num_entries, entry_size = cond_prob.shape
+    starting_pij = _MaybeReadStartingPij(input_path, entry_size)
+    v = cond_prob.astype(np.float64).ravel()
+
+    sep()
+    DebugSum(num_entries, entry_size, v)
+
+    sep()
+    pij_in, em_iter_expr = BuildEmIter(num_entries, entry_size, v)
+    num_em_iters, pij = RunEm(pij_in, entry_size, em_iter_expr,
+                              max_em_iters, starting_pij=starting_pij)
+
+  else:
+    raise RuntimeError('Invalid engine %r' % engine)
+
+  if estimate_var:
+    # One more pass over the input.
+    var_cov, _, _ = ComputeVar(cond_prob, pij)
 
   sep()
   log('Final Pij: %s', pij)
 
   with open(output_path, 'wb') as f:
-    WriteResult(f, num_em_iters, pij)
+    if output_version == '2':
+      WriteResultV2(f, num_em_iters, pij, var_cov=var_cov)
+    else:
+      WriteResult(f, num_em_iters, pij, var_cov=var_cov)
   log('Wrote %s', output_path)
 
+  if trace is not None:
+    trace_path = output_path + '.trace.csv'
+    with open(trace_path, 'w') as f:
+      WriteTrace(f, trace)
+    log('Wrote %s', trace_path)
+
 
 if __name__ == '__main__':
   try:
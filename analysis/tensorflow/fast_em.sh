@@ -16,7 +16,7 @@ fast-em() {
   # Never returns
   LD_LIBRARY_PATH=$LD_LIBRARY_PATH:/usr/local/cuda/lib64 \
   CUDA_HOME=/usr/local/cuda-7.0 \
-    exec $THIS_DIR/fast_em.py "$@"
+    exec $THIS_DIR/fast_em.py "$@" tensorflow
 }
 
 fast-em "$@"
@@ -0,0 +1,465 @@
+#!/usr/bin/python
+"""
+fast_em_test.py: Tests for the NumPy engine of fast_em.py
+"""
+
+import multiprocessing.pool
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import fast_em  # module under test
+
+
+def _WriteInput(f, cond_prob):
+  num_entries, entry_size = cond_prob.shape
+  fast_em.WriteTag(f, 'ne ')
+  np.array([num_entries], np.uint32).tofile(f)
+  fast_em.WriteTag(f, 'es ')
+  np.array([entry_size], np.uint32).tofile(f)
+  fast_em.WriteTag(f, 'dat')
+  cond_prob.astype(np.float64).tofile(f)
+
+
+def _SlowEmIter(cond_prob, pij):
+  """The iteration as written in fast_em.cc, one report at a time."""
+  new_pij = np.zeros(len(pij))
+  for row in cond_prob:
+    z = row * pij
+    new_pij += z / z.sum()
+  return new_pij / cond_prob.shape[0]
+
+
+class FastEmTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = np.random.RandomState(1)
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testEmIter(self):
+    cond_prob = self.rand.uniform(size=(50, 8))
+    pij = self.rand.uniform(size=8)
+    pij /= pij.sum()
+    np.testing.assert_allclose(_SlowEmIter(cond_prob, pij),
+                               fast_em.NumpyEmIter(cond_prob, pij))
+
+  def testRunNumpyEm(self):
+    # Every report favors the first pair.
+    cond_prob = self.rand.uniform(0.1, 1.0, size=(2000, 4))
+    cond_prob[:, 0] += 0.5
+
+    num_iters, pij, trace = fast_em.RunNumpyEm(cond_prob, 3)
+    self.assertEqual(3, len(trace))
+    self.assertEqual(3, num_iters)
+
+    num_iters, pij, trace = fast_em.RunNumpyEm(cond_prob, 10000)
+    self.assertTrue(num_iters < 10000)
+    self.assertAlmostEqual(1.0, pij.sum())
+    # A fixed point of the iteration.
+    np.testing.assert_allclose(pij, fast_em.NumpyEmIter(cond_prob, pij),
+                               atol=1e-5)
+    self.assertEqual(0, np.argmax(pij))
+
+    # EM never decreases the objective.
+    objectives = [objective for objective, _ in trace]
+    self.assertTrue(np.all(np.diff(objectives) >= -1e-12))
+    self.assertEqual(set([1.0]), set(step for _, step in trace))
+
+  def testSquarem(self):
+    # Sparse joint distribution, where plain EM converges slowly.
+    truth = np.array([0.7, 0.3, 0, 0, 0, 0])
+    cond_prob = self.rand.uniform(0.2, 1.0, size=(3000, 6))
+    cond_prob[:, :2] *= 1 + truth[:2]
+
+    em_iters, em_pij, _ = fast_em.RunNumpyEm(cond_prob, 5000)
+    num_iters, pij, trace = fast_em.RunNumpyEm(cond_prob, 5000,
+                                               accelerate=True)
+    self.assertTrue(num_iters < em_iters)
+    np.testing.assert_allclose(em_pij, pij, atol=1e-3)
+    self.assertAlmostEqual(1.0, pij.sum())
+    self.assertTrue(np.all(pij >= 0))
+
+    objectives = [objective for objective, _ in trace]
+    self.assertTrue(np.all(np.diff(objectives) >= -1e-12))
+    self.assertTrue(max(step for _, step in trace) > 1.0)
+
+  def testChunked(self):
+    cond_prob = self.rand.uniform(size=(103, 5))
+    path = os.path.join(self.tmp_dir, 'input.bin')
+    with open(path, 'wb') as f:
+      _WriteInput(f, cond_prob)
+
+    num_entries, entry_size, mapped = fast_em.MapListOfMatrices(path)
+    self.assertEqual((103, 5), (num_entries, entry_size))
+    np.testing.assert_array_equal(cond_prob, mapped)
+
+    expected = fast_em.RunNumpyEm(cond_prob, 20)
+    for chunk_rows in (1, 10, 103, 1000):
+      num_iters, pij, _ = fast_em.RunNumpyEm(mapped, 20,
+                                             chunk_rows=chunk_rows)
+      self.assertEqual(expected[0], num_iters)
+      np.testing.assert_allclose(expected[1], pij, rtol=1e-12)
+
+    # Threads give the same result, whether or not the rows are chunked.
+    for chunk_rows in (None, 7):
+      num_iters, pij, _ = fast_em.RunNumpyEm(mapped, 20, chunk_rows=chunk_rows,
+                                             num_threads=4)
+      self.assertEqual(expected[0], num_iters)
+      np.testing.assert_allclose(expected[1], pij, rtol=1e-12)
+
+    # Truncated file.
+    with open(path, 'r+b') as f:
+      f.truncate(100)
+    self.assertRaises(RuntimeError, fast_em.MapListOfMatrices, path)
+
+  def testSparse(self):
+    cond_prob = self.rand.uniform(size=(60, 8))
+    cond_prob[cond_prob < 0.5] = 0
+    cond_prob[7] = 0  # a row with no entries
+    sparse = fast_em.SparseCondProb.FromDense(cond_prob)
+    self.assertEqual((60, 8), sparse.shape)
+    self.assertEqual(np.count_nonzero(cond_prob), len(sparse.data))
+    np.testing.assert_array_equal(cond_prob, sparse.ToDense())
+    np.testing.assert_array_equal(cond_prob[10:20], sparse[10:20].ToDense())
+
+    pij = self.rand.uniform(size=8)
+    pij /= pij.sum()
+    dense_total, _ = fast_em._PartialSum(cond_prob[8:], pij)
+    sparse_total, _ = fast_em._PartialSum(sparse[8:], pij)
+    np.testing.assert_allclose(dense_total, sparse_total)
+
+    # Thresholding drops entries relative to the row max.
+    thresholded = fast_em.SparseCondProb.FromDense(cond_prob, threshold=0.9)
+    self.assertTrue(len(thresholded.data) < len(sparse.data))
+    self.assertTrue(np.all(thresholded.data > 0.9 * 0.5))
+
+    # Round trip through a file, read or mapped.
+    path = os.path.join(self.tmp_dir, 'sparse.bin')
+    with open(path, 'wb') as f:
+      fast_em.WriteSparseListOfMatrices(f, sparse[8:])
+    with open(path, 'rb') as f:
+      read = fast_em.ReadSparseListOfMatrices(f)
+    mapped = fast_em.MapSparseListOfMatrices(path)
+
+    expected = fast_em.RunNumpyEm(cond_prob[8:], 20)
+    for cp, chunk_rows in ((read, None), (mapped, 7)):
+      num_iters, pij, _ = fast_em.RunNumpyEm(cp, 20, chunk_rows=chunk_rows)
+      self.assertEqual(expected[0], num_iters)
+      np.testing.assert_allclose(expected[1], pij, rtol=1e-12)
+
+  def testOnlineEm(self):
+    truth = np.array([0.5, 0.3, 0.15, 0.05])
+    cond_prob = self.rand.uniform(size=(20000, 4))
+    values = self.rand.choice(4, size=20000, p=truth)
+    cond_prob[np.arange(20000), values] += 3
+
+    _, batch_pij, _ = fast_em.RunNumpyEm(cond_prob, 1000)
+    num_batches, online_pij, trace = fast_em.RunOnlineEm(
+        cond_prob, num_passes=2, batch_rows=500,
+        rand=np.random.RandomState(1))
+    self.assertEqual(80, num_batches)
+    self.assertEqual(80, len(trace))
+    self.assertEqual(1.0, trace[0][1])  # the first step replaces pij
+    self.assertAlmostEqual(1.0, online_pij.sum())
+    np.testing.assert_allclose(batch_pij, online_pij, atol=0.02)
+
+    # Sparse input gives the same result.
+    _, sparse_pij, _ = fast_em.RunOnlineEm(
+        fast_em.SparseCondProb.FromDense(cond_prob), num_passes=2,
+        batch_rows=500, rand=np.random.RandomState(1))
+    np.testing.assert_allclose(online_pij, sparse_pij)
+
+    self.assertRaises(RuntimeError, fast_em.RunOnlineEm, cond_prob,
+                      step_decay=0.5)
+
+  def testFactored(self):
+    factors = [self.rand.uniform(size=(30, 2)),
+               self.rand.uniform(size=(30, 3)),
+               self.rand.uniform(size=(30, 4))]
+    factored = fast_em.FactorCondProb(factors)
+    self.assertEqual((30, 24), factored.shape)
+    dense = factored.ToDense()
+    # The first variable varies fastest, as in UpdateJointConditional().
+    for m in xrange(30):
+      expected = np.einsum('i,j,k->ijk', *[f[m] for f in factors])
+      np.testing.assert_allclose(expected.ravel(order='F'), dense[m])
+
+    pij = self.rand.uniform(size=24)
+    pij /= pij.sum()
+    for actual, expected in zip(fast_em.EmStep(factored, pij),
+                                fast_em.EmStep(dense, pij)):
+      np.testing.assert_allclose(expected, actual)
+    # Chunks are slices of the factors.
+    np.testing.assert_allclose(
+        fast_em.EmStep(dense, pij, chunk_rows=7)[0],
+        fast_em.EmStep(factored, pij, chunk_rows=7)[0])
+
+    _, expected, _ = fast_em.RunNumpyEm(dense, 50)
+    _, actual, _ = fast_em.RunNumpyEm(factored, 50)
+    np.testing.assert_allclose(expected, actual)
+
+  def testComputeVar(self):
+    cond_prob = self.rand.uniform(size=(50, 3))
+    pij = np.array([0.5, 0.3, 0.2])
+
+    # ComputeVar() in association.R, one report at a time.
+    expected = sum(np.outer(x, x) / x.dot(pij) ** 2 for x in cond_prob)
+    inform = fast_em.ObservedInformation(cond_prob, pij)
+    np.testing.assert_allclose(expected, inform)
+    # In chunks, on threads, and sparse.
+    pool = multiprocessing.pool.ThreadPool(2)
+    np.testing.assert_allclose(
+        expected, fast_em.ObservedInformation(cond_prob, pij, chunk_rows=7,
+                                              pool=pool))
+    pool.close()
+    np.testing.assert_allclose(
+        expected, fast_em.ObservedInformation(
+            fast_em.SparseCondProb.FromDense(cond_prob), pij, chunk_rows=7))
+
+    var_cov, sd, _ = fast_em.ComputeVar(cond_prob, pij)
+    np.testing.assert_allclose(np.linalg.inv(expected), var_cov)
+    np.testing.assert_allclose(np.sqrt(np.diag(var_cov)), sd)
+
+    # With no noise, the information matrix is diagonal, with count / pij^2.
+    cond_prob = np.zeros((100, 3))
+    cond_prob[np.arange(100), np.arange(100) % 3] = 1
+    pij = np.array([34, 33, 33]) / 100.0
+    var_cov, _, _ = fast_em.ComputeVar(cond_prob, pij)
+    np.testing.assert_allclose(np.diag(pij ** 2 / [34, 33, 33]), var_cov)
+
+  def testMain(self):
+    cond_prob = self.rand.uniform(size=(20, 6))
+    input_path = os.path.join(self.tmp_dir, 'input.bin')
+    output_path = os.path.join(self.tmp_dir, 'pij.bin')
+    with open(input_path, 'wb') as f:
+      _WriteInput(f, cond_prob)
+
+    fast_em.main(['fast_em.py', input_path, output_path, '5'])
+
+    with open(output_path, 'rb') as f:
+      fast_em.ExpectTag(f, 'emi\0')
+      self.assertEqual(5, np.fromfile(f, np.uint32, count=1)[0])
+      fast_em.ExpectTag(f, 'pij\0')
+      pij = np.fromfile(f, np.float64)
+    _, expected, _ = fast_em.RunNumpyEm(cond_prob, 5)
+    np.testing.assert_allclose(expected, pij)
+
+    with open(output_path + '.trace.csv') as f:
+      lines = f.readlines()
+    self.assertEqual('iteration,objective,step_size\n', lines[0])
+    self.assertEqual(6, len(lines))
+
+    # The mmap engine gives the same result.
+    fast_em.main(['fast_em.py', input_path, output_path, '5', 'mmap'])
+    with open(output_path, 'rb') as f:
+      f.seek(8)  # emi
+      fast_em.ExpectTag(f, 'pij\0')
+      np.testing.assert_allclose(expected, np.fromfile(f, np.float64))
+
+    os.environ['FAST_EM_ESTIMATE_VAR'] = '1'
+    try:
+      fast_em.main(['fast_em.py', input_path, output_path, '5'])
+    finally:
+      del os.environ['FAST_EM_ESTIMATE_VAR']
+    with open(output_path, 'rb') as f:
+      f.seek(8)  # emi
+      fast_em.ExpectTag(f, 'pij\0')
+      pij = np.fromfile(f, np.float64, count=6)
+      fast_em.ExpectTag(f, 'var\0')
+      var_cov = np.fromfile(f, np.float64)
+    np.testing.assert_allclose(
+        fast_em.ComputeVar(cond_prob, pij)[0].ravel(), var_cov)
+
+    # The online engine makes one pass by default, whatever MAX_EM_ITERS is.
+    os.environ['FAST_EM_BATCH_ROWS'] = '8'
+    try:
+      fast_em.main(['fast_em.py', input_path, output_path, '1000', 'online'])
+      with open(output_path, 'rb') as f:
+        fast_em.ExpectTag(f, 'emi\0')
+        self.assertEqual(3, np.fromfile(f, np.uint32, count=1)[0])
+
+      os.environ['FAST_EM_ONLINE_PASSES'] = '2'
+      fast_em.main(['fast_em.py', input_path, output_path, '1000', 'online'])
+      with open(output_path, 'rb') as f:
+        fast_em.ExpectTag(f, 'emi\0')
+        self.assertEqual(6, np.fromfile(f, np.uint32, count=1)[0])
+
+      os.environ['FAST_EM_ONLINE_PASSES'] = '0'
+      self.assertRaises(RuntimeError, fast_em.main,
+                        ['fast_em.py', input_path, output_path, '1000',
+                         'online'])
+    finally:
+      del os.environ['FAST_EM_BATCH_ROWS']
+      os.environ.pop('FAST_EM_ONLINE_PASSES', None)
+
+    self.assertRaises(RuntimeError, fast_em.main,
+                      ['fast_em.py', input_path, output_path, '5', 'R'])
+
+  def testMixedPrecision(self):
+    truth = np.array([0.5, 0.3, 0.15, 0.05])
+    cond_prob = self.rand.uniform(size=(3000, 4))
+    values = self.rand.choice(4, size=3000, p=truth)
+    cond_prob[np.arange(3000), values] += 3
+
+    _, expected, _ = fast_em.RunNumpyEm(cond_prob, 1000)
+    cond_prob32 = fast_em.AsFloat32(cond_prob)
+    self.assertEqual(np.float32, cond_prob32.dtype)
+    _, pij, _, fell_back = fast_em.RunMixedPrecisionEm(
+        cond_prob32, 1000, chunk_rows=1000)
+    self.assertFalse(fell_back)
+    np.testing.assert_allclose(expected, pij, atol=1e-5)
+
+    # Force the fallback.  float64 EM continues from the float32 estimate,
+    # within the same iteration budget.
+    num_iters32, _, _ = fast_em.RunNumpyEm(cond_prob32, 1000, float32=True,
+                                           chunk_rows=1000)
+    num_iters, pij, trace, fell_back = fast_em.RunMixedPrecisionEm(
+        cond_prob32, 1000, tolerance=0, chunk_rows=1000)
+    self.assertTrue(fell_back)
+    self.assertEqual(num_iters, len(trace))
+    self.assertLess(num_iters - num_iters32, num_iters32)
+    np.testing.assert_allclose(expected, pij, atol=1e-5)
+
+    num_iters, _, _, fell_back = fast_em.RunMixedPrecisionEm(
+        cond_prob32, num_iters32, tolerance=0, chunk_rows=1000)
+    self.assertTrue(fell_back)
+    self.assertEqual(num_iters32, num_iters)
+
+    # The rows underflow in float32, but not in float64.  float32 EM stops at
+    # the first estimate that isn't finite.
+    tiny = cond_prob * 1e-42
+    num_iters64, expected, _ = fast_em.RunNumpyEm(tiny, 1000)
+    num_iters, pij, _, fell_back = fast_em.RunMixedPrecisionEm(tiny, 1000)
+    self.assertTrue(fell_back)
+    self.assertEqual(num_iters64 + 1, num_iters)
+    np.testing.assert_allclose(expected, pij)
+
+    # main() with a float32 input.
+    input_path = os.path.join(self.tmp_dir, 'input.bin')
+    output_path = os.path.join(self.tmp_dir, 'pij.bin')
+    with open(input_path, 'wb') as f:
+      fast_em.WriteListOfMatricesV2(f, cond_prob, dtype=np.float32)
+    os.environ['FAST_EM_PRECISION'] = 'float32'
+    try:
+      fast_em.main(['fast_em.py', input_path, output_path, '1000'])
+    finally:
+      del os.environ['FAST_EM_PRECISION']
+    with open(output_path, 'rb') as f:
+      _, pij, _ = fast_em.ReadResult(f)
+    _, expected, _ = fast_em.RunNumpyEm(cond_prob, 1000)
+    np.testing.assert_allclose(expected, pij, atol=1e-5)
+
+  def testFormatV2(self):
+    cond_prob = self.rand.uniform(size=(30, 10))
+    path = os.path.join(self.tmp_dir, 'input.bin')
+    with open(path, 'wb') as f:
+      fast_em.WriteListOfMatricesV2(f, cond_prob, dims=(2, 5))
+
+    with open(path, 'rb') as f:
+      h, actual = fast_em.ReadV2(f)
+    self.assertEqual(2, h['version'])
+    self.assertEqual((2, 5), fast_em.V2Dims(h))
+    self.assertEqual(0, h['data_offset'] % fast_em.V2_ALIGNMENT)
+    np.testing.assert_array_equal(cond_prob, actual)
+
+    h, mapped = fast_em.MapV2(path, verify=True)
+    self.assertTrue(isinstance(mapped, np.memmap))
+    np.testing.assert_array_equal(cond_prob, mapped)
+    del mapped
+
+    # A flipped bit is detected in the data, and in the header.
+    with open(path, 'r+b') as f:
+      f.seek(-1, os.SEEK_END)
+      last = f.read(1)
+      f.seek(-1, os.SEEK_END)
+      f.write(chr(ord(last) ^ 1))
+    with open(path, 'rb') as f:
+      self.assertRaises(RuntimeError, fast_em.ReadV2, f)
+    with open(path, 'r+b') as f:
+      f.seek(20)
+      f.write('\x01')
+    self.assertRaises(RuntimeError, fast_em.MapV2, path)
+
+    # float32 storage, read by all the engines.
+    with open(path, 'wb') as f:
+      fast_em.WriteListOfMatricesV2(f, cond_prob, dtype=np.float32)
+    self.assertEqual(np.float32, fast_em.LoadCondProb(path, mmap=True).dtype)
+    _, expected, _ = fast_em.RunNumpyEm(cond_prob.astype(np.float32), 5)
+    output_path = os.path.join(self.tmp_dir, 'pij.bin')
+    for engine in ('numpy', 'mmap'):
+      fast_em.main(['fast_em.py', path, output_path, '5', engine])
+      with open(output_path, 'rb') as f:
+        num_em_iters, pij, var_cov = fast_em.ReadResult(f)
+      self.assertEqual(5, num_em_iters)
+      self.assertEqual(None, var_cov)
+      np.testing.assert_allclose(expected, pij)
+
+    # v1 input, v2 output.
+    v1_path = os.path.join(self.tmp_dir, 'input-v1.bin')
+    with open(v1_path, 'wb') as f:
+      _WriteInput(f, cond_prob)
+    np.testing.assert_array_equal(cond_prob, fast_em.LoadCondProb(v1_path))
+    os.environ['FAST_EM_OUTPUT_VERSION'] = '2'
+    os.environ['FAST_EM_ESTIMATE_VAR'] = '1'
+    try:
+      fast_em.main(['fast_em.py', v1_path, output_path, '5'])
+    finally:
+      del os.environ['FAST_EM_OUTPUT_VERSION']
+      del os.environ['FAST_EM_ESTIMATE_VAR']
+    with open(output_path, 'rb') as f:
+      num_em_iters, pij, var_cov = fast_em.ReadResult(f)
+    self.assertEqual(5, num_em_iters)
+    self.assertEqual((10, 10), var_cov.shape)
+
+    # ReadResult() reads v1 results with and without the variance.
+    for v in (None, var_cov):
+      with open(output_path, 'wb') as f:
+        fast_em.WriteResult(f, 5, pij, var_cov=v)
+      with open(output_path, 'rb') as f:
+        actual = fast_em.ReadResult(f)
+      self.assertEqual(5, actual[0])
+      np.testing.assert_array_equal(pij, actual[1])
+      if v is None:
+        self.assertEqual(None, actual[2])
+      else:
+        np.testing.assert_array_equal(v, actual[2])
+
+  def testStartingPij(self):
+    truth = np.array([0.5, 0.3, 0.15, 0.05])
+    cond_prob = self.rand.uniform(size=(2000, 4))
+    # Make the reports informative about their value.
+    values = self.rand.choice(4, size=2000, p=truth)
+    cond_prob[np.arange(2000), values] += 3
+
+    cold_iters, cold_pij, _ = fast_em.RunNumpyEm(cond_prob, 1000)
+    # Starting near the answer takes fewer iterations to the same answer.
+    start = 0.9 * cold_pij + 0.1 / 4
+    warm_iters, warm_pij, _ = fast_em.RunNumpyEm(cond_prob, 1000,
+                                                 starting_pij=start)
+    self.assertTrue(warm_iters < cold_iters)
+    np.testing.assert_allclose(cold_pij, warm_pij, atol=1e-4)
+
+    self.assertRaises(RuntimeError, fast_em.RunNumpyEm, cond_prob, 10,
+                      starting_pij=start[:3])
+
+    # main() reads INPUT.start.bin.
+    input_path = os.path.join(self.tmp_dir, 'input.bin')
+    output_path = os.path.join(self.tmp_dir, 'pij.bin')
+    with open(input_path, 'wb') as f:
+      _WriteInput(f, cond_prob)
+    with open(fast_em.StartingPijPath(input_path), 'wb') as f:
+      fast_em.WriteStartingPij(f, 2 * start)  # normalized when read
+    fast_em.main(['fast_em.py', input_path, output_path, '1000'])
+    with open(output_path, 'rb') as f:
+      fast_em.ExpectTag(f, 'emi\0')
+      self.assertEqual(warm_iters, np.fromfile(f, np.uint32, count=1)[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
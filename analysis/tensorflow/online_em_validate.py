@@ -0,0 +1,185 @@
+#!/usr/bin/python
+"""
+online_em_validate.py: Compare online EM with batch EM on simulated reports.
+
+The simulation follows SamplePopulations() in analysis/R/association_test.R:
+the string variable is Poisson(1) + 1, and the boolean depends on it.  The
+reports are encoded with RAPPOR, and the conditional probabilities are
+computed with analysis/python/assoc.py against a map of all the strings, so
+no marginal is decoded.
+
+Usage:
+  PYTHONPATH=../python:../../client/python ./online_em_validate.py [options]
+
+Prints a CSV row per run, with the distance of its estimate from batch EM and
+from the true joint distribution.  The 'online+batch' rows run batch EM
+starting from the online estimate.
+"""
+
+import csv
+import optparse
+import sys
+import time
+
+import numpy as np
+
+import assoc
+import decode
+import fast_em
+import lasso
+import rappor
+
+
+def CreateOptionsParser():
+  p = optparse.OptionParser()
+
+  p.add_option(
+      '--num-reports', dest='num_reports', type='int', default=100000,
+      help='Number of reports to simulate')
+  p.add_option(
+      '--num-bits', dest='num_bits', type='int', default=32,
+      help='Number of Bloom filter bits (k)')
+  p.add_option(
+      '--num-hashes', dest='num_hashes', type='int', default=2,
+      help='Number of hashes (h)')
+  p.add_option(
+      '--num-cohorts', dest='num_cohorts', type='int', default=16,
+      help='Number of cohorts (m)')
+  p.add_option('-p', dest='prob_p', type='float', default=0.25)
+  p.add_option('-q', dest='prob_q', type='float', default=0.75)
+  p.add_option('-f', dest='prob_f', type='float', default=0.5)
+  p.add_option(
+      '--batch-rows', dest='batch_rows', type='int', default=10000,
+      help='Number of reports in a mini-batch of online EM')
+  p.add_option(
+      '--passes', dest='passes', default='1,2,5',
+      help='Comma-separated numbers of passes of online EM to run')
+  p.add_option(
+      '--max-em-iters', dest='max_em_iters', type='int', default=1000,
+      help='Maximum number of iterations of batch EM')
+  p.add_option(
+      '--random-seed', dest='random_seed', type='int', default=None,
+      help='Seed for the simulation')
+
+  return p
+
+
+def SamplePopulation(num_reports, num_cohorts, rand):
+  """Like SamplePopulations() with deterministic = FALSE.
+
+  Returns:
+    (0-based cohorts, 0-based string values, boolean values)
+  """
+  cohorts = rand.randint(0, num_cohorts, size=num_reports)
+  values = rand.poisson(1, size=num_reports)
+  # The boolean is more likely to be TRUE for the common strings.
+  bools = rand.uniform(size=num_reports) < 1.0 / (values + 1)
+  return cohorts, values, bools
+
+
+def CreateMap(params, num_strings, rand):
+  """A map with random Bloom filter bits for each string and cohort."""
+  m, k = params.num_cohorts, params.num_bloombits
+  columns = [
+      (np.arange(m)[:, None] * k +
+       rand.randint(0, k, size=(m, params.num_hashes))).ravel()
+      for _ in xrange(num_strings)]
+  return lasso.ColumnSparseMatrix.FromColumns(m * k, columns)
+
+
+def Encode(params, bloom, rand):
+  """The IRR bits of Bloom filters, with the probabilities of
+  decode._ReportProbs()."""
+  qstar, pstar = decode._ReportProbs(params)
+  return rand.uniform(size=bloom.shape) < np.where(bloom, qstar, pstar)
+
+
+def Simulate(params, num_reports, rand):
+  """Simulate string x boolean reports.
+
+  Returns:
+    (N x 2S joint conditional probabilities, true joint distribution of
+    length 2S)
+  """
+  m, k = params.num_cohorts, params.num_bloombits
+  cohorts, values, bools = SamplePopulation(num_reports, m, rand)
+  num_strings = values.max() + 1
+  X = CreateMap(params, num_strings, rand)
+
+  bloom = np.zeros((num_reports, k), dtype=bool)
+  for j in xrange(num_strings):
+    rows = np.flatnonzero(values == j)
+    column = X.Column(j)
+    for c in xrange(m):
+      in_cohort = rows[cohorts[rows] == c]
+      bits = column[column // k == c] % k
+      bloom[np.ix_(in_cohort, bits)] = True
+
+  string_bits = Encode(params, bloom, rand)
+  string_cp = assoc.StringCondProbs(params, cohorts, string_bits, X)
+  bool_bits = Encode(params, bools[:, None], rand)
+  bool_cp = assoc.BooleanCondProbs(params, bool_bits)
+  joint = assoc.JointCondProbs([bool_cp, string_cp])
+
+  # The boolean varies fastest, with TRUE first.
+  truth = np.bincount(values * 2 + (1 - bools), minlength=2 * num_strings)
+  return joint, truth / float(num_reports)
+
+
+def main(argv):
+  (opts, argv) = CreateOptionsParser().parse_args(argv)
+  rand = np.random.RandomState(opts.random_seed)
+
+  params = rappor.Params()
+  params.num_bloombits = opts.num_bits
+  params.num_hashes = opts.num_hashes
+  params.num_cohorts = opts.num_cohorts
+  params.prob_p = opts.prob_p
+  params.prob_q = opts.prob_q
+  params.prob_f = opts.prob_f
+
+  joint, truth = Simulate(params, opts.num_reports, rand)
+  fast_em.log('Simulated %d reports x %d entries', *joint.shape)
+
+  out = csv.writer(sys.stdout)
+  out.writerow(('method', 'passes', 'updates', 'seconds', 'max_dif_batch',
+                'max_dif_truth', 'objective'))
+
+  start_time = time.time()
+  num_em_iters, batch_pij, _ = fast_em.RunNumpyEm(joint, opts.max_em_iters)
+  elapsed = time.time() - start_time
+  objective = fast_em.EmStep(joint, batch_pij)[1]
+  out.writerow(('batch', num_em_iters, num_em_iters, '%.3f' % elapsed, 0.0,
+                '%.5f' % np.max(np.abs(batch_pij - truth)),
+                '%.8f' % objective))
+
+  for passes in [int(s) for s in opts.passes.split(',')]:
+    start_time = time.time()
+    num_batches, pij, _ = fast_em.RunOnlineEm(
+        joint, num_passes=passes, batch_rows=opts.batch_rows,
+        rand=np.random.RandomState(opts.random_seed))
+    elapsed = time.time() - start_time
+    objective = fast_em.EmStep(joint, pij)[1]
+    out.writerow(('online', passes, num_batches, '%.3f' % elapsed,
+                  '%.5f' % np.max(np.abs(pij - batch_pij)),
+                  '%.5f' % np.max(np.abs(pij - truth)),
+                  '%.8f' % objective))
+
+    # Online EM as a warm start for batch EM.
+    num_em_iters, pij, _ = fast_em.RunNumpyEm(joint, opts.max_em_iters,
+                                              starting_pij=pij)
+    elapsed = time.time() - start_time
+    objective = fast_em.EmStep(joint, pij)[1]
+    out.writerow(('online+batch', passes, num_batches + num_em_iters,
+                  '%.3f' % elapsed,
+                  '%.5f' % np.max(np.abs(pij - batch_pij)),
+                  '%.5f' % np.max(np.abs(pij - truth)),
+                  '%.8f' % objective))
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError, e:
+    print >>sys.stderr, 'FATAL: %s' % e
+    sys.exit(1)
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+"""
+Decode every (string, boolean) pair of a metric's reports in one process.
+
+Reads task specs on stdin, in the format printed by 'task_spec.py assoc':
+
+  num_reports metric_name date reports var1 var2 map1 output_dir
+  [prev_task_dir]
+
+The last field is printed by 'task_spec.py assoc --prior-base-dir'.  If
+prev_task_dir has an assoc-results.csv, EM starts from it.
+
+Tasks with the same reports file, string variable, and map share their work:
+the reports file is parsed once, and the string variable's marginal and
+conditional probabilities are computed once.  Then EM is run for each boolean
+partner, as in decode_assoc_numpy.py.  var2 may be comma-separated booleans,
+as printed by 'task_spec.py assoc --assoc-num-vars'.
+
+Like 'assoc.sh decode-one', each output_dir gets assoc-spec.txt,
+assoc-log.txt, assoc-status.txt, assoc-results.csv, and assoc-metrics.json.
+
+Unlike decode_assoc.R, which decodes each pair on its own, the string marginal
+is decoded from every report with a string value, and the reports sample is
+drawn once for all pairs.  Rows with a blank boolean value are removed for
+that pair only.
+"""
+
+import collections
+import optparse
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import assoc
+import decode
+import decode_assoc_numpy
+import rappor
+
+
+def CreateOptionsParser():
+  p = optparse.OptionParser()
+
+  p.add_option(
+      '--schema', dest='schema', default='',
+      help='CSV file with variable types and metadata (required)')
+  p.add_option(
+      '--params-dir', dest='params_dir', default='',
+      help='Directory where parameter CSV files are stored (required)')
+  p.add_option(
+      '--spec-prefix', dest='spec_prefix', default='- - - - -',
+      help='Job constants to write before the task spec in assoc-spec.txt, '
+           'as assoc.sh decode-one does.')
+  decode_assoc_numpy.AddEmOptions(p)
+
+  return p
+
+
+def _WriteFile(path, contents):
+  with open(path, 'w') as f:
+    f.write(contents)
+
+
+def _WriteStatus(output_dir, status, log_lines):
+  _WriteFile(os.path.join(output_dir, 'assoc-log.txt'),
+             '\n'.join(log_lines) + '\n')
+  _WriteFile(os.path.join(output_dir, 'assoc-status.txt'), status + '\n')
+
+
+def _DecodeGroup(key, pairs, schema, opts, rand):
+  """Decode the pairs of one (metric, date, reports, var1, map1) group.
+
+  Args:
+    pairs: list of (var2, output_dir, prev_task_dir)
+  """
+  start_time = time.time()
+  metric_name, _, reports_path, var1, map1 = key
+
+  params_names = set(
+      decode_assoc_numpy.PairParamsName(schema, metric_name, var1, var2)
+      for var2, _, _ in pairs)
+  if len(params_names) != 1:
+    raise RuntimeError('Pairs of %s have different params' % var1)
+  params_path = os.path.join(opts.params_dir, params_names.pop() + '.csv')
+  with open(params_path) as f:
+    params = rappor.Params.from_csv(f)
+  with open(map1) as f:
+    strings, X = decode.ReadMapFile(f, params)
+
+  # var2 may be comma-separated booleans.  Read each column once.
+  bool_vars = []
+  for var2, _, _ in pairs:
+    bool_vars.extend(v for v in var2.split(',') if v not in bool_vars)
+  with open(reports_path) as f:
+    cohorts, values = assoc.ReadReportsColumns(f, [var1] + bool_vars)
+  bool_values = dict(zip(bool_vars, values[1:]))
+
+  # Reports with a string value.
+  rows = np.flatnonzero(assoc.NonBlank(values[0]))
+  N = len(rows)
+  if N == 0:
+    for _, output_dir, _ in pairs:
+      _WriteStatus(output_dir, 'SKIPPED by child process',
+                   ['No reports with a value of %s' % var1])
+    return
+
+  if opts.reports_sample_size != -1 and N > opts.reports_sample_size:
+    rows = np.sort(rand.choice(rows, opts.reports_sample_size, replace=False))
+
+  # Hack for Chrome: like AdjustCounts in decode_dist.R.
+  cohorts = cohorts[rows] % params.num_cohorts
+  string_bits = assoc.BitMatrix([values[0][i] for i in rows],
+                                params.num_bloombits)
+  string_cp, found = assoc.DecodeStringVar(params, strings, X, cohorts,
+                                           string_bits, rand=rand)
+  shared_elapsed_time = time.time() - start_time
+
+  for var2, output_dir, prev_task_dir in pairs:
+    pair_start_time = time.time()
+    pair_values = [[bool_values[v][i] for i in rows] for v in var2.split(',')]
+    non_blank = np.ones(len(rows), dtype=bool)
+    for v in pair_values:
+      non_blank &= assoc.NonBlank(v)
+    keep = np.flatnonzero(non_blank)
+    log_lines = ['Decoded %s with %d other pairs' % (var1, len(pairs) - 1),
+                 'Removed %d rows with a blank %s' %
+                 (len(rows) - len(keep), var2)]
+    if len(keep) == 0:
+      _WriteStatus(output_dir, 'SKIPPED by child process', log_lines)
+      continue
+
+    cond_probs = [
+        assoc.BooleanCondProbs(params, assoc.BitMatrix([v[i] for i in keep], 1))
+        for v in pair_values]
+    cond_probs.append(string_cp[keep])
+    prior_results = ''
+    if prev_task_dir != '-':
+      prior_results = os.path.join(prev_task_dir, 'assoc-results.csv')
+    starting_pij, skipped = decode_assoc_numpy.ReadPairWarmStart(
+        prior_results, found, len(pair_values))
+    fit, sd, metrics = decode_assoc_numpy.RunEm(cond_probs, opts,
+                                                starting_pij=starting_pij)
+    if skipped:
+      metrics['warm_start_skipped'] = skipped
+      log_lines.append('Ignored %s: %s' % (prior_results, skipped))
+    decode_assoc_numpy.WriteAssocResults(fit, found, var1, var2, output_dir,
+                                         sd=sd)
+
+    metrics['num_reports'] = N
+    metrics['reports_sample_size'] = opts.reports_sample_size
+    metrics['total_elapsed_time'] = (
+        shared_elapsed_time + time.time() - pair_start_time)
+    decode_assoc_numpy.WriteMetrics(metrics, output_dir)
+
+    log_lines.append('EM iterations: %d (warm start: %s)' %
+                     (metrics['num_em_iters'], metrics['warm_start']))
+    _WriteStatus(output_dir, 'OK', log_lines)
+
+
+def main(argv):
+  (opts, argv) = CreateOptionsParser().parse_args(argv)
+  if not opts.schema:
+    raise RuntimeError('--schema is required')
+  if not opts.params_dir:
+    raise RuntimeError('--params-dir is required')
+
+  with open(opts.schema) as f:
+    schema = decode_assoc_numpy.ReadSchema(f)
+  rand = np.random.RandomState(opts.random_seed)
+
+  # (metric, date, reports, var1, map1) -> list of (var2, output_dir,
+  # prev_task_dir).  Keep the order of the input.
+  groups = collections.OrderedDict()
+  for line in sys.stdin:
+    spec = line.split()
+    if not spec:
+      continue
+    if len(spec) not in (8, 9):
+      raise RuntimeError('Expected 8 or 9 fields in task spec, got %r' % line)
+    (_, metric_name, date, reports_path, var1, var2, map1,
+     output_dir) = spec[:8]
+    prev_task_dir = spec[8] if len(spec) == 9 else '-'
+
+    if not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+    # Output the spec for combine_status.py.
+    _WriteFile(os.path.join(output_dir, 'assoc-spec.txt'),
+               '%s %s\n' % (opts.spec_prefix, ' '.join(spec)))
+
+    key = (metric_name, date, reports_path, var1, map1)
+    groups.setdefault(key, []).append((var2, output_dir, prev_task_dir))
+
+  for key, pairs in groups.iteritems():
+    print >>sys.stderr, 'Decoding %d pairs of %s %s' % (len(pairs), key[0],
+                                                       key[3])
+    try:
+      _DecodeGroup(key, pairs, schema, opts, rand)
+    except Exception:
+      # One bad group shouldn't stop the others.
+      trace = traceback.format_exc()
+      print >>sys.stderr, trace
+      for _, output_dir, _ in pairs:
+        _WriteStatus(output_dir, 'FAIL with status 1', [trace])
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError, e:
+    print >>sys.stderr, e.args[0]
+    sys.exit(1)
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+"""
+Decode the joint distribution of a string and a boolean variable with NumPy.
+
+This is a drop-in replacement for decode_assoc.R, with the same flags and
+output files.  The conditional probabilities of the reports are computed with
+analysis/python/assoc.py, and EM is run in memory with the NumPy engine of
+analysis/tensorflow/fast_em.py, so there is no temp file to write and read.
+
+--var2 may be a comma-separated list of booleans, for the N-way joint
+distribution of the string and all of them.  assoc-results.csv then has a
+column for each boolean, and the first one varies fastest.  EM on more than 2
+variables keeps the per-variable conditional probabilities, and never
+materializes the joint matrix (see fast_em.FactorCondProb).
+
+--em-executable and --tmp-dir are accepted, and ignored.
+"""
+
+import csv
+import itertools
+import json
+import optparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import assoc
+import decode
+import fast_em
+import rappor
+
+
+def AddEmOptions(p):
+  """Options shared with decode_assoc_batch.py."""
+  p.add_option(
+      '--reports-sample-size', dest='reports_sample_size', type='int',
+      default=-1,
+      help='Only analyze a random sample of this size.')
+  p.add_option(
+      '--max-em-iters', dest='max_em_iters', type='int', default=1000,
+      help='Maximum number of EM iterations')
+  p.add_option(
+      '--num-threads', dest='num_threads', type='int', default=1,
+      help='Number of threads for EM.')
+  p.add_option(
+      '--accelerate', dest='accelerate', default=False, action='store_true',
+      help='Accelerate EM with SQUAREM.')
+  p.add_option(
+      '--online-em-passes', dest='online_em_passes', type='int', default=0,
+      help='If set, run online EM over mini-batches of reports, with this '
+           'many passes, instead of batch EM.  --max-em-iters and '
+           '--accelerate are ignored.')
+  p.add_option(
+      '--online-batch-rows', dest='online_batch_rows', type='int',
+      default=10000,
+      help='Number of reports in a mini-batch of online EM.')
+  p.add_option(
+      '--sparse-threshold', dest='sparse_threshold', type='float', default=-1,
+      help='If 0 or more, run EM on a sparse matrix of the conditional '
+           'probabilities.  Entries less than this fraction of the max of '
+           'their row are dropped.')
+  p.add_option(
+      '--factor-em', dest='factor_em', default=False, action='store_true',
+      help='Run EM on the conditional probabilities of each variable, '
+           'without the joint matrix.  This is the default for more than 2 '
+           'variables, unless --sparse-threshold is set.')
+  p.add_option(
+      '--float32', dest='float32', default=False, action='store_true',
+      help='Store the joint conditional probabilities as float32, which '
+           'halves their memory.  EM sums in float64, and falls back to '
+           'float64 if the float32 result is off.  Only for the dense joint '
+           'matrix.')
+  p.add_option(
+      '--estimate-var', dest='estimate_var', default=False,
+      action='store_true',
+      help='Estimate the standard error of each proportion, and write it to '
+           'the prop_std_error column of assoc-results.csv.')
+  p.add_option(
+      '--random-seed', dest='random_seed', type='int', default=None,
+      help='Seed for sampling and decoding the marginal.')
+
+
+def CreateOptionsParser():
+  p = optparse.OptionParser()
+
+  p.add_option(
+      '--metric-name', dest='metric_name', default='',
+      help='Name of the metric; metrics contain variables (required)')
+  p.add_option(
+      '--reports', dest='reports', default='',
+      help='CSV file with reports; each variable is a column (required)')
+  p.add_option(
+      '--schema', dest='schema', default='',
+      help='CSV file with variable types and metadata (required)')
+  p.add_option(
+      '--params-dir', dest='params_dir', default='',
+      help='Directory where parameter CSV files are stored (required)')
+  p.add_option(
+      '--var1', dest='var1', default='',
+      help='Name of the string variable (required)')
+  p.add_option(
+      '--var2', dest='var2', default='',
+      help='Name of the boolean variable, or comma-separated booleans '
+           '(required)')
+  p.add_option(
+      '--map1', dest='map1', default='',
+      help='Path to the map file of var1 (required)')
+  p.add_option(
+      '--output-dir', dest='output_dir', default='.',
+      help='Output directory (default .)')
+  p.add_option(
+      '--create-bool-map', dest='create_bool_map', default=False,
+      action='store_true',
+      help='Accepted for compatibility with decode_assoc.R.')
+  p.add_option(
+      '--prior-results', dest='prior_results', default='',
+      help='assoc-results.csv of the previous date.  If it exists, EM starts '
+           'from its estimate instead of the uniform distribution.  Ignored '
+           'with a warning if --var2 has more than one boolean.')
+  p.add_option(
+      '--remove-bad-rows', dest='remove_bad_rows', default=False,
+      action='store_true',
+      help='Remove rows where any value is missing (by default, the program '
+           'aborts with an error)')
+  AddEmOptions(p)
+  # Ignored.
+  p.add_option('--em-executable', dest='em_executable', default='')
+  p.add_option('--tmp-dir', dest='tmp_dir', default='')
+  p.add_option('--num-cores', dest='num_cores', type='int', default=1)
+
+  return p
+
+
+def ReadSchema(f):
+  """Return a dict of (metric, var) -> schema row."""
+  return dict(((row['metric'], row['var']), row) for row in csv.DictReader(f))
+
+
+def PairParamsName(schema, metric_name, var1, var2):
+  """Check the schema of a (string, boolean) pair and return its params name.
+
+  var2 may be comma-separated booleans.
+  """
+  try:
+    schema1 = schema[(metric_name, var1)]
+    schemas2 = [schema[(metric_name, v)] for v in var2.split(',')]
+  except KeyError as e:
+    raise RuntimeError("Couldn't find %s in schema" % (e,))
+  for schema2 in schemas2:
+    if schema1['params'] != schema2['params']:
+      raise RuntimeError('var1 and var2 should have the same params (%s != %s)'
+                         % (schema1['params'], schema2['params']))
+    if schema1['var_type'] != 'string' or schema2['var_type'] != 'boolean':
+      raise RuntimeError('var1 should be a string and var2 a boolean')
+  return schema1['params']
+
+
+def WriteAssocResults(fit, strings, string_var, bool_var, output_dir,
+                      sd=None):
+  """Write assoc-results.csv, like ResultMatrixToDataFrame() and write.csv()
+  in decode_assoc.R.
+
+  Args:
+    fit: 2 x S matrix: (TRUE, FALSE) x strings.  With comma-separated
+      bool_var, a 2 x ... x 2 x S array.
+    sd: If set, standard errors of the same shape as fit
+  """
+  bool_vars = bool_var.split(',')
+  path = os.path.join(output_dir, 'assoc-results.csv')
+  with open(path, 'w') as f:
+    out = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+    header = bool_vars + [string_var, 'proportion']
+    if sd is not None:
+      header.append('prop_std_error')
+    out.writerow(header)
+    for j, s in enumerate(strings):
+      # The first boolean varies fastest, as in expand.grid().
+      for index in itertools.product((0, 1), repeat=len(bool_vars)):
+        index = index[::-1] + (j,)
+        row = [('TRUE', 'FALSE')[i] for i in index[:-1]] + [s, fit[index]]
+        if sd is not None:
+          row.append(sd[index])
+        out.writerow(row)
+
+
+def ReadWarmStart(prior_results, strings):
+  """Return the pij to start EM from, or None to start from uniform."""
+  if not prior_results or not os.path.exists(prior_results):
+    return None
+  with open(prior_results) as f:
+    prior_strings, prior_fit = assoc.ReadAssocResults(f)
+  print >>sys.stderr, 'Read %d strings from %s' % (len(prior_strings),
+                                                   prior_results)
+  return assoc.WarmStartPij(prior_strings, prior_fit, strings)
+
+
+def ReadPairWarmStart(prior_results, strings, num_bools):
+  """ReadWarmStart() for a string and num_bools booleans.
+
+  Only 2-way results can be read back, so with more booleans the prior is
+  ignored with a warning.
+
+  Returns:
+    (pij to start EM from or None, why prior_results wasn't used or None)
+  """
+  if num_bools == 1:
+    return ReadWarmStart(prior_results, strings), None
+  if not prior_results:
+    return None, None
+  reason = 'only 2-way results can be read back for a warm start'
+  print >>sys.stderr, 'WARNING: Ignoring %s: %s' % (prior_results, reason)
+  return None, reason
+
+
+def RunEm(cond_probs, opts, starting_pij=None):
+  """Run EM on the conditional probabilities of booleans and a string
+  variable.
+
+  Args:
+    cond_probs: list of N x d_i matrices, the string last
+    starting_pij: passed to fast_em.RunNumpyEm()
+
+  Returns:
+    (d_1 x ... x d_n array of proportions, array of their standard errors
+    or None, dict of EM metrics)
+  """
+  dims = tuple(cp.shape[1] for cp in cond_probs)
+  if opts.factor_em or (len(cond_probs) > 2 and opts.sparse_threshold < 0):
+    joint = fast_em.FactorCondProb(cond_probs)
+    print >>sys.stderr, 'Running factored EM on %d reports x %s entries' % (
+        joint.shape[0], ' x '.join(str(d) for d in dims))
+  elif opts.sparse_threshold >= 0:
+    joint = fast_em.SparseCondProb(
+        *assoc.SparseJointCondProbs(cond_probs, opts.sparse_threshold))
+    print >>sys.stderr, 'Running EM on %d reports x %d entries (%d nonzero)' % (
+        joint.shape + (len(joint.data),))
+  elif opts.float32:
+    joint = assoc.JointCondProbs([cp.astype(np.float32) for cp in cond_probs])
+    print >>sys.stderr, 'Running float32 EM on %d reports x %d entries' % (
+        joint.shape)
+  else:
+    joint = assoc.JointCondProbs(cond_probs)
+    print >>sys.stderr, 'Running EM on %d reports x %d entries' % joint.shape
+
+  start_time = time.time()
+  float64_fallback = False
+  if opts.online_em_passes > 0:
+    # num_em_iters is the number of mini-batches.
+    num_em_iters, pij, trace = fast_em.RunOnlineEm(
+        joint, num_passes=opts.online_em_passes,
+        batch_rows=opts.online_batch_rows, starting_pij=starting_pij,
+        rand=np.random.RandomState(opts.random_seed))
+  elif opts.float32 and isinstance(joint, np.ndarray):
+    num_em_iters, pij, trace, float64_fallback = fast_em.RunMixedPrecisionEm(
+        joint, opts.max_em_iters, num_threads=opts.num_threads,
+        accelerate=opts.accelerate, starting_pij=starting_pij)
+  else:
+    num_em_iters, pij, trace = fast_em.RunNumpyEm(
+        joint, opts.max_em_iters, num_threads=opts.num_threads,
+        accelerate=opts.accelerate, starting_pij=starting_pij)
+  em_elapsed_time = time.time() - start_time
+
+  # The first variable varies fastest.
+  fit = pij.reshape(dims, order='F')
+  sd = None
+  if opts.estimate_var:
+    _, sd, _ = fast_em.ComputeVar(joint, pij)
+    sd = sd.reshape(dims, order='F')
+  metrics = {
+      'estimate_dimensions': list(fit.shape),
+      'sum_estimates': fit.sum(),
+      'em_elapsed_time': em_elapsed_time,
+      'num_em_iters': num_em_iters,
+      'warm_start': starting_pij is not None,
+      'float64_fallback': float64_fallback,
+      'em_objective': [objective for objective, _ in trace],
+      'em_step_size': [step for _, step in trace],
+  }
+  return fit, sd, metrics
+
+
+def WriteMetrics(metrics, output_dir):
+  with open(os.path.join(output_dir, 'assoc-metrics.json'), 'w') as f:
+    json.dump(metrics, f)
+
+
+def main(argv):
+  start_time = time.time()
+  (opts, argv) = CreateOptionsParser().parse_args(argv)
+  for name in ('metric_name', 'reports', 'schema', 'params_dir', 'var1',
+               'var2', 'map1'):
+    if not getattr(opts, name):
+      raise RuntimeError('--%s is required' % name.replace('_', '-'))
+
+  with open(opts.schema) as f:
+    schema = ReadSchema(f)
+  params_name = PairParamsName(schema, opts.metric_name, opts.var1, opts.var2)
+  params_path = os.path.join(opts.params_dir, params_name + '.csv')
+  with open(params_path) as f:
+    params = rappor.Params.from_csv(f)
+  with open(opts.map1) as f:
+    strings, X = decode.ReadMapFile(f, params)
+
+  bool_vars = opts.var2.split(',')
+  with open(opts.reports) as f:
+    cohorts, values, num_bad = assoc.ReadReportsFile(
+        f, [opts.var1] + bool_vars, remove_bad_rows=opts.remove_bad_rows)
+  print >>sys.stderr, 'Removed %d bad rows' % num_bad
+
+  N = len(cohorts)
+  if N == 0:
+    # Like decode_assoc.R, so we can distinguish this from other failures.
+    print >>sys.stderr, 'No reports to analyze.  Exiting with code 9.'
+    sys.exit(9)
+
+  rand = np.random.RandomState(opts.random_seed)
+  if opts.reports_sample_size != -1 and N > opts.reports_sample_size:
+    indices = np.sort(rand.choice(N, opts.reports_sample_size, replace=False))
+    cohorts = cohorts[indices]
+    values = [[v[i] for i in indices] for v in values]
+    print >>sys.stderr, 'Created a sample of %d reports' % len(cohorts)
+
+  # Hack for Chrome: like AdjustCounts in decode_dist.R.
+  cohorts = cohorts % params.num_cohorts
+
+  string_bits = assoc.BitMatrix(values[0], params.num_bloombits)
+  string_cp, found = assoc.DecodeStringVar(params, strings, X, cohorts,
+                                           string_bits, rand=rand)
+  cond_probs = [assoc.BooleanCondProbs(params, assoc.BitMatrix(v, 1))
+                for v in values[1:]]
+  cond_probs.append(string_cp)
+
+  starting_pij, skipped = ReadPairWarmStart(opts.prior_results, found,
+                                            len(bool_vars))
+  fit, sd, metrics = RunEm(cond_probs, opts, starting_pij=starting_pij)
+  if skipped:
+    metrics['warm_start_skipped'] = skipped
+  if not os.path.isdir(opts.output_dir):
+    os.makedirs(opts.output_dir)
+  WriteAssocResults(fit, found, opts.var1, opts.var2, opts.output_dir, sd=sd)
+
+  metrics['num_reports'] = N
+  metrics['reports_sample_size'] = opts.reports_sample_size
+  metrics['total_elapsed_time'] = time.time() - start_time
+  WriteMetrics(metrics, opts.output_dir)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except (RuntimeError, decode.Error, rappor.Error), e:
+    print >>sys.stderr, 'FATAL: %s' % e
+    sys.exit(1)
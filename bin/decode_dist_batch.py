@@ -0,0 +1,301 @@
+#!/usr/bin/python
+"""
+Decode many dates of each metric in one process.
+
+Reads task specs on stdin, in the format printed by 'task_spec.py dist':
+
+  num_reports metric_name date counts_path params_path map_path results_dir
+  [prev_task_dir]
+
+The last field is printed by 'task_spec.py dist --prior-base-dir'.  Each task
+is warm started from the results in its prev_task_dir, which is in the output
+of an earlier job.  Like 'dist.sh decode-dist-one', dates decoded together
+don't start from each other, so a task gets the same prior either way.
+Only this decoder starts the fit from the prior coefficients.  decode-dist
+only uses the prior to screen candidates.
+
+Tasks with the same metric, params, and map are decoded together with
+DecodeMany() in analysis/python/decode.py, so the map is read once and its
+design matrix is shared by every date.  Boolean and basic RAPPOR tasks of all
+metrics are decoded in closed form with one array computation.
+
+Like 'dist.sh decode-dist-one', each task directory results_dir/metric/date
+gets spec.txt, log.txt, STATUS.txt, results.csv, and metrics.json.
+"""
+
+import collections
+import optparse
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import decode
+import rappor
+
+
+def CreateOptionsParser():
+  p = optparse.OptionParser()
+
+  p.add_option(
+      '--min-reports', dest='min_reports', type='int', default=0,
+      help='Skip tasks with fewer reports than this.')
+  p.add_option(
+      '--num-draws', dest='num_draws', type='int', default=5,
+      help='Number of fits per task, including resampled ones.')
+  p.add_option(
+      '--adjust-counts-hack', dest='adjust_counts_hack', default=False,
+      action='store_true',
+      help='Allow the counts file to have more rows than cohorts. '
+           'Most users should not use this.')
+  p.add_option(
+      '--random-seed', dest='random_seed', type='int', default=None,
+      help='Seed for the resampling.')
+
+  return p
+
+
+def _WriteFile(path, contents):
+  with open(path, 'w') as f:
+    f.write(contents)
+
+
+def PriorResultsPath(spec):
+  """Return the results.csv to warm start a task from, or None.
+
+  Like 'dist.sh decode-dist-one', which passes it to decode_dist.R as
+  --prior-results.
+  """
+  if len(spec) < 8 or spec[7] == '-':
+    return None
+  path = os.path.join(spec[7], 'results.csv')
+  return path if os.path.exists(path) else None
+
+
+class _Group(object):
+  """The tasks of one (metric, params, map) group, and their inputs."""
+
+  def __init__(self, metric_name, params_path, map_path, tasks):
+    self.metric_name = metric_name
+    self.params_path = params_path
+    self.map_path = map_path
+    self.tasks = tasks  # list of (spec tuple, task_dir)
+
+    self.params = None
+    self.strings = None
+    self.X = None
+    self.bits = None  # for basic RAPPOR maps
+    # With several maps, X is their union.  List of (name, columns of X).
+    self.maps = []
+    self.counts_list = None
+
+  def ReadPriors(self):
+    """Read the prior results of each task, named by its spec.
+
+    Returns:
+      List of (Prior or None, path of the results it was read from or None)
+    """
+    priors = []
+    for spec, _ in self.tasks:
+      prior_results = PriorResultsPath(spec)
+      if prior_results is None:
+        priors.append((None, None))
+        continue
+
+      metrics_path = os.path.join(os.path.dirname(prior_results),
+                                  'metrics.json')
+      with open(prior_results) as results_f:
+        if os.path.exists(metrics_path):
+          with open(metrics_path) as metrics_f:
+            prior = decode.ReadPrior(results_f, metrics_f, self.strings)
+        else:
+          prior = decode.ReadPrior(results_f, None, self.strings)
+      priors.append((prior, prior_results))
+    return priors
+
+  def Load(self, opts):
+    with open(self.params_path) as f:
+      self.params = rappor.Params.from_csv(f)
+    # Boolean metrics don't need their map.
+    if self.params.num_bloombits != 1:
+      # map_path may be a comma-separated list of maps.
+      map_paths = self.map_path.split(',')
+      maps = []
+      for path in map_paths:
+        with open(path) as f:
+          maps.append(decode.ReadMapFile(f, self.params))
+      if len(maps) == 1:
+        self.strings, self.X = maps[0]
+      else:
+        self.strings, self.X, columns = decode.UnionMaps(maps)
+        names = [os.path.splitext(os.path.basename(p))[0] for p in map_paths]
+        self.maps = zip(names, columns)
+
+    self.counts_list = []
+    for spec, _ in self.tasks:
+      with open(spec[3]) as f:
+        self.counts_list.append(decode.ReadCountsFile(
+            f, self.params, adjust_counts=opts.adjust_counts_hack))
+
+
+def _WriteResults(group, results, how, elapsed, prior_paths=None):
+  if prior_paths is None:
+    prior_paths = [None] * len(results)
+  for (spec, task_dir), result, prior_results in zip(group.tasks, results,
+                                                     prior_paths):
+    log_lines = ['Decoded %d reports of %s %s' %
+                 (result.metrics['sample_size'], spec[1], how)]
+    if prior_results:
+      log_lines.append('Prior results: %s' % prior_results)
+    if result.fit:
+      result.metrics['total_elapsed_time'] = elapsed
+      decode.WriteResult(result, task_dir)
+      status = 'OK'
+    else:
+      # Like decode_dist.R, this is a failure.
+      log_lines.append('FATAL: Analysis returned no strings.')
+      status = 'FAIL with status 1'
+    _WriteFile(os.path.join(task_dir, 'log.txt'), '\n'.join(log_lines) + '\n')
+    _WriteFile(os.path.join(task_dir, 'STATUS.txt'), status + '\n')
+
+
+def _WriteFailure(group):
+  # One bad metric shouldn't stop the others.
+  trace = traceback.format_exc()
+  print >>sys.stderr, trace
+  for _, task_dir in group.tasks:
+    _WriteFile(os.path.join(task_dir, 'log.txt'), trace)
+    _WriteFile(os.path.join(task_dir, 'STATUS.txt'), 'FAIL with status 1\n')
+
+
+def _DecodeClosedForm(groups, DecodeStack):
+  """Decode the tasks of many groups in one call.
+
+  Args:
+    groups: list of _Group
+    DecodeStack: function from a list of (group, counts) to a list of
+      DecodeResult
+  """
+  start_time = time.time()
+  stack = [(g, counts) for g in groups for counts in g.counts_list]
+  results = DecodeStack(stack)
+  elapsed = time.time() - start_time
+
+  i = 0
+  for g in groups:
+    n = len(g.counts_list)
+    _WriteResults(g, results[i:i + n], 'in closed form', elapsed)
+    i += n
+
+
+def _DecodeBoolean(stack):
+  return decode.DecodeBooleanMany(
+      [g.params for g, _ in stack], [counts for _, counts in stack])
+
+
+def _DecodeBasic(stack):
+  return decode.DecodeBasicMany(
+      [g.params for g, _ in stack], [g.strings for g, _ in stack],
+      [g.bits for g, _ in stack], [counts for _, counts in stack])
+
+
+def _DecodeGroup(group, opts, rand):
+  start_time = time.time()
+  priors, prior_paths = zip(*group.ReadPriors())
+  # With several maps, X is their union.  Each map is also decoded on its
+  # own columns, like DecodeMaps() in decode.R, sharing the estimates.
+  results = decode.DecodeMany(group.params, group.strings, group.X,
+                              group.counts_list, num_draws=opts.num_draws,
+                              rand=rand, priors=list(priors), maps=group.maps)
+  elapsed = time.time() - start_time
+  how = 'with %d other dates' % (len(group.tasks) - 1)
+  _WriteResults(group, results, how, elapsed, prior_paths=prior_paths)
+
+  # The union is the result of the task.  Each map gets a subdirectory.
+  for (_, task_dir), result in zip(group.tasks, results):
+    for name, map_result in result.by_map.iteritems():
+      map_dir = os.path.join(task_dir, 'by_map', name)
+      if not os.path.isdir(map_dir):
+        os.makedirs(map_dir)
+      decode.WriteResult(map_result, map_dir)
+
+
+def main(argv):
+  (opts, argv) = CreateOptionsParser().parse_args(argv)
+  rand = np.random.RandomState(opts.random_seed)
+
+  # (metric, params, map) -> list of tasks.  Keep the order of the input.
+  groups = collections.OrderedDict()
+  for line in sys.stdin:
+    spec = line.split()
+    if not spec:
+      continue
+    if len(spec) not in (7, 8):
+      raise RuntimeError('Expected 7 or 8 fields in task spec, got %r' % line)
+    (num_reports, metric_name, date, _, params_path, map_path,
+     results_dir) = spec[:7]
+
+    task_dir = os.path.join(results_dir, metric_name, date)
+    if not os.path.isdir(task_dir):
+      os.makedirs(task_dir)
+    # Record the spec so we know params, counts, etc.
+    _WriteFile(os.path.join(task_dir, 'spec.txt'), ' '.join(spec) + '\n')
+
+    if int(num_reports) < opts.min_reports:
+      msg = 'SKIPPED because %s reports is less than %d' % (
+          num_reports, opts.min_reports)
+      _WriteFile(os.path.join(task_dir, 'STATUS.txt'), msg + '\n')
+      _WriteFile(os.path.join(task_dir, 'log.txt'), msg + '\n')
+      continue
+
+    key = (metric_name, params_path, map_path)
+    groups.setdefault(key, []).append((spec, task_dir))
+
+  # Boolean and basic RAPPOR tasks are decoded in closed form, all at once.
+  # Basic RAPPOR tasks are stacked by their number of bits.
+  boolean = []
+  basic = collections.defaultdict(list)
+  general = []
+  for (metric_name, params_path, map_path), tasks in groups.iteritems():
+    group = _Group(metric_name, params_path, map_path, tasks)
+    try:
+      group.Load(opts)
+    except Exception:
+      _WriteFailure(group)
+      continue
+
+    if group.params.num_bloombits == 1:
+      boolean.append(group)
+      continue
+    if not group.maps:
+      group.bits = decode.BasicRapporBits(group.params, group.X)
+    if group.bits is not None:
+      basic[group.params.num_bloombits].append(group)
+    else:
+      general.append(group)
+
+  if boolean:
+    print >>sys.stderr, 'Decoding %d boolean metrics' % len(boolean)
+    _DecodeClosedForm(boolean, _DecodeBoolean)
+  for k, basic_groups in basic.iteritems():
+    print >>sys.stderr, 'Decoding %d basic RAPPOR metrics with k = %d' % (
+        len(basic_groups), k)
+    _DecodeClosedForm(basic_groups, _DecodeBasic)
+
+  for group in general:
+    print >>sys.stderr, 'Decoding %d dates of %s' % (
+        len(group.tasks), group.metric_name)
+    try:
+      _DecodeGroup(group, opts, rand)
+    except Exception:
+      _WriteFailure(group)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError, e:
+    print >>sys.stderr, e.args[0]
+    sys.exit(1)
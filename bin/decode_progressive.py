@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""
+Decode a sample of the reports on stdin, and refine it as more are read.
+
+The reports are in the format read by sum_bits.py.  Each one is kept with
+probability --sample-rate.  After --first-checkpoint sampled reports, and then
+every time the sample doubles, the sample is decoded and the results are
+written to --output-dir.  At the end of the input, the final result is written.
+If no reports were sampled, nothing is written and the exit code is 9, like
+decode_assoc.R with no reports.
+
+Each result is scaled to the number of reports read so far, and metrics.json
+has 'preliminary', 'sample_rate', 'num_sampled', and 'num_reports_read'.
+Intervals are those of the sample, so they're wider than those of a full
+decode.
+"""
+
+import csv
+import optparse
+import os
+import random
+import sys
+
+import numpy as np
+
+import decode
+import rappor
+
+
+def CreateOptionsParser():
+  p = optparse.OptionParser()
+
+  p.add_option(
+      '--params', dest='params', metavar='PATH', default='',
+      help='Params file (required)')
+  p.add_option(
+      '--map', dest='map', metavar='PATH', default='',
+      help='Map file (required)')
+  p.add_option(
+      '--output-dir', dest='output_dir', metavar='PATH', default='.',
+      help='Output directory (default .)')
+  p.add_option(
+      '--sample-rate', dest='sample_rate', type='float', default=0.1,
+      help='Probability of keeping each report.')
+  p.add_option(
+      '--first-checkpoint', dest='first_checkpoint', type='int', default=10000,
+      help='Number of sampled reports before the first decode.')
+  p.add_option(
+      '--random-seed', dest='random_seed', type='int', default=None,
+      help='Seed for the sampling and decoding.')
+
+  return p
+
+
+class SampledCounts(object):
+  """Counts of a Bernoulli sample of reports, like SumBits()."""
+
+  def __init__(self, params, sample_rate, rand):
+    self.params = params
+    self.sample_rate = sample_rate
+    self.rand = rand
+    self.counts = np.zeros((params.num_cohorts, params.num_bloombits + 1),
+                           dtype=np.int64)
+    self.num_read = 0
+    self.num_sampled = 0
+
+  def Add(self, cohort, irr):
+    self.num_read += 1
+    if self.sample_rate < 1.0 and self.rand.random() >= self.sample_rate:
+      return
+    k = self.params.num_bloombits
+    if len(irr) != k:
+      raise RuntimeError('Expected %d bits, got %r' % (k, len(irr)))
+    row = self.counts[cohort]
+    row[0] += 1
+    self.num_sampled += 1
+    # Char 0 is bit k - 1.
+    row[1:] += np.frombuffer(irr[::-1], dtype=np.uint8) == ord('1')
+
+
+def _WriteResult(result, output_dir):
+  # Write to temp files and rename, so readers never see a partial result.
+  tmp_dir = os.path.join(output_dir, '.tmp')
+  if not os.path.isdir(tmp_dir):
+    os.makedirs(tmp_dir)
+  decode.WriteResult(result, tmp_dir)
+  for name in ('results.csv', 'metrics.json'):
+    os.rename(os.path.join(tmp_dir, name), os.path.join(output_dir, name))
+
+
+def _DecodeSample(sampled, strings, X, preliminary, output_dir, np_rand):
+  result = decode.Decode(sampled.params, strings, X, sampled.counts.copy(),
+                         rand=np_rand)
+  result = decode.ScaleSampledResult(result, sampled.num_read,
+                                     sampled.sample_rate)
+  result.metrics['num_reports_read'] = sampled.num_read
+  result.metrics['preliminary'] = preliminary
+  _WriteResult(result, output_dir)
+  print >>sys.stderr, 'Decoded %d of %d reports: %d strings%s' % (
+      sampled.num_sampled, sampled.num_read, len(result.fit),
+      ' (preliminary)' if preliminary else '')
+
+
+def main(argv):
+  (opts, argv) = CreateOptionsParser().parse_args(argv)
+  if not opts.params:
+    raise RuntimeError('--params is required')
+  if not opts.map:
+    raise RuntimeError('--map is required')
+  if not 0.0 < opts.sample_rate <= 1.0:
+    raise RuntimeError('--sample-rate should be in (0, 1]')
+
+  with open(opts.params) as f:
+    try:
+      params = rappor.Params.from_csv(f)
+    except rappor.Error as e:
+      raise RuntimeError(e)
+  with open(opts.map) as f:
+    strings, X = decode.ReadMapFile(f, params)
+
+  rand = random.Random(opts.random_seed)
+  np_rand = np.random.RandomState(opts.random_seed)
+  sampled = SampledCounts(params, opts.sample_rate, rand)
+
+  checkpoint = opts.first_checkpoint
+  for i, row in enumerate(csv.reader(sys.stdin)):
+    if i == 0:
+      continue  # skip header
+    try:
+      (_, cohort, _, _, irr) = row
+    except ValueError:
+      raise RuntimeError('Error parsing row %r' % row)
+    sampled.Add(int(cohort), irr)
+
+    if sampled.num_sampled >= checkpoint:
+      _DecodeSample(sampled, strings, X, True, opts.output_dir, np_rand)
+      checkpoint *= 2
+
+  if sampled.num_sampled == 0:
+    # Like decode_assoc.R, so we can distinguish this from other failures.
+    print >>sys.stderr, (
+        'No reports sampled out of %d.  Exiting with code 9.' %
+        sampled.num_read)
+    sys.exit(9)
+  _DecodeSample(sampled, strings, X, False, opts.output_dir, np_rand)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError, e:
+    print >>sys.stderr, e.args[0]
+    sys.exit(1)
@@ -20,12 +20,20 @@ filter by cohort.  This can then be analyzed by R.
 """
 
 import csv
+import random
 import sys
 
 import rappor
 
 
-def SumBits(params, stdin, stdout):
+def SumBits(params, stdin, stdout, sample_rate=1.0, rand=random):
+  """Sum the bits of the reports on stdin.
+
+  If sample_rate is less than 1, each report is kept with that probability
+  (Bernoulli sampling), so a preliminary result can be decoded quickly.  The
+  counts are those of the sample: they're not scaled up, so that the decoder
+  sees the real number of reports and its intervals stay honest.
+  """
   csv_in = csv.reader(stdin)
   csv_out = csv.writer(stdout)
 
@@ -44,6 +52,9 @@ def SumBits(params, stdin, stdout):
     if i == 0:
       continue  # skip header
 
+    if sample_rate < 1.0 and rand.random() >= sample_rate:
+      continue
+
     cohort = int(cohort)
     num_reports[cohort] += 1
 
@@ -68,14 +79,18 @@ def main(argv):
   try:
     filename = argv[1]
   except IndexError:
-    raise RuntimeError('Usage: sum_bits.py <params file>')
+    raise RuntimeError('Usage: sum_bits.py <params file> [<sample rate>]')
   with open(filename) as f:
     try:
       params = rappor.Params.from_csv(f)
     except rappor.Error as e:
       raise RuntimeError(e)
 
-  SumBits(params, sys.stdin, sys.stdout)
+  sample_rate = float(argv[2]) if len(argv) > 2 else 1.0
+  if not 0.0 < sample_rate <= 1.0:
+    raise RuntimeError('Sample rate should be in (0, 1], got %s' % argv[2])
+
+  SumBits(params, sys.stdin, sys.stdout, sample_rate=sample_rate)
 
 
 if __name__ == '__main__':
@@ -19,6 +19,7 @@ sum_bits_test.py: Tests for sum_bits.py
 """
 
 import cStringIO
+import random
 import unittest
 
 import rappor
@@ -58,6 +59,19 @@ class SumBitsTest(unittest.TestCase):
 
     self.assertMultiLineEqual(EXPECTED_CSV_OUT, stdout.getvalue())
 
+  def testSample(self):
+    rows = ['5,1,dummy,dummy,0000000000000001'] * 1000
+    stdin = cStringIO.StringIO('user_id,cohort,bloom,prr,rappor\n' +
+                               '\n'.join(rows) + '\n')
+    stdout = cStringIO.StringIO()
+
+    sum_bits.SumBits(self.params, stdin, stdout, sample_rate=0.2,
+                     rand=random.Random(1))
+
+    cohort1 = [int(c) for c in stdout.getvalue().splitlines()[1].split(',')]
+    self.assertTrue(150 < cohort1[0] < 250, cohort1[0])
+    self.assertEqual(cohort1[0], cohort1[1])  # bit 0 of every sampled report
+
   def testErrors(self):
     stdin = cStringIO.StringIO(TOO_MANY_COLUMNS)
     stdout = cStringIO.StringIO()
@@ -13,6 +13,8 @@ echo "
    ./test.sh decode-assoc-cpp-smoke     # test with analysis/cpp/fast_em.cc
    ./test.sh decode-assoc-cpp-converge  # run for longer with C++
    ./test.sh decode-assoc-tensorflow
+   ./test.sh decode-assoc-numpy         # NumPy engine of tensorflow/fast_em.py
+   ./test.sh online-em-validate         # online vs. batch EM on simulated data
 "
 }
 
@@ -254,6 +256,22 @@ decode-assoc-tensorflow-converge() {
   decode-assoc-tensorflow --max-em-iters 1000
 }
 
+# Compare online EM with batch EM on simulated reports.  Pass flags like
+# --num-reports and -p to online_em_validate.py.
+online-em-validate() {
+  PYTHONPATH=$RAPPOR_SRC/analysis/python:$RAPPOR_SRC/client/python \
+    $RAPPOR_SRC/analysis/tensorflow/online_em_validate.py "$@"
+}
+
+decode-assoc-numpy() {
+  local output_dir=_tmp/numpy
+  mkdir -p $output_dir
+
+  # fast_em.py uses the NumPy engine by default.
+  decode-assoc-helper $output_dir \
+    --em-executable $RAPPOR_SRC/analysis/tensorflow/fast_em.py "$@"
+}
+
 if test $# -eq 0 ; then
   usage
 else
@@ -17,6 +17,7 @@ source $RAPPOR_SRC/pipeline/alarm-lib.sh
 # Change the default location of these tools by setting DEP_*
 readonly DECODE_ASSOC=${DEP_DECODE_ASSOC:-$RAPPOR_SRC/bin/decode-assoc}
 readonly FAST_EM=${DEP_FAST_EM:-$RAPPOR_SRC/analysis/cpp/_tmp/fast_em}
+readonly DECODE_ASSOC_BATCH=${DEP_DECODE_ASSOC_BATCH:-$RAPPOR_SRC/bin/decode-assoc-batch}
 
 # Run a single decode-assoc process, to analyze one variable pair for one
 # metric.  The arguments to this function are one row of the task spec.
@@ -37,6 +38,8 @@ decode-one() {
   local var2=${11}
   local map1=${12}
   local output_dir=${13}
+  # Optional, from task_spec.py --prior-base-dir
+  local prev_task_dir=${14:--}
 
   local log_file=$output_dir/assoc-log.txt
   local status_file=$output_dir/assoc-status.txt
@@ -53,6 +56,12 @@ decode-one() {
   # Output the spec for combine_status.py.
   echo "$@" > $output_dir/assoc-spec.txt
 
+  # prev_task_dir is in the output of an earlier job, which has finished.
+  local prior_results=''
+  if test $prev_task_dir != '-'; then
+    prior_results=$prev_task_dir/assoc-results.csv
+  fi
+
   # NOTE: Not passing --num-cores since we're parallelizing already.
 
   # NOTE: --tmp-dir is the output dir.  Then we just delete all the .bin files
@@ -71,6 +80,7 @@ decode-one() {
           --var1 $var1 \
           --var2 $var2 \
           --map1 $map1 \
+          --prior-results "$prior_results" \
           --reports-sample-size $sample_size \
           --tmp-dir $output_dir \
           --output-dir $output_dir
@@ -106,11 +116,61 @@ decode-many() {
   local rappor_src=${6:-$RAPPOR_SRC}
   local min_reports=${7:-$DEFAULT_MIN_REPORTS}
 
+  # Chained specs have an extra field.
+  local num_args=$NUM_ARGS
+  if test -s $spec_list; then
+    num_args=$(head -n 1 $spec_list | wc -w)
+  fi
+
   time cat $spec_list \
-    | xargs --verbose -n $NUM_ARGS -P $max_procs --no-run-if-empty -- \
+    | xargs --verbose -n $num_args -P $max_procs --no-run-if-empty -- \
       $0 decode-one $rappor_src $timeout_secs $min_reports $job_dir $sample_size
 }
 
+# Decode all the tasks in one spec file in a single process.  The tasks for
+# the same reports file and string variable share the parsed reports and the
+# decoded marginal.  decode-assoc-batch writes the status of each task.
+decode-batch-one() {
+  local job_dir=$1
+  local sample_size=$2
+  local spec_file=$3
+
+  local log_file=${spec_file%.txt}-log.txt
+
+  { time \
+      $DECODE_ASSOC_BATCH \
+        --schema $job_dir/config/rappor-vars.csv \
+        --params-dir $job_dir/config \
+        --spec-prefix "$RAPPOR_SRC - - $job_dir $sample_size" \
+        --reports-sample-size $sample_size \
+        < $spec_file
+  } >$log_file 2>&1
+}
+
+# Like decode-many, but run one decode-assoc-batch process per reports file,
+# instead of one decode-assoc process per variable pair.
+decode-batch-many() {
+  local job_dir=$1
+  local spec_list=$2
+
+  local sample_size=${3:-$DEFAULT_SAMPLE_SIZE}
+  local max_procs=${4:-$DEFAULT_MAX_PROCS}
+
+  local batch_dir=$job_dir/assoc-batch
+  rm -r -f $batch_dir
+  mkdir -p $batch_dir
+
+  # Split the spec list on the reports path (field 4).
+  awk -v dir=$batch_dir '
+    !($4 in files) { files[$4] = sprintf("%s/batch-%d.txt", dir, n++) }
+    { print > files[$4] }
+  ' $spec_list
+
+  time ls $batch_dir/batch-*.txt \
+    | xargs --verbose -n 1 -P $max_procs --no-run-if-empty -- \
+      $0 decode-batch-one $job_dir $sample_size
+}
+
 # Combine assoc results and render HTML.
 
 combine-and-render-html() {
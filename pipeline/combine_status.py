@@ -8,6 +8,7 @@ and log.txt files.  Writes a CSV to stdout.  Row key is (metric, date).
 import collections
 import csv
 import json
+import operator
 import os
 import re
 import sys
@@ -126,18 +127,20 @@ def CombineDistTaskStatus(stdin, c_out, mem_by_pid):
     with open(spec_file) as f:
       spec_line = f.readline()
       # See backfill.sh analyze-one for the order of these 7 fields.
-      # There are 3 job constants on the front.
+      # There are 3 job constants on the front.  Chained specs have the
+      # previous task dir at the end.
       (num_reports, metric_name, date, counts_path, params_path,
-       map_path, _) = spec_line.split()
+       map_path, _) = spec_line.split()[:7]
 
     # NOTE: These are all constant per metric.  Could have another CSV and
     # join.  But denormalizing is OK for now.
     params_file = os.path.basename(params_path)
-    map_file = os.path.basename(map_path)
 
     # remove extension
     params_file, _ = os.path.splitext(params_file)
-    map_file, _ = os.path.splitext(map_file)
+    # A task may have several maps.
+    map_file = '+'.join(
+        os.path.splitext(os.path.basename(p))[0] for p in map_path.split(','))
 
     #
     # Read the log
@@ -237,10 +240,10 @@ def CombineAssocTaskStatus(stdin, c_out):
       # See backfill.sh analyze-one for the order of these 7 fields.
       # There are 3 job constants on the front.
 
-      # 5 job params
+      # 5 job params.  Chained specs have the previous task dir at the end.
       (_, _, _, _, _,
        dummy_num_reports, metric_name, date, reports, var1, var2, map1,
-       output_dir) = spec_line.split()
+       output_dir) = spec_line.split()[:13]
 
     #
     # Parse decode-assoc metrics
@@ -257,7 +260,9 @@ def CombineAssocTaskStatus(stdin, c_out):
     em_elapsed_seconds = metrics.get('em_elapsed_time')
     estimate_dimensions = metrics.get('estimate_dimensions')
     if estimate_dimensions:
-      d1, d2 = estimate_dimensions
+      # N-way tasks have a dimension for each boolean, then the strings.
+      d1 = reduce(operator.mul, estimate_dimensions[:-1], 1)
+      d2 = estimate_dimensions[-1]
     else:
       d1, d2 = (0, 0)  # unknown
 
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+"""Cache decode results by the content of their inputs.
+
+The key of a task is a hash of its counts, params and map files, the source of
+the decoder, and the decoder options.  So identical inputs, e.g. when a job is
+rerun after a crash, are decoded only once.  With several maps, the options
+include the map names, since the results of each map are stored under its name.
+
+Usage:
+  decode_cache.py key <decoder source dir> <option string> <input file>...
+  decode_cache.py restore <cache dir> <key> <task dir>
+  decode_cache.py store <cache dir> <key> <task dir>
+
+'restore' exits with status 1 if the key isn't in the cache.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+
+# Files written by a successful decode.  Only the first two are required.
+RESULT_FILES = ('results.csv', 'metrics.json', 'ambiguity.csv', 'residual.png')
+REQUIRED_FILES = RESULT_FILES[:2]
+
+# With several maps, the results of each map are in a subdirectory of this,
+# named after the map.  It's copied as a whole.
+BY_MAP_DIR = 'by_map'
+
+# Source files of the decoder, relative to the repository root.  If any of
+# them changes, the old results are no longer used.
+DECODER_SOURCES = (
+    'bin/decode_dist.R',
+    'analysis/R/alternative.R',
+    'analysis/R/decode.R',
+    'analysis/R/read_input.R',
+    'analysis/R/util.R',
+)
+
+
+def _HashFile(h, path):
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(1 << 20)
+      if not chunk:
+        break
+      h.update(chunk)
+
+
+def DecoderVersion(repo_dir):
+  """Hash of the decoder source."""
+  h = hashlib.sha1()
+  for rel_path in DECODER_SOURCES:
+    h.update(rel_path + '\0')
+    _HashFile(h, os.path.join(repo_dir, rel_path))
+  return h.hexdigest()
+
+
+def CacheKey(input_paths, decoder_version, options):
+  """Compute the cache key of a task.
+
+  Args:
+    input_paths: the counts, params and map files.  Their contents are hashed,
+      not their names.
+    decoder_version: from DecoderVersion()
+    options: string of decoder options that affect the result
+  """
+  h = hashlib.sha1()
+  h.update('decoder %s\0options %s\0' % (decoder_version, options))
+  for path in input_paths:
+    file_hash = hashlib.sha1()
+    _HashFile(file_hash, path)
+    h.update(file_hash.hexdigest() + '\0')
+  return h.hexdigest()
+
+
+def _EntryDir(cache_dir, key):
+  return os.path.join(cache_dir, key[:2], key)
+
+
+def Restore(cache_dir, key, task_dir):
+  """Copy cached results to the task dir.
+
+  Returns:
+    Whether the key was found.
+  """
+  entry_dir = _EntryDir(cache_dir, key)
+  if not os.path.isdir(entry_dir):
+    return False
+  for name in RESULT_FILES:
+    path = os.path.join(entry_dir, name)
+    if os.path.exists(path):
+      shutil.copy(path, task_dir)
+
+  by_map = os.path.join(entry_dir, BY_MAP_DIR)
+  if os.path.isdir(by_map):
+    dest = os.path.join(task_dir, BY_MAP_DIR)
+    if os.path.isdir(dest):
+      shutil.rmtree(dest)
+    shutil.copytree(by_map, dest)
+  return True
+
+
+def Store(cache_dir, key, task_dir):
+  """Copy the results of a task to the cache.
+
+  The entry is written to a temporary dir and renamed, so concurrent tasks
+  never see a partial entry.
+
+  Returns:
+    Whether the results were stored.
+  """
+  for name in REQUIRED_FILES:
+    if not os.path.exists(os.path.join(task_dir, name)):
+      return False
+
+  entry_dir = _EntryDir(cache_dir, key)
+  parent = os.path.dirname(entry_dir)
+  try:
+    os.makedirs(parent)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+  tmp_dir = tempfile.mkdtemp(dir=parent)
+  for name in RESULT_FILES:
+    path = os.path.join(task_dir, name)
+    if os.path.exists(path):
+      shutil.copy(path, tmp_dir)
+
+  by_map = os.path.join(task_dir, BY_MAP_DIR)
+  if os.path.isdir(by_map):
+    shutil.copytree(by_map, os.path.join(tmp_dir, BY_MAP_DIR))
+  try:
+    os.rename(tmp_dir, entry_dir)
+  except OSError:
+    # Another task stored the same key first.
+    shutil.rmtree(tmp_dir)
+  return True
+
+
+def main(argv):
+  try:
+    action = argv[1]
+  except IndexError:
+    raise RuntimeError('Action required')
+
+  if action == 'key':
+    repo_dir, options = argv[2], argv[3]
+    print CacheKey(argv[4:], DecoderVersion(repo_dir), options)
+
+  elif action == 'restore':
+    cache_dir, key, task_dir = argv[2:5]
+    if not Restore(cache_dir, key, task_dir):
+      sys.exit(1)
+
+  elif action == 'store':
+    cache_dir, key, task_dir = argv[2:5]
+    if not Store(cache_dir, key, task_dir):
+      raise RuntimeError('No results in %s' % task_dir)
+
+  else:
+    raise RuntimeError('Invalid action %r' % action)
+
+
+if __name__ == '__main__':
+  try:
+    main(sys.argv)
+  except RuntimeError, e:
+    print >>sys.stderr, 'FATAL: %s' % e
+    sys.exit(1)
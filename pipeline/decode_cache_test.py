@@ -0,0 +1,98 @@
+#!/usr/bin/python -S
+"""
+decode_cache_test.py: Tests for decode_cache.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import decode_cache  # module under test
+
+
+def _WriteFile(path, contents):
+  with open(path, 'w') as f:
+    f.write(contents)
+
+
+class DecodeCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Path(self, *parts):
+    return os.path.join(self.tmp_dir, *parts)
+
+  def testCacheKey(self):
+    _WriteFile(self._Path('counts.csv'), '10,1,2\n')
+    _WriteFile(self._Path('counts2.csv'), '10,1,2\n')
+    _WriteFile(self._Path('params.csv'), 'k,h,m,p,q,f\n')
+
+    key = decode_cache.CacheKey(
+        [self._Path('counts.csv'), self._Path('params.csv')], 'v1', '')
+
+    # Only the contents matter, not the names.
+    self.assertEqual(key, decode_cache.CacheKey(
+        [self._Path('counts2.csv'), self._Path('params.csv')], 'v1', ''))
+
+    # The version and options do matter.
+    self.assertNotEqual(key, decode_cache.CacheKey(
+        [self._Path('counts.csv'), self._Path('params.csv')], 'v2', ''))
+    self.assertNotEqual(key, decode_cache.CacheKey(
+        [self._Path('counts.csv'), self._Path('params.csv')], 'v1', '--x'))
+
+    _WriteFile(self._Path('counts2.csv'), '10,2,1\n')
+    self.assertNotEqual(key, decode_cache.CacheKey(
+        [self._Path('counts2.csv'), self._Path('params.csv')], 'v1', ''))
+
+  def testStoreAndRestore(self):
+    cache_dir = self._Path('cache')
+    task_dir = self._Path('task')
+    os.mkdir(task_dir)
+
+    self.assertFalse(decode_cache.Restore(cache_dir, 'abcd', task_dir))
+    # Nothing to store yet.
+    self.assertFalse(decode_cache.Store(cache_dir, 'abcd', task_dir))
+
+    _WriteFile(os.path.join(task_dir, 'results.csv'), 'results')
+    _WriteFile(os.path.join(task_dir, 'metrics.json'), '{}')
+    self.assertTrue(decode_cache.Store(cache_dir, 'abcd', task_dir))
+    # Storing twice is OK.
+    self.assertTrue(decode_cache.Store(cache_dir, 'abcd', task_dir))
+
+    task_dir2 = self._Path('task2')
+    os.mkdir(task_dir2)
+    self.assertTrue(decode_cache.Restore(cache_dir, 'abcd', task_dir2))
+    with open(os.path.join(task_dir2, 'results.csv')) as f:
+      self.assertEqual('results', f.read())
+    self.assertEqual(['metrics.json', 'results.csv'],
+                     sorted(os.listdir(task_dir2)))
+
+  def testByMap(self):
+    cache_dir = self._Path('cache')
+    task_dir = self._Path('task')
+    for name in ('curated', 'broad'):
+      os.makedirs(os.path.join(task_dir, 'by_map', name))
+      _WriteFile(os.path.join(task_dir, 'by_map', name, 'results.csv'), name)
+    _WriteFile(os.path.join(task_dir, 'results.csv'), 'union')
+    _WriteFile(os.path.join(task_dir, 'metrics.json'), '{}')
+    self.assertTrue(decode_cache.Store(cache_dir, 'abcd', task_dir))
+
+    task_dir2 = self._Path('task2')
+    os.mkdir(task_dir2)
+    self.assertTrue(decode_cache.Restore(cache_dir, 'abcd', task_dir2))
+    self.assertEqual(['broad', 'curated'],
+                     sorted(os.listdir(os.path.join(task_dir2, 'by_map'))))
+    with open(os.path.join(task_dir2, 'by_map', 'broad', 'results.csv')) as f:
+      self.assertEqual('broad', f.read())
+
+    # Restoring over old results replaces them.
+    self.assertTrue(decode_cache.Restore(cache_dir, 'abcd', task_dir2))
+
+
+if __name__ == '__main__':
+  unittest.main()
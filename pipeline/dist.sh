@@ -15,9 +15,13 @@ source $RAPPOR_SRC/pipeline/tools-lib.sh
 source $RAPPOR_SRC/pipeline/alarm-lib.sh
 
 readonly DECODE_DIST=${DEP_DECODE_DIST:-$RAPPOR_SRC/bin/decode-dist}
+readonly DECODE_DIST_BATCH=${DEP_DECODE_DIST_BATCH:-$RAPPOR_SRC/bin/decode-dist-batch}
 
 readonly NUM_ARGS=7  # used for xargs
 
+# If set, decode results are cached here, keyed by the content of the inputs.
+readonly DECODE_CACHE_DIR=${DECODE_CACHE_DIR:-}
+
 decode-dist-one() {
   # Job constants
   local rappor_src=$1
@@ -33,6 +37,8 @@ decode-dist-one() {
   local params=$5
   local map=$6
   local results_dir=$7
+  # Optional, from task_spec.py --prior-base-dir
+  local prev_task_dir=${8:--}
 
   local task_dir=$results_dir/$metric_name/$date
   mkdir --verbose -p $task_dir
@@ -51,6 +57,45 @@ decode-dist-one() {
     return
   fi
 
+  # prev_task_dir is in the output of an earlier job, which has finished.  So
+  # the prior doesn't depend on the order the tasks of this job run in.
+  # decode_dist_batch.py reads the same file.
+  local prior_results=''
+  if test $prev_task_dir != '-'; then
+    prior_results=$prev_task_dir/results.csv
+  fi
+
+  local decode_options='--adjust-counts-hack'
+  if test -n "$prior_results" && test -f $prior_results; then
+    # decode-dist only uses the prior to keep the strings detected there
+    # through screening, so it has no effect without --screen.  Only
+    # decode-dist-batch starts the fit itself from the prior coefficients.
+    decode_options="$decode_options --screen"
+  fi
+  local cache_key=''
+  if test -n "$DECODE_CACHE_DIR"; then
+    local inputs="$counts $params ${map//,/ }"  # $map may be a list
+    # Results for each map are written to by_map/<name>, so the names are part
+    # of the key too.
+    local map_names=''
+    local m
+    for m in ${map//,/ }; do
+      map_names="$map_names $(basename $m)"
+    done
+    if test -n "$prior_results" && test -f $prior_results; then
+      inputs="$inputs $prior_results"
+    fi
+    cache_key=$($rappor_src/pipeline/decode_cache.py \
+      key $rappor_src "$decode_options maps:$map_names" $inputs)
+
+    if $rappor_src/pipeline/decode_cache.py \
+      restore $DECODE_CACHE_DIR $cache_key $task_dir; then
+      echo 'OK (cached)' > $status_file
+      echo "Restored results from cache entry $cache_key" > $log_file
+      return
+    fi
+  fi
+
   # Run it with a timeout, and record status in the task dir.
   { time \
       alarm-status $status_file $timeout_secs \
@@ -59,9 +104,15 @@ decode-dist-one() {
           --params $params \
           --map $map \
           --output-dir $task_dir \
-          --adjust-counts-hack
+          --prior-results=$prior_results \
+          $decode_options
   } >$log_file 2>&1
 
+  if test -n "$cache_key" && test "$(cat $status_file)" = OK; then
+    $rappor_src/pipeline/decode_cache.py \
+      store $DECODE_CACHE_DIR $cache_key $task_dir
+  fi
+
   # TODO: Don't pass --adjust-counts-hack unless the user asks for it.
 }
 
@@ -104,11 +155,32 @@ decode-dist-many() {
   local sys_mem="$job_dir/system-mem.csv"
   mkdir --verbose -p $pid_dir
 
+  # Chained specs have an extra field.
+  local num_args=$NUM_ARGS
+  if test -s $spec_list; then
+    num_args=$(head -n 1 $spec_list | wc -w)
+  fi
+
   time cat $spec_list \
-    | xargs --verbose -n $NUM_ARGS -P $max_procs --no-run-if-empty -- \
+    | xargs --verbose -n $num_args -P $max_procs --no-run-if-empty -- \
       $0 decode-dist-one $rappor_src $timeout_secs $min_reports
 }
 
+# Like decode-dist-many, but decode all dates of a metric in one process, so
+# the map is read and factored once per metric rather than once per date.
+decode-dist-batch-many() {
+  local job_dir=$1
+  local spec_list=$2
+  local min_reports=${3:-$DEFAULT_MIN_REPORTS}
+
+  mkdir --verbose -p $job_dir
+
+  time $DECODE_DIST_BATCH \
+    --min-reports $min_reports \
+    --adjust-counts-hack \
+    < $spec_list
+}
+
 # Combine/summarize results and task metadata from the parallel decode-dist
 # processes.  Render them as HTML.
 combine-and-render-html() {
@@ -0,0 +1,102 @@
+#!/usr/bin/python -S
+"""
+dist_test.py: Tests for dist.sh
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+DIST_SH = os.path.join(THIS_DIR, 'dist.sh')
+
+# Records its flags, like bin/decode-dist would get them.
+FAKE_DECODE_DIST = """\
+#!/bin/bash
+echo "$@" > $(dirname $0)/decode-dist-args.txt
+"""
+
+
+def _WriteFile(path, contents):
+  with open(path, 'w') as f:
+    f.write(contents)
+
+
+class DistTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Path(self, *parts):
+    return os.path.join(self.tmp_dir, *parts)
+
+  def _WriteInputs(self):
+    _WriteFile(self._Path('params.csv'), 'k,h,m,p,q,f\n8,2,2,0.25,0.75,0\n')
+    _WriteFile(self._Path('map.csv'), 'a,1,2,9,10\nb,3,4,11,12\nc,5,6,13,14\n')
+    _WriteFile(self._Path('counts.csv'),
+               '1000,550,550,350,350,250,250,250,250\n'
+               '1000,550,550,350,350,250,250,250,250\n')
+
+    # Output of an earlier job.
+    prev_dir = self._Path('prev', 'm', '2015-12-01')
+    os.makedirs(prev_dir)
+    _WriteFile(os.path.join(prev_dir, 'STATUS.txt'), 'OK\n')
+    _WriteFile(os.path.join(prev_dir, 'results.csv'),
+               'string,estimate,std_error,proportion,prop_std_error,'
+               'prop_low_95,prop_high_95\n'
+               'a,1000,10,0.5,0.01,0.48,0.52\n')
+    return prev_dir
+
+  def _Spec(self, date, results_dir, prev_dir):
+    return [str(2000), 'm', date, self._Path('counts.csv'),
+            self._Path('params.csv'), self._Path('map.csv'), results_dir,
+            prev_dir]
+
+  def testSamePrior(self):
+    prev_dir = self._WriteInputs()
+    expected = os.path.join(prev_dir, 'results.csv')
+
+    fake = self._Path('decode-dist')
+    _WriteFile(fake, FAKE_DECODE_DIST)
+    os.chmod(fake, 0755)
+    env = dict(os.environ, DEP_DECODE_DIST=fake)
+    spec = self._Spec('2015-12-03', self._Path('one'), prev_dir)
+    subprocess.check_call(
+        [DIST_SH, 'decode-dist-one', os.path.dirname(THIS_DIR), '60', '0'] +
+        spec, env=env)
+    with open(self._Path('decode-dist-args.txt')) as f:
+      args = f.read().split()
+    self.assertIn('--prior-results=%s' % expected, args)
+    # decode-dist only uses the prior for screening.
+    self.assertIn('--screen', args)
+
+    # Without a prior, candidates aren't screened.
+    spec = self._Spec('2015-12-03', self._Path('cold'), '-')
+    subprocess.check_call(
+        [DIST_SH, 'decode-dist-one', os.path.dirname(THIS_DIR), '60', '0'] +
+        spec, env=env)
+    with open(self._Path('decode-dist-args.txt')) as f:
+      self.assertNotIn('--screen', f.read().split())
+
+    # Decode two dates in one batch.  The later one still starts from the
+    # prior in its spec, not from the other date.
+    specs = [self._Spec('2015-12-02', self._Path('batch'), prev_dir),
+             self._Spec('2015-12-03', self._Path('batch'), prev_dir)]
+    spec_list = self._Path('spec-list.txt')
+    _WriteFile(spec_list, ''.join(' '.join(s) + '\n' for s in specs))
+    subprocess.check_call(
+        [DIST_SH, 'decode-dist-batch-many', self._Path('batch'), spec_list,
+         '0'])
+    for date in ('2015-12-02', '2015-12-03'):
+      with open(self._Path('batch', 'm', date, 'log.txt')) as f:
+        self.assertIn('Prior results: %s' % expected, f.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
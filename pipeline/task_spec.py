@@ -8,6 +8,7 @@ are passed to ./dist.sh decode-many or ./assoc.sh decode-many.
 import collections
 import csv
 import errno
+import itertools
 import optparse
 import os
 import pprint
@@ -18,7 +19,11 @@ import util
 
 
 def _ReadDistMaps(f):
-  dist_maps = {}
+  """Return a dictionary of var -> list of map filenames.
+
+  A var can be listed on several rows, once for each map.
+  """
+  dist_maps = collections.defaultdict(list)
   c = csv.reader(f)
   for i, row in enumerate(c):
     if i == 0:
@@ -28,22 +33,36 @@ def _ReadDistMaps(f):
       continue  # skip header
 
     var_name, map_filename = row
-    dist_maps[var_name] = map_filename
-  return dist_maps
+    if map_filename in dist_maps[var_name]:
+      raise RuntimeError('Map %r listed twice for %r' % (map_filename, var_name))
+    if ',' in map_filename:
+      # The task spec joins map paths with commas.
+      raise RuntimeError('Invalid map filename %r' % map_filename)
+    dist_maps[var_name].append(map_filename)
+  return dict(dist_maps)
 
 
 class DistMapLookup(object):
-  """Create a dictionary of var -> map to analyze against.
+  """Create a dictionary of var -> maps to analyze against.
 
-  TODO: Support a LIST of maps.  Users should be able to specify more than one.
+  Users can specify more than one map for a var.  Then the decoder produces
+  results for each map and for their union.
   """
   def __init__(self, f, map_dir):
     self.dist_maps = _ReadDistMaps(f)
     self.map_dir = map_dir
 
+  def GetMapPaths(self, var_name):
+    return [os.path.join(self.map_dir, filename)
+            for filename in self.dist_maps[var_name]]
+
   def GetMapPath(self, var_name):
-    filename = self.dist_maps[var_name]
-    return os.path.join(self.map_dir, filename)
+    """Return the first map of a var."""
+    return self.GetMapPaths(var_name)[0]
+
+  def GetMapSpec(self, var_name):
+    """Return the maps of a var as one task spec token."""
+    return ','.join(self.GetMapPaths(var_name))
 
 
 def CreateFieldIdLookup(f):
@@ -181,7 +200,7 @@ def DistTaskSpec(input_iter, field_id_lookup, var_schema, dist_maps, bad_c):
     # NOTE: We could remove the params from the spec if decode_dist.R took the
     # --schema flag.  The var type is there too.
     params_path = var_schema.GetParamsPath(field_name)
-    map_path= dist_maps.GetMapPath(field_name)
+    map_path = dist_maps.GetMapSpec(field_name)
 
     yield num_reports, field_name, date, counts_path, params_path, map_path
 
@@ -191,6 +210,64 @@ def DistTaskSpec(input_iter, field_id_lookup, var_schema, dist_maps, bad_c):
              '(check --field-ids file)', num_bad)
 
 
+DATE_RE = re.compile(r'\d+-\d+-\d+$')
+
+
+def FindPriorTaskDir(prior_dir, date, status_name, results_name):
+  """Find the task directory to warm start a task from.
+
+  Args:
+    prior_dir: directory with a subdirectory per date, e.g.
+      prior_base_dir/metric_name
+    date: date of the task
+    status_name, results_name: files the task directory must have.  The
+      status must start with OK.
+
+  Returns:
+    The directory of the latest date before 'date' that finished OK, or '-'.
+  """
+  try:
+    names = os.listdir(prior_dir)
+  except OSError:
+    return '-'
+  for name in sorted(names, reverse=True):
+    if not DATE_RE.match(name) or name >= date:
+      continue
+    task_dir = os.path.join(prior_dir, name)
+    try:
+      with open(os.path.join(task_dir, status_name)) as f:
+        status = f.read()
+    except IOError:
+      continue
+    if (status.startswith('OK') and
+        os.path.exists(os.path.join(task_dir, results_name))):
+      return task_dir
+  return '-'
+
+
+def ChainDates(rows, prior_base_dir):
+  """Link each dist task to a previous decode of the same metric.
+
+  The previous decode is looked up in the output of an earlier job, which is
+  complete, and not among the tasks of this job, which run in parallel.  So
+  the prior of a task doesn't depend on timing or on how tasks are batched.
+
+  Args:
+    rows: tuples from DistTaskSpec()
+    prior_base_dir: output base dir of an earlier job
+
+  Yields:
+    Each row with the task directory of the latest earlier date appended, or
+    '-' if there isn't one.  decode-dist-batch warm starts the fit from the
+    results in that directory.  decode-dist only keeps the strings detected
+    there through screening.
+  """
+  for row in rows:
+    _, metric_name, date = row[:3]
+    yield row + (FindPriorTaskDir(os.path.join(prior_base_dir, metric_name),
+                                  date, 'STATUS.txt', 'results.csv'),)
+
+
 ASSOC_INPUT_PATH_RE = re.compile(r'.*/(\d+-\d+-\d+)/(\S+)_reports.csv')
 
 
@@ -207,10 +284,11 @@ def AssocInputIter(stdin):
     yield reports_path, date, metric_name
 
 
-def CreateAssocVarPairs(rappor_metrics):
-  """Yield a list of pairs of variables that should be associated.
+def CreateAssocVarPairs(rappor_metrics, num_vars=2):
+  """Yield a list of tuples of variables that should be associated.
 
-  For now just do all (string x boolean) analysis.
+  For now just do all (string x boolean) analysis.  With num_vars > 2, each
+  string is associated with every combination of num_vars - 1 booleans.
   """
   var_pairs = collections.defaultdict(list)
 
@@ -228,8 +306,8 @@ def CreateAssocVarPairs(rappor_metrics):
         util.log('Unknown type variable type %r', var_type)
 
     for s in string_vars:
-      for b in boolean_vars:
-        var_pairs[metric].append((s, b))
+      for b in itertools.combinations(boolean_vars, num_vars - 1):
+        var_pairs[metric].append((s,) + b)
   return var_pairs
 
 
@@ -252,19 +330,48 @@ def AssocTaskSpec(input_iter, var_pairs, dist_maps, output_base_dir, bad_c):
 
   for reports_path, date, metric_name in input_iter:
     pairs = var_pairs[metric_name]
-    for var1, var2 in pairs:
+    for var_tuple in pairs:
       # Assuming var1 is a string.  TODO: Use an assoc file, not dist_maps?
+      var1 = var_tuple[0]
       field1_name = '%s.%s' % (metric_name, var1)
       map1_path = dist_maps.GetMapPath(field1_name)
 
+      # The booleans of an N-way task are one comma-separated token.
+      var2 = ','.join(var_tuple[1:])
+
       # e.g. domain_X_flags__DID_PROCEED
       # Don't use .. in filenames since it could be confusing.
-      pair_name = '%s_X_%s' % (var1, var2.replace('..', '_'))
+      pair_name = '_X_'.join(v.replace('..', '_') for v in var_tuple)
       output_dir = os.path.join(output_base_dir, metric_name, pair_name, date)
 
       yield metric_name, date, reports_path, var1, var2, map1_path, output_dir
 
 
+def ChainAssocDates(rows, output_base_dir, prior_base_dir):
+  """Link each assoc task to a previous decode of the same variable pair.
+
+  Like ChainDates(), the previous decode is looked up in the output of an
+  earlier job.
+
+  Args:
+    rows: tuples from AssocTaskSpec()
+    output_base_dir: output base dir of this job
+    prior_base_dir: output base dir of an earlier job
+
+  Yields:
+    Each row with the task directory of the latest earlier date appended, or
+    '-' if there isn't one.  The decoder can warm start EM from the results in
+    that directory.
+  """
+  for row in rows:
+    date, output_dir = row[1], row[6]
+    # e.g. metric/domain_X_flag
+    pair_path = os.path.relpath(os.path.dirname(output_dir), output_base_dir)
+    yield row + (FindPriorTaskDir(os.path.join(prior_base_dir, pair_path),
+                                  date, 'assoc-status.txt',
+                                  'assoc-results.csv'),)
+
+
 def CreateOptionsParser():
   p = optparse.OptionParser()
 
@@ -285,6 +392,17 @@ def CreateOptionsParser():
       '--output-base-dir', dest='output_base_dir', metavar='PATH', type='str',
       default='',
       help='Root of the directory tree where analysis output will be placed.')
+  p.add_option(
+      '--prior-base-dir', dest='prior_base_dir', metavar='PATH', type='str',
+      default='',
+      help='Output base dir of an earlier job.  Append the output directory '
+           'of the latest earlier date of the same metric (dist) or variable '
+           'pair (assoc) in it to each task spec, so it can be used as a '
+           'starting point.')
+  p.add_option(
+      '--assoc-num-vars', dest='assoc_num_vars', type='int', default=2,
+      help='Number of variables in each assoc task: a string and '
+           'N - 1 booleans.')
   p.add_option(
       '--field-ids', dest='field_ids', metavar='PATH', type='str',
       default='',
@@ -310,6 +428,11 @@ def main(argv):
     raise RuntimeError('--map-dir is required')
   if not opts.output_base_dir:
     raise RuntimeError('--output-base-dir is required')
+  if (opts.prior_base_dir and os.path.realpath(opts.prior_base_dir) ==
+      os.path.realpath(opts.output_base_dir)):
+    # Tasks of this job would read each other's output while it's written.
+    raise RuntimeError('--prior-base-dir should be the output of an earlier '
+                       'job, not --output-base-dir')
 
   # This is shared between the two specs.
   path = os.path.join(opts.config_dir, 'dist-analysis.csv')
@@ -328,10 +451,15 @@ def main(argv):
       field_id_lookup = {}
 
     input_iter = DistInputIter(sys.stdin)
-    for row in DistTaskSpec(input_iter, field_id_lookup, var_schema, dist_maps,
-                            bad_c):
-      # The spec is a series of space-separated tokens.
-      tokens = row + (opts.output_base_dir,)
+    rows = DistTaskSpec(input_iter, field_id_lookup, var_schema, dist_maps,
+                        bad_c)
+    if opts.prior_base_dir:
+      rows = ChainDates(rows, opts.prior_base_dir)
+
+    for row in rows:
+      # The spec is a series of space-separated tokens.  The output dir comes
+      # before the optional previous task dir.
+      tokens = row[:6] + (opts.output_base_dir,) + row[6:]
       print ' '.join(str(t) for t in tokens)
 
   elif action == 'assoc':
@@ -339,11 +467,18 @@ def main(argv):
     input_iter = AssocInputIter(sys.stdin)
 
     # Create M x N association tasks
-    var_pairs = CreateAssocVarPairs(var_schema.GetAssocMetrics())
+    if opts.assoc_num_vars < 2:
+      raise RuntimeError('--assoc-num-vars should be at least 2')
+    var_pairs = CreateAssocVarPairs(var_schema.GetAssocMetrics(),
+                                    num_vars=opts.assoc_num_vars)
+
+    rows = AssocTaskSpec(
+        input_iter, var_pairs, dist_maps, opts.output_base_dir, bad_c)
+    if opts.prior_base_dir:
+      rows = ChainAssocDates(rows, opts.output_base_dir, opts.prior_base_dir)
 
     # Now add the other constant stuff
-    for row in AssocTaskSpec(
-        input_iter, var_pairs, dist_maps, opts.output_base_dir, bad_c):
+    for row in rows:
 
       num_reports = 0  # placeholder, not filtering yet
       tokens = (num_reports,) + row
@@ -4,13 +4,30 @@ task_spec_test.py: Tests for task_spec.py
 """
 
 import cStringIO
+import os
+import shutil
+import tempfile
 import unittest
 
 import task_spec  # module under test
 
 
+def _WriteTask(task_dir, status_name, status, results_name):
+  os.makedirs(task_dir)
+  with open(os.path.join(task_dir, status_name), 'w') as f:
+    f.write(status)
+  with open(os.path.join(task_dir, results_name), 'w') as f:
+    f.write('results\n')
+
+
 class TaskSpecTest(unittest.TestCase):
 
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
   def testCountReports(self):
     f = cStringIO.StringIO("""\
 1,2
@@ -56,6 +73,99 @@ gauss,,string,params
         input_iter, field_id_lookup, var_schema, dist_maps, None):
       print row
 
+  def testDistMapLookup(self):
+    f = cStringIO.StringIO("""\
+var,map_filename
+exp,curated.csv
+exp,broad.csv
+gauss,map.csv
+""")
+    dist_maps = task_spec.DistMapLookup(f, 'maps')
+    self.assertEqual(['maps/curated.csv', 'maps/broad.csv'],
+                     dist_maps.GetMapPaths('exp'))
+    self.assertEqual('maps/curated.csv', dist_maps.GetMapPath('exp'))
+    self.assertEqual('maps/curated.csv,maps/broad.csv',
+                     dist_maps.GetMapSpec('exp'))
+    self.assertEqual('maps/map.csv', dist_maps.GetMapSpec('gauss'))
+
+    f = cStringIO.StringIO("""\
+var,map_filename
+exp,map.csv
+exp,map.csv
+""")
+    self.assertRaises(RuntimeError, task_spec.DistMapLookup, f, 'maps')
+
+  def testChainDates(self):
+    # Output of an earlier job.  2015-12-02 failed, so it isn't a prior.
+    prev = os.path.join(self.tmp_dir, 'prev')
+    for date, status in [('2015-11-30', 'OK\n'),
+                         ('2015-12-01', 'OK (cached)\n'),
+                         ('2015-12-02', 'FAIL with status 1\n'),
+                         ('2015-12-04', 'OK\n')]:
+      _WriteTask(os.path.join(prev, 'exp', date), 'STATUS.txt', status,
+                 'results.csv')
+
+    rows = [
+        (10, 'exp', '2015-12-02', 'c2', 'p', 'm'),
+        (10, 'gauss', '2015-12-01', 'c3', 'p', 'm'),
+        (10, 'exp', '2015-12-01', 'c1', 'p', 'm'),
+        (10, 'exp', '2015-12-04', 'c4', 'p', 'm'),
+    ]
+    chained = list(task_spec.ChainDates(rows, prev))
+    # Dates of the same job are never linked to each other.
+    self.assertEqual(
+        [('exp', '2015-12-02', os.path.join(prev, 'exp/2015-12-01')),
+         ('gauss', '2015-12-01', '-'),
+         ('exp', '2015-12-01', os.path.join(prev, 'exp/2015-11-30')),
+         ('exp', '2015-12-04', os.path.join(prev, 'exp/2015-12-01'))],
+        [(row[1], row[2], row[6]) for row in chained])
+
+    # The same task gets the same prior in any batch.
+    self.assertEqual(chained[3:], list(task_spec.ChainDates(rows[3:], prev)))
+
+  def testAssocTaskSpec(self):
+    metrics = {'M': [('domain', 'string'), ('flag..a', 'boolean'),
+                     ('b2', 'boolean'), ('b3', 'boolean')]}
+    f = cStringIO.StringIO('var,map_filename\nM.domain,map.csv\n')
+    dist_maps = task_spec.DistMapLookup(f, 'maps')
+    input_iter = [('r1', '2015-12-01', 'M')]
+
+    var_pairs = task_spec.CreateAssocVarPairs(metrics)
+    self.assertEqual(3, len(var_pairs['M']))
+
+    var_pairs = task_spec.CreateAssocVarPairs(metrics, num_vars=3)
+    rows = list(task_spec.AssocTaskSpec(input_iter, var_pairs, dist_maps,
+                                        'out', None))
+    self.assertEqual(
+        [('M', '2015-12-01', 'r1', 'domain', 'flag..a,b2', 'maps/map.csv',
+          'out/M/domain_X_flag_a_X_b2/2015-12-01'),
+         ('M', '2015-12-01', 'r1', 'domain', 'flag..a,b3', 'maps/map.csv',
+          'out/M/domain_X_flag_a_X_b3/2015-12-01'),
+         ('M', '2015-12-01', 'r1', 'domain', 'b2,b3', 'maps/map.csv',
+          'out/M/domain_X_b2_X_b3/2015-12-01')],
+        rows)
+
+  def testChainAssocDates(self):
+    prev = os.path.join(self.tmp_dir, 'prev')
+    _WriteTask(os.path.join(prev, 'M/domain_X_flag/2015-11-30'),
+               'assoc-status.txt', 'OK\n', 'assoc-results.csv')
+
+    rows = [
+        ('M', '2015-12-02', 'r2', 'domain', 'flag', 'm',
+         'out/M/domain_X_flag/2015-12-02'),
+        ('M', '2015-12-01', 'r1', 'domain', 'flag', 'm',
+         'out/M/domain_X_flag/2015-12-01'),
+        ('M', '2015-12-01', 'r1', 'domain', 'b2', 'm',
+         'out/M/domain_X_b2/2015-12-01'),
+    ]
+    chained = list(task_spec.ChainAssocDates(rows, 'out', prev))
+    prior = os.path.join(prev, 'M/domain_X_flag/2015-11-30')
+    self.assertEqual(
+        [('flag', '2015-12-02', prior),
+         ('flag', '2015-12-01', prior),
+         ('b2', '2015-12-01', '-')],
+        [(row[4], row[1], row[7]) for row in chained])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -205,6 +205,23 @@ _run-one-instance() {
         < $true_values \
         > "$instance_dir/case_reports.csv"
       ;;
+
+    numpy)
+      banner "Running RAPPOR Python client simulation with NumPy"
+
+      # Same output as the python impl, but encodes blocks of clients at once.
+      # Fast enough for the 'large' cases.
+      time tests/rappor_sim.py \
+        --engine numpy \
+        --num-bits $num_bits \
+        --num-hashes $num_hashes \
+        --num-cohorts $num_cohorts \
+        -p $p \
+        -q $q \
+        -f $f \
+        < $true_values \
+        > "$instance_dir/case_reports.csv"
+      ;;
       
     cpp)
       banner "Running RAPPOR C++ client (see rappor_sim.log for errors)"
@@ -222,7 +239,7 @@ _run-one-instance() {
       ;;
       
     *)
-      log "Invalid impl $impl (should be one of python|cpp)"
+      log "Invalid impl $impl (should be one of python|numpy|cpp)"
       exit 1
     ;;
     
@@ -323,7 +340,7 @@ default-processes() {
 #   spec_regex: A pattern selecting the subset of tests to run
 #   parallel: Whether the tests are run in parallel (T/F).  Sequential
 #     runs log to the console; parallel runs log to files.
-#   impl: one of python, or cpp
+#   impl: one of python, numpy, or cpp
 #   instances: A number of times each test case is run
 
 _run-tests() {
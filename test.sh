@@ -48,7 +48,8 @@ readonly CLIENT_DIR=$REPO_ROOT/client/python
 # TODO: Separate out deterministic tests from statistical tests (which may
 # rarely fail)
 py-unit() {
-  export PYTHONPATH=$CLIENT_DIR  # to find client library
+  # to find the client library, and fast_em.py for analysis/python/assoc.py
+  export PYTHONPATH=$CLIENT_DIR:$REPO_ROOT/analysis/tensorflow
 
   if test $# -gt 0; then
     "$@"
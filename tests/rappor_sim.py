@@ -22,6 +22,10 @@ column CSV of RAPPOR'd data.
 Input columns: client,true_value
 Output coumns: client,cohort,bloom,prr,rappor
 
+With --engine numpy, the input is encoded in blocks of rows with NumPy array
+operations instead of one rappor.Encoder per row.  The Bloom filter and PRR
+bits are the same as the client library's; the IRR uses NumPy's random numbers.
+
 TODO:
 - cohort should be in the input _input.csv file.
 
@@ -30,6 +34,8 @@ See http://google.github.io/rappor/doc/data-flow.html for details.
 
 import csv
 import collections
+import hashlib
+import itertools
 import optparse
 import os
 import random
@@ -43,6 +49,10 @@ except ImportError:
   print >>sys.stderr, (
       "Native fastrand module not imported; see README for speedups")
   fastrand = None
+try:
+  import numpy as np
+except ImportError:
+  np = None  # only needed for --engine numpy
 
 
 def log(msg, *args):
@@ -83,6 +93,17 @@ def CreateOptionsParser():
       dest='random_mode', default='fast', choices=choices,
       help='Random algorithm (%s)' % '|'.join(choices))
 
+  choices = ['row', 'numpy']
+  p.add_option(
+      '--engine', type='choice', metavar='STR',
+      dest='engine', default='row', choices=choices,
+      help='Simulation engine (%s).  numpy encodes blocks of rows with array '
+           'operations, and ignores -r.' % '|'.join(choices))
+  p.add_option(
+      '--block-size', type='int', metavar='INT', dest='block_size',
+      default=100000, help='Number of input rows per block with --engine '
+      'numpy.')
+
   return p
 
 
@@ -177,6 +198,134 @@ def RapporClientSim(params, irr_rand, csv_in, csv_out):
     csv_out.writerow(out_row)
 
 
+# Padded HMAC keys, as in the hmac module.
+_HMAC_IPAD = ''.join(chr(x ^ 0x36) for x in xrange(256))
+_HMAC_OPAD = ''.join(chr(x ^ 0x5C) for x in xrange(256))
+
+
+def _HmacSha256(key, msg):
+  """hmac.new(key, msg, digestmod=hashlib.sha256).digest(), but faster.
+
+  Most of hmac.new()'s time is spent setting up the object, which we can't
+  reuse because each client has a different key.
+  """
+  if len(key) > 64:
+    key = hashlib.sha256(key).digest()
+  key = key.ljust(64, '\0')
+  inner = hashlib.sha256(key.translate(_HMAC_IPAD) + msg).digest()
+  return hashlib.sha256(key.translate(_HMAC_OPAD) + inner).digest()
+
+
+class _BloomTable(object):
+  """Bloom filter of each (cohort, value), hashed the first time it's seen."""
+
+  def __init__(self, params):
+    self.params = params
+    self.blooms = {}  # (cohort_str, value) -> (bloom, big endian bloom)
+
+  def Lookup(self, cohort_str, value):
+    key = (cohort_str, value)
+    try:
+      return self.blooms[key]
+    except KeyError:
+      bloom = 0
+      for bit_to_set in rappor.get_bloom_bits(
+          value, int(cohort_str), self.params.num_hashes,
+          self.params.num_bloombits):
+        bloom |= (1 << bit_to_set)
+      entry = (bloom, rappor.to_big_endian(bloom))
+      self.blooms[key] = entry
+      return entry
+
+
+def EncodeBlock(params, table, clients, cohort_strs, values, rand):
+  """Encode a block of rows.
+
+  Args:
+    params: rappor.Params
+    table: _BloomTable
+    clients, cohort_strs, values: lists of strings, one entry per row
+    rand: numpy.random.RandomState for the IRR
+
+  Returns:
+    Boolean matrices bloom, prr, irr, each of shape (rows, num_bloombits).
+    Column i is bit i, i.e. 1 << i in the client library's integers.
+  """
+  k = params.num_bloombits
+  entries = [table.Lookup(c, v) for c, v in itertools.izip(cohort_strs,
+                                                           values)]
+  blooms = np.array([bloom for bloom, _ in entries], dtype=np.int64)
+  bloom = ((blooms[:, np.newaxis] >> np.arange(k)) & 1).astype(bool)
+
+  # Like rappor.get_prr_masks().  The HMAC is keyed by the client, so it's
+  # computed per row, but the masks are computed for the whole block.
+  digests = ''.join(
+      _HmacSha256(client, word)
+      for client, (_, word) in itertools.izip(clients, entries))
+  digest_bytes = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 32)[:, :k]
+  uniform = (digest_bytes & 0x01).astype(bool)
+  f_mask = (digest_bytes >> 1) < params.prob_f * 128
+  prr = np.where(f_mask, uniform, bloom)
+
+  # IRR bit is 1 with probability q if the PRR bit is 1, and p otherwise.
+  irr = rand.random_sample(prr.shape) < np.where(prr, params.prob_q,
+                                                 params.prob_p)
+  return bloom, prr, irr
+
+
+def BitStringColumns(matrices):
+  """Format boolean matrices as CSV columns of rappor.bit_string() strings.
+
+  Returns:
+    An array with one string per row, e.g. '0110,0010,1011\r\n' for 3
+    matrices of 4 bits.  The line ends with \r\n, like csv.writer.
+  """
+  num_rows, num_bits = matrices[0].shape
+  width = len(matrices) * (num_bits + 1) + 1
+  chars = np.empty((num_rows, width), dtype=np.uint8)
+  chars.fill(ord(','))
+  for j, bits in enumerate(matrices):
+    start = j * (num_bits + 1)
+    # Highest bit first.
+    chars[:, start:start + num_bits] = bits[:, ::-1] + ord('0')
+  chars[:, -2] = ord('\r')
+  chars[:, -1] = ord('\n')
+  return chars.view('S%d' % width).ravel()
+
+
+def RapporClientSimNumpy(params, rand, f_in, f_out, block_size=100000):
+  """Like RapporClientSim, but encode block_size rows at a time."""
+  if params.num_bloombits > 32:
+    # The PRR uses one byte of an HMAC-SHA256 digest per bit.
+    raise RuntimeError("Can't have more than 32 bits with --engine numpy")
+
+  header = f_in.readline().rstrip('\r\n').split(',')
+  if header != ['client', 'cohort', 'value']:
+    raise RuntimeError('Expected client,cohort,value header, got %s' % header)
+  f_out.write('client,cohort,bloom,prr,irr\r\n')
+
+  table = _BloomTable(params)
+  start_time = time.time()
+  num_rows = 0
+  while True:
+    lines = list(itertools.islice(f_in, block_size))
+    if not lines:
+      break
+    rows = [line.rstrip('\r\n').split(',') for line in lines]
+    clients, cohort_strs, values = zip(*rows)
+
+    bloom, prr, irr = EncodeBlock(params, table, clients, cohort_strs, values,
+                                  rand)
+    bit_columns = BitStringColumns([bloom, prr, irr])
+    f_out.write(''.join(
+        '%s,%s,%s' % row
+        for row in itertools.izip(clients, cohort_strs, bit_columns)))
+
+    num_rows += len(rows)
+    elapsed = time.time() - start_time
+    log('Processed %d inputs in %.2f seconds', num_rows, elapsed)
+
+
 def main(argv):
   (opts, argv) = CreateOptionsParser().parse_args(argv)
 
@@ -189,6 +338,15 @@ def main(argv):
   params.prob_q = opts.prob_q
   params.prob_f = opts.prob_f
 
+  if opts.engine == 'numpy':
+    if np is None:
+      raise RuntimeError('--engine numpy requires NumPy')
+    if opts.assoc_testdata:
+      raise RuntimeError("--engine numpy doesn't support --assoc-testdata")
+    RapporClientSimNumpy(params, np.random.RandomState(), sys.stdin,
+                         sys.stdout, block_size=opts.block_size)
+    return
+
   if opts.random_mode == 'simple':
     irr_rand = rappor.SecureIrrRand(params)
   elif opts.random_mode == 'fast':
@@ -18,16 +18,82 @@
 rappor_sim_test.py: Tests for rappor_sim.py
 """
 
+import cStringIO
+import csv
 import unittest
 
+import numpy as np
+
+import rappor
 import rappor_sim  # module under test
 
 
+INPUT = """\
+client,cohort,value
+c1,1,v1
+c2,2,v2
+c3,3,v1
+c3,3,v3
+c4,0,v1
+"""
+
+
+def _Params(p, q, f):
+  params = rappor.Params()
+  params.num_bloombits = 16
+  params.num_hashes = 2
+  params.num_cohorts = 4
+  params.prob_p = p
+  params.prob_q = q
+  params.prob_f = f
+  return params
+
+
 class RapporSimTest(unittest.TestCase):
 
   def testFoo(self):
     pass
 
+  def testNumpyEngine(self):
+    # With p = 0 and q = 1, the IRR is the PRR, so the output doesn't depend on
+    # the random numbers.
+    params = _Params(0.0, 1.0, 0.5)
+
+    row_out = cStringIO.StringIO()
+    rappor_sim.RapporClientSim(
+        params, rappor.SecureIrrRand(params),
+        csv.reader(cStringIO.StringIO(INPUT)), csv.writer(row_out))
+
+    for block_size in (1, 2, 100):
+      numpy_out = cStringIO.StringIO()
+      rappor_sim.RapporClientSimNumpy(
+          params, np.random.RandomState(1), cStringIO.StringIO(INPUT),
+          numpy_out, block_size=block_size)
+      self.assertEqual(row_out.getvalue(), numpy_out.getvalue())
+
+  def testEncodeBlockIrr(self):
+    params = _Params(0.25, 0.75, 0.0)
+    table = rappor_sim._BloomTable(params)
+    n = 20000
+    clients = ['c%d' % i for i in xrange(n)]
+    bloom, prr, irr = rappor_sim.EncodeBlock(
+        params, table, clients, ['1'] * n, ['v1'] * n,
+        np.random.RandomState(1))
+
+    # f = 0, so the PRR is the Bloom filter.
+    np.testing.assert_array_equal(bloom, prr)
+    self.assertEqual(1, len(table.blooms))  # one (cohort, value)
+    self.assertAlmostEqual(0.75, irr[prr].mean(), delta=0.01)
+    self.assertAlmostEqual(0.25, irr[~prr].mean(), delta=0.01)
+
+  def testBitStringColumns(self):
+    bits = np.array([[True, False, False], [False, True, True]])
+    self.assertEqual(
+        ['001,110\r\n', '110,001\r\n'],
+        list(rappor_sim.BitStringColumns([bits, ~bits])))
+    self.assertEqual(rappor.bit_string(0x6, 3),
+                     rappor_sim.BitStringColumns([bits])[1][:3])
+
 
 if __name__ == "__main__":
   unittest.main()